@@ -15,11 +15,15 @@ import re
 from acct_mgr.api import AccountManager, CommonTemplateProvider
 from acct_mgr.api import IUserIdChanger
 from acct_mgr.api import _, N_, dgettext, gettext, ngettext, tag_
+from acct_mgr.db import SessionStore
 from acct_mgr.guard import AccountGuard
 from acct_mgr.model import change_uid, del_user_attribute, email_verified
 from acct_mgr.model import get_user_attribute, last_seen, set_user_attribute
+from acct_mgr.model import USER_LISTING_ORDER, user_attributes
+from acct_mgr.model import user_listing
 from acct_mgr.notification import NotificationError
-from acct_mgr.register import EmailVerificationModule, RegistrationError
+from acct_mgr.register import EmailVerificationModule, RegExpCheck
+from acct_mgr.register import RegistrationError
 from acct_mgr.util import pretty_precise_timedelta
 from acct_mgr.web_ui import AccountModule
 from trac import __version__ as trac_version
@@ -39,67 +43,152 @@ from trac.web.chrome import add_script, add_stylesheet, add_warning
 from trac.wiki.formatter import format_to_html
 
 
-def fetch_user_data(env, req, filters=None):
+def _verify_email(env):
+    return env.is_enabled(EmailVerificationModule) and \
+           EmailVerificationModule(env).email_enabled and \
+           EmailVerificationModule(env).verify_email
+
+
+def _warn_pattern_errors(env, req):
+    """Add a warning for every invalid RegExpCheck pattern."""
+    for option, error in RegExpCheck(env).pattern_errors():
+        add_warning(req, _("Invalid regular expression in option "
+                           "[account-manager] %(option)s: %(error)s",
+                           option=option, error=error))
+
+
+def _account_approval(approval, email, sent_to, known, verify_email,
+                      filters=None):
+    """Returns the list of pending approvals of an account, or `False`,
+    if the account is excluded by `filters`.
+    """
+    approval = approval and set((approval,)) or set()
+    if approval and filters and not approval.intersection(filters):
+        return False
+    if email and verify_email:
+        # Same as `email_verified`, but with pre-fetched attributes.
+        verified = known and (sent_to is None or sent_to == email)
+        if not verified and (approval or not filters or 'email' in filters):
+            approval.add('email')
+    if filters and 'active' not in filters and not approval:
+        return False
+    return list(approval)
+
+
+def fetch_user_data(env, req, filters=None, order='username', desc=False,
+                    decorate=True):
+    """Returns the list of accounts from all password stores.
+
+    Set `decorate` to `False` for calling `decorate_user_data` later on,
+    i.e. only for accounts that are actually shown.
+    """
     acctmgr = AccountManager(env)
-    guard = AccountGuard(env)
+    verify_email = _verify_email(env)
+    # Get all data with a few queries rather than per account.
+    names = ['name', 'email', 'approval']
+    if verify_email:
+        names.append('email_verification_sent_to')
+    attributes = user_attributes(env, names)
+    ts_seen = dict(last_seen(env))
     accounts = {}
     for username in acctmgr.get_users():
-        if 'ACCTMGR_USER_ADMIN' in req.perm:
-            url = req.href.admin('accounts', 'users', username)
-        else:
-            url = None
-        accounts[username] = {'username': username, 'url': url}
-        if guard.user_locked(username):
-            accounts[username]['locked'] = True
-            t_lock = guard.lock_time(username)
-            if t_lock > 0:
-                t_release = guard.pretty_release_time(req, username)
-                accounts[username]['release_hint'] = _(
-                    "Locked until %(t_release)s",
-                    t_release=t_release)
-    verify_email = env.is_enabled(EmailVerificationModule) and \
-                   EmailVerificationModule(env).email_enabled and \
-                   EmailVerificationModule(env).verify_email
-    for acct, status in get_user_attribute(env, username=None,
-                                           authenticated=None).iteritems():
-        account = accounts.get(acct)
-        if account is not None and 1 in status:
-            # Only use attributes related to authenticated
-            # accounts.
-            account['name'] = status[1].get('name')
-            account['email'] = status[1].get('email')
-            # Obfuscate email address if required.
-            if account['email']:
-                account['email'] = Chrome(env).format_author(req,
-                                                             account['email'])
-            approval = status[1].get('approval')
-            approval = approval and set((approval,)) or set()
-            if approval and filters and not approval.intersection(filters):
-                del accounts[acct]
-                continue
-            if account['email'] and verify_email:
-                if email_verified(env, account['username'], account['email']):
-                    if approval:
-                        account['approval'] = list(approval)
-                elif approval:
-                    account['approval'] = list(approval.union(['email']))
-                elif not filters or 'email' in filters:
-                    account['approval'] = ['email']
-            elif approval:
-                account['approval'] = list(approval)
-    if filters and 'active' not in filters:
-        inactive_accounts = {}
-        for username in accounts:
-            if 'approval' in accounts[username]:
-                # Hint: This is 30 % faster than dict.update() here.
-                inactive_accounts[username] = accounts[username]
-        accounts = inactive_accounts
-    ts_seen = last_seen(env)
-    for username, last_visit in ts_seen:
-        account = accounts.get(username)
-        if account and last_visit:
+        status = attributes.get(username, {})
+        approval = _account_approval(
+            status.get('approval'), status.get('email'),
+            status.get('email_verification_sent_to'), username in ts_seen,
+            verify_email, filters)
+        if approval is False:
+            continue
+        account = {'username': username, 'name': status.get('name'),
+                   'email': status.get('email')}
+        if approval:
+            account['approval'] = approval
+        last_visit = ts_seen.get(username)
+        if last_visit:
             account['last_visit'] = to_datetime(last_visit)
-    return sorted(accounts.itervalues(), key=lambda acct: acct['username'])
+        accounts[username] = account
+    if order == 'last_visit':
+        key = lambda acct: (ts_seen.get(acct['username']) or 0,
+                            acct['username'])
+    elif order in ('name', 'email'):
+        key = lambda acct: (acct[order] or '', acct['username'])
+    else:
+        key = lambda acct: acct['username']
+    accounts = sorted(accounts.itervalues(), key=key, reverse=desc)
+    if decorate:
+        decorate_user_data(env, req, accounts)
+    return accounts
+
+
+def fetch_user_page(env, req, filters=None, order='username', desc=False,
+                    page=1, max_per_page=20):
+    """Returns one page of accounts and the total count of accounts.
+
+    Filtering, sorting and paging are done by the database, if all
+    password stores keep accounts there, so that the cost doesn't grow
+    with the number of accounts.  Otherwise all accounts are listed, but
+    only the shown ones are decorated.
+    """
+    offset = (page - 1) * max_per_page
+    stores = AccountManager(env).password_stores
+    keys = set(getattr(store, 'key', None) for store in stores)
+    if not stores or len(keys) != 1 or \
+            not all(isinstance(store, SessionStore) for store in stores):
+        accounts = fetch_user_data(env, req, filters, order, desc,
+                                   decorate=False)
+        total = len(accounts)
+        accounts = accounts[offset:offset + max_per_page]
+        decorate_user_data(env, req, accounts)
+        return accounts, total
+
+    verify_email = _verify_email(env)
+    total, rows = user_listing(env, keys.pop(), filters, verify_email,
+                               order, desc, max_per_page, offset)
+    accounts = []
+    for username, name, email, approval, sent_to, known, last_visit in rows:
+        account = {'username': username, 'name': name, 'email': email}
+        approval = _account_approval(approval, email, sent_to, known,
+                                     verify_email, filters)
+        if approval:
+            account['approval'] = approval
+        if last_visit:
+            account['last_visit'] = to_datetime(last_visit)
+        accounts.append(account)
+    decorate_user_data(env, req, accounts)
+    return accounts, total
+
+
+def decorate_user_data(env, req, accounts):
+    """Add links, lock status and obfuscated email addresses to accounts."""
+    guard = AccountGuard(env)
+    chrome = Chrome(env)
+    user_admin = 'ACCTMGR_USER_ADMIN' in req.perm
+    if guard.login_attempt_max_count > 0:
+        states = user_attributes(env, guard.STATE_ATTRIBUTES,
+                                 [acct['username'] for acct in accounts])
+    else:
+        states = {}
+    for account in accounts:
+        username = account['username']
+        if user_admin:
+            account['url'] = req.href.admin('accounts', 'users', username)
+        else:
+            account['url'] = None
+        if username in states:
+            locked, t_lock, ts_release = \
+                guard.user_lock_state(states[username])
+            if locked:
+                account['locked'] = True
+                if t_lock > 0:
+                    t_release = ts_release is not None and \
+                                format_datetime(to_datetime(ts_release),
+                                                tzinfo=req.tz) or None
+                    account['release_hint'] = _(
+                        "Locked until %(t_release)s",
+                        t_release=t_release)
+        # Obfuscate email address if required.
+        if account.get('email'):
+            account['email'] = chrome.format_author(req, account['email'])
 
 
 def _getoptions(cls):
@@ -226,7 +315,7 @@ class UserAdminPanel(CommonTemplateProvider):
             changed = False
             # Get data for all authenticated users from 'session_attributes'.
             attr = get_user_attribute(self.env, username=None,
-                                      authenticated=1)
+                                      authenticated=1, ids=True)
             attrs = {}
             accounts = req.args.get('accounts')
             accounts = accounts and accounts.split(',') or []
@@ -302,7 +391,7 @@ class UserAdminPanel(CommonTemplateProvider):
                                      account=tag.ul(accounts_, attributes)))
                 # Update the dict after changes.
                 attr = get_user_attribute(env, username=None,
-                                          authenticated=1)
+                                          authenticated=1, ids=True)
             if not accounts and sel:
                 # Get initial account selection from account/user list.
                 accounts = sel
@@ -508,21 +597,24 @@ class UserAdminPanel(CommonTemplateProvider):
 
         if self.env.is_enabled(AccountGuard):
             attempts = []
-            attempts_count = guard.failed_count(username, reset=None)
+            state = guard.get_state(username)
+            attempts_count = guard.failed_count(username, reset=None,
+                                                state=state)
             if attempts_count > 0:
-                for attempt in guard.get_failed_log(username):
+                for attempt in guard.get_failed_log(username, state):
                     t = format_datetime(to_datetime(
                         attempt['time']), tzinfo=req.tz)
                     attempts.append({'ipnr': attempt['ipnr'], 'time': t})
                 data['attempts'] = attempts
-                data['pretty_lock_time'] = guard.pretty_lock_time(username,
-                                                                  next=True)
+                data['pretty_lock_time'] = guard.pretty_lock_time(
+                    username, next=True, state=state)
             data['attempts_count'] = attempts_count
-            data['lock_count'] = guard.lock_count(username)
-            if guard.user_locked(username) is True:
+            data['lock_count'] = guard.lock_count(username, state=state)
+            if guard.user_locked(username, state) is True:
                 data['user_locked'] = True
                 data['release_time'] = guard.pretty_release_time(req,
-                                                                 username)
+                                                                 username,
+                                                                 state)
 
         # TRANSLATOR: Optionally tabbed account editor's label
         forms = [('edit', _('Modify Account Attributes'))]
@@ -580,22 +672,21 @@ class UserAdminPanel(CommonTemplateProvider):
                 # Toggle approval status for selected accounts.
                 ban = []
                 unban = []
+                # Get approval status of all accounts at once.
+                approval = get_user_attribute(env, attribute='approval')
                 for username in sel:
-                    # Get account approval status.
-                    status = get_user_attribute(env, username,
-                                                attribute='approval')
-                    status = username in status and \
-                             status[username][1].get('approval') or None
+                    status = username in approval and \
+                             approval[username][1].get('approval') or None
                     if status:
                         # Admit authenticated/registered session.
-                        del_user_attribute(env, username,
-                                           attribute='approval')
                         unban.append(username)
                     else:
                         # Ban the account.
-                        set_user_attribute(env, username, 'approval',
-                                           N_('revoked'))
                         ban.append(username)
+                acctmgr.set_user_attributes_bulk(
+                    [(username, 'approval', None) for username in unban] +
+                    [(username, 'approval', N_('revoked'))
+                     for username in ban])
                 msg = None
                 if unban:
                     accounts = tag.b(', '.join(unban))
@@ -616,21 +707,33 @@ class UserAdminPanel(CommonTemplateProvider):
             elif req.args.get('reset') and req.args.get('sel'):
                 # Password reset for one or more accounts.
                 if password_reset_enabled:
-                    for username, name, email in env.get_known_users():
-                        if username in sel:
-                            acctmod._reset_password(req, username, email)
-                    if sel:
+                    # Selected known users, having a name or an email.
+                    users = user_attributes(env, ('email', 'name'), sel)
+                    errors = acctmod._reset_passwords(
+                        req, [(username, users[username].get('email'))
+                              for username in sorted(users)])
+                    reset = [username for username in sorted(users)
+                             if username not in errors or
+                             isinstance(errors[username], NotificationError)]
+                    if reset:
                         add_notice(req, tag_(
                             "Password reset for %(accounts)s.",
-                            accounts=tag.b(', '.join(sel))))
+                            accounts=tag.b(', '.join(reset))))
+                    # Nobody would learn a new password for the others.
+                    skipped = [username for username in sel
+                               if username not in users]
+                    if skipped:
+                        add_warning(req, tag_(
+                            "No name or email address known for "
+                            "%(accounts)s, password not reset.",
+                            accounts=tag.b(', '.join(skipped))))
                 else:
                     add_warning(req, _(
                         "The password reset procedure is not enabled."))
             elif req.args.get('remove') and req.args.get('sel'):
                 # Delete one or more accounts.
                 if delete_enabled:
-                    for account in sel:
-                        self._delete_user(req, account)
+                    self._delete_users(req, sel)
                     if sel:
                         add_notice(req, tag_(
                             "Deleted account: %(accounts)s",
@@ -690,8 +793,11 @@ class UserAdminPanel(CommonTemplateProvider):
                 req.redirect(req.href.admin('accounts', 'users'))
 
             # Read account information.
-            data.update(self._paginate(req, fetch_user_data(env, req,
-                                                            filters)))
+            order = req.args.get('order')
+            if order not in USER_LISTING_ORDER:
+                order = 'username'
+            desc = req.args.get('desc') == '1'
+            data.update(self._paginate(req, filters, order, desc))
         add_stylesheet(req, 'acct_mgr/acctmgr.css')
         add_stylesheet(req, 'common/css/report.css')
         return 'admin_users.html', data
@@ -844,16 +950,35 @@ class UserAdminPanel(CommonTemplateProvider):
             self.log.error('Unable to send user delete notification: %s',
                            exception_to_unicode(e, traceback=True))
 
-    def _paginate(self, req, accounts):
+    def _delete_users(self, req, usernames):
+        """Bulk delete method, that handles notification errors gracefully.
+        """
+        try:
+            self.acctmgr.delete_users(usernames)
+        except NotificationError, e:
+            add_warning(req, _("Error raised while sending a change "
+                               "notification.") +
+                        _("You'll get details with TracLogging "
+                          "enabled."))
+            self.log.error('Unable to send user delete notification: %s',
+                           exception_to_unicode(e, traceback=True))
+
+    def _paginate(self, req, filters, order='username', desc=False):
         max_per_page = as_int(req.session.get('acctmgr_user.max_items'),
-                              self.ACCTS_PER_PAGE)
-        page = int(req.args.get('page', '1'))
-        total = len(accounts)
-        pager = Paginator(accounts, page - 1, max_per_page)
+                              self.ACCTS_PER_PAGE, min=1)
+        page = as_int(req.args.get('page'), 1, min=1)
+        accounts, total = fetch_user_page(self.env, req, filters, order,
+                                          desc, page, max_per_page)
+        pager = Paginator(accounts, page - 1, max_per_page, total)
+
+        def href(**kwargs):
+            kwargs.setdefault('order', order != 'username' and order or None)
+            kwargs.setdefault('desc', desc and '1' or None)
+            return req.href.admin('accounts', 'users', **kwargs)
         pagedata = []
         shown_pages = pager.get_shown_pages(21)
         for shown_page in shown_pages:
-            page_href = req.href.admin('accounts', 'users', page=shown_page)
+            page_href = href(page=shown_page)
             pagedata.append([page_href, None, str(shown_page),
                              _("page %(num)s", num=str(shown_page))])
         # Prepare bottom and top pager navigation data.
@@ -865,14 +990,20 @@ class UserAdminPanel(CommonTemplateProvider):
             # Show '# of #' instead of total count.
             total = pager.displayed_items()
         if pager.has_next_page:
-            next_href = req.href.admin('accounts', 'users', page=page + 1)
+            next_href = href(page=page + 1)
             add_link(req, 'next', next_href, _('Next Page'))
         if pager.has_previous_page:
-            prev_href = req.href.admin('accounts', 'users', page=page - 1)
+            prev_href = href(page=page - 1)
             add_link(req, 'prev', prev_href, _('Previous Page'))
         page_href = req.href.admin('accounts', 'cleanup')
+        # Clicking on the current sort column reverses the order.
+        sort_hrefs = dict((col, href(order=col != 'username' and col or None,
+                                     desc=col == order and not desc and '1'
+                                          or None))
+                          for col in USER_LISTING_ORDER)
         return dict(accounts=pager, displayed_items=total,
-                    page_href=page_href)
+                    page_href=page_href, order=order, desc=desc,
+                    sort_hrefs=sort_hrefs)
 
 
 class ConfigurationAdminPanel(CommonTemplateProvider):
@@ -1091,6 +1222,7 @@ class ConfigurationAdminPanel(CommonTemplateProvider):
                         self.log.debug("%s.%s: %s", cls_name, attr, newval)
                         if newval is not None:
                             cfg.set(option.section, option.name, newval)
+                _warn_pattern_errors(self.env, req)
                 if acctmgr_register:
                     # Should require approval for user self-registrations,
                     # not for accounts created by admin users alone.
@@ -1169,6 +1301,8 @@ class ConfigurationAdminPanel(CommonTemplateProvider):
                 step += 1
             elif ('back' in req.args or 'prev' in req.args) and step > 0:
                 step -= 1
+        if req.method == 'GET' and step == 3:
+            _warn_pattern_errors(self.env, req)
         steps = [
             dict(label=_("Authentication Options"), past=step > 0),
             dict(image='users', label=_("Password Store"), past=step > 1),
@@ -9,15 +9,21 @@
 #
 # Author: Matthew Good <trac@matt-good.net>
 
+import hashlib
+import hmac
+import os
+import sys
+import time
+
 from pkg_resources import resource_filename
 
-from trac.config import BoolOption
+from trac.config import BoolOption, IntOption
 from trac.config import Option, OrderedExtensionsOption
 from trac.core import Component, ExtensionPoint, Interface, TracError
 from trac.core import implements
 from trac.perm import IPermissionRequestor, PermissionCache
 from trac.util.compat import cleandoc
-from trac.util.text import exception_to_unicode
+from trac.util.text import exception_to_unicode, to_utf8
 from trac.util.translation import dgettext, domain_functions
 from trac.web.chrome import ITemplateProvider, add_warning
 from trac.web.main import IRequestFilter
@@ -55,6 +61,15 @@ class IAccountChangeListener(Interface):
         by using the old password again.
         """
 
+    def users_password_reset(resets):
+        """Optional: Passwords of many users have been reset at once.
+
+        `resets` is a sequence of `(user, email, password)` tuples.  Returns
+        a dict mapping users to the error raised for them, if any.
+        AccountManager falls back to `user_password_reset` per user, if a
+        listener doesn't provide this method.
+        """
+
     def user_email_verification_requested(user, token):
         """User verification has been requested."""
 
@@ -114,6 +129,25 @@ class IPasswordStore(Interface):
     def has_user(user):
         """Returns whether the user account exists."""
 
+    def has_user_ignore_case(user):
+        """Optional: Returns whether an account exists, whose name equals
+        the lower-cased `user` disregarding case.
+
+        AccountManager scans `get_users` instead, if a store doesn't
+        provide this method.
+        """
+
+    def get_generation():
+        """Optional: Returns a value, that changes whenever accounts are
+        added to or removed from this store, or passwords are changed.
+
+        AccountManager caches store resolution results and, with
+        'verify_cache_ttl', successful password checks only, while all
+        consulted stores in the chain report an unchanged generation.
+        Stores without this method, or returning None, because they
+        can't notice such changes, are queried every time.
+        """
+
     def set_password(user, password, old_password=None, overwrite=True):
         """Sets the password for the user.
 
@@ -140,6 +174,23 @@ class IPasswordStore(Interface):
         Returns True, if the account existed and was deleted, False otherwise.
         """
 
+    def set_passwords(passwords, overwrite=True):
+        """Optional: Sets passwords for many users at once.
+
+        `passwords` is a sequence of `(user, password)` tuples.  Returns
+        a dict mapping each user to the result `set_password` would have
+        returned.  AccountManager falls back to `set_password` per user,
+        if a store doesn't provide this method.
+        """
+
+    def delete_users(users):
+        """Optional: Deletes many user accounts at once.
+
+        Returns the list of users, that existed and were deleted.
+        AccountManager falls back to `delete_user` per user, if a store
+        doesn't provide this method.
+        """
+
 
 class IUserIdChanger(Interface):
     """An interface for Components, that will participate in changing user
@@ -214,6 +265,21 @@ class AccountManager(Component):
             enforce new store configuration (i.e. changed hash type),
             but should be disabled/unset otherwise.""")
 
+    verify_cache_ttl = IntOption(
+        'account-manager', 'verify_cache_ttl', 0,
+        doc="""Seconds to remember a successful password check, so that
+            clients re-sending credentials with every request, i.e. by
+            HTTP basic authentication, skip hashing. Only a keyed hash
+            of user, password and password store state is kept in memory.
+            Disabled with 0.""")
+
+    # Bounds for the cache of username to password store resolution results.
+    STORE_CACHE_SIZE = 1000
+    STORE_CACHE_TTL = 300
+
+    # Maximum number of users with a remembered password check.
+    VERIFY_CACHE_SIZE = 1000
+
     username_char_blacklist = Option(
         'account-manager', 'username_char_blacklist', ':[]',
         doc="""Always exclude some special characters from usernames.
@@ -223,6 +289,12 @@ class AccountManager(Component):
         # Bind the 'acct_mgr' catalog to the specified locale directory.
         locale_dir = resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        from acct_mgr.util import LRUCache
+        self._user_stores = LRUCache(self.STORE_CACHE_SIZE,
+                                     self.STORE_CACHE_TTL)
+        # Verified credentials by user, see `_verify_digest`.
+        self._verified = LRUCache(self.VERIFY_CACHE_SIZE)
+        self._verify_key = os.urandom(32)
 
     # Public API
 
@@ -239,14 +311,22 @@ class AccountManager(Component):
         return users
 
     def has_user(self, user):
-        exists = False
-        user = self.handle_username_casing(user)
+        return self.find_user_store(user) is not None
+
+    def has_user_ignore_case(self, user):
+        """Returns whether any active store has an account, whose name
+        differs from `user` only by case or is identical.
+        """
+        user = user.lower()
         for store in self.password_stores:
-            if store.has_user(user):
-                exists = True
-                break
-            continue
-        return exists
+            has_user = getattr(store, 'has_user_ignore_case', None)
+            if callable(has_user):
+                if has_user(user):
+                    return True
+            elif any(store_user.lower() == user
+                     for store_user in store.get_users()):
+                return True
+        return False
 
     def set_password(self, user, password, old_password=None, overwrite=True):
         user = self.handle_username_casing(user)
@@ -283,6 +363,12 @@ class AccountManager(Component):
     def check_password(self, user, password):
         valid = False
         user = self.handle_username_casing(user)
+        verified = self._verify_digest(user, password)
+        if verified is not None:
+            cached = self._verified.get(user)
+            if cached is not None and cached[2] > time.time() and \
+                    hmac.compare_digest(cached[0], verified[0]):
+                return True
         for store in self.password_stores:
             valid = store.check_password(user, password)
             if valid:
@@ -291,8 +377,18 @@ class AccountManager(Component):
                         self.get_supporting_store('set_password'):
                     self._maybe_update_hash(user, password)
                 break
+        if valid is True and verified is not None:
+            self._verified.set(user, verified +
+                                     (time.time() + self.verify_cache_ttl,))
         return valid
 
+    def reset_verify_cache(self, user=None):
+        """Forget remembered password checks of `user`, or of all users."""
+        if user is None:
+            self._verified.clear()
+        else:
+            self._verified.pop(user)
+
     def delete_user(self, user):
         user = self.handle_username_casing(user)
         # Delete credentials from password store.
@@ -306,6 +402,105 @@ class AccountManager(Component):
         delete_user(self.env, user)
         self._notify('deleted', user)
 
+    def set_passwords(self, passwords, overwrite=True):
+        """Set passwords for many users at once.
+
+        `passwords` is a sequence of `(user, password)` tuples.  Users are
+        processed store by store, using the optional `set_passwords` method
+        of password stores for doing all work in one go.  Other than
+        `set_password` this doesn't raise an error for existing users, if
+        `overwrite` is False, but skips them.
+
+        Returns a dict mapping users to `True` for created accounts and
+        `False` for updated or skipped ones.
+        """
+        passwords = [(self.handle_username_casing(user), password)
+                     for user, password in passwords]
+        default_store = None
+        stores = []
+        store_passwords = {}
+        for user, password in passwords:
+            store = self.find_user_store(user)
+            if store and not hasattr(store, 'set_password'):
+                raise TracError(_("The authentication backend for user "
+                                  "%(user)s does not support setting the "
+                                  "password.", user=user))
+            elif not store:
+                if default_store is None:
+                    default_store = self.get_supporting_store('set_password')
+                    if not default_store:
+                        raise TracError(_(
+                            """None of the IPasswordStore components listed
+                            in the trac.ini supports setting the password
+                            or creating users.
+                            """))
+                store = default_store
+            if store not in store_passwords:
+                stores.append(store)
+            store_passwords.setdefault(store, []).append((user, password))
+        results = {}
+        for store in stores:
+            set_method = getattr(store, 'set_passwords', None)
+            if callable(set_method):
+                results.update(set_method(store_passwords[store], overwrite))
+                continue
+            for user, password in store_passwords[store]:
+                if not overwrite and store.has_user(user):
+                    results[user] = False
+                else:
+                    results[user] = store.set_password(user, password)
+        changes = []
+        for user, password in passwords:
+            if results.get(user):
+                changes.append(('created', user, password))
+            elif overwrite:
+                changes.append(('password_changed', user, password))
+        self._notify_all(changes)
+        return results
+
+    def delete_users(self, users):
+        """Delete many user accounts at once.
+
+        Password stores providing the optional `delete_users` method remove
+        all their accounts in one go, and session data and permissions of
+        all users are purged within a single transaction.
+        """
+        users = [self.handle_username_casing(user) for user in users]
+        stores = []
+        store_users = {}
+        for user in users:
+            store = self.find_user_store(user)
+            if store is None:
+                continue
+            if store not in store_users:
+                stores.append(store)
+            store_users.setdefault(store, []).append(user)
+        for store in stores:
+            del_method = getattr(store, 'delete_users', None)
+            if callable(del_method):
+                del_method(store_users[store])
+                continue
+            del_method = getattr(store, 'delete_user', None)
+            if callable(del_method):
+                for user in store_users[store]:
+                    del_method(user)
+        from acct_mgr.model import delete_users
+        delete_users(self.env, users)
+        self._notify_all([('deleted', user) for user in users])
+
+    def set_user_attributes_bulk(self, attributes):
+        """Set, update or delete many user attributes at once.
+
+        `attributes` is an iterable of `(user, attribute, value)` tuples,
+        where a `value` of `None` deletes the attribute.  All changes are
+        written within one transaction.
+        """
+        from acct_mgr.model import set_user_attributes
+        set_user_attributes(self.env,
+                            [(self.handle_username_casing(user), attribute,
+                              value)
+                             for user, attribute, value in attributes])
+
     def supports(self, operation):
         try:
             self.password_stores
@@ -345,19 +540,29 @@ class AccountManager(Component):
         """Locates which store contains the user specified.
 
         If the user isn't found in any IPasswordStore in the chain, None is
-        returned.
+        returned.  Stores are asked in chain order, and the result is
+        cached for as long as the generation of every store consulted for
+        it remains unchanged.
         """
-        user_stores = []
-        for store in self.password_stores:
-            user_list = store.get_users()
-            user_stores.append((store, user_list))
-            continue
         user = self.handle_username_casing(user)
-        for store in user_stores:
-            if user in store[1]:
-                return store[0]
-            continue
-        return None
+        stores = self.password_stores
+        cached = self._user_stores.get(user)
+        if cached is not None:
+            user_store, generations = cached
+            if generations == [(store, _store_generation(store))
+                               for store in stores[:len(generations)]]:
+                return user_store
+        user_store = None
+        generations = []
+        for store in stores:
+            # Get generation first, so a concurrent change invalidates.
+            generations.append((store, _store_generation(store)))
+            if store.has_user(user):
+                user_store = store
+                break
+        if None not in [generation for _, generation in generations]:
+            self._user_stores.set(user, (user_store, generations))
+        return user_store
 
     def handle_username_casing(self, user):
         """Enforce lowercase usernames if required.
@@ -406,6 +611,28 @@ class AccountManager(Component):
                 from acct_mgr.model import delete_user
                 delete_user(self.env, username)
 
+    def _verify_digest(self, user, password):
+        """Return a keyed hash of the credentials and the state of all
+        password stores together with that state, or None if password
+        checks are not remembered.
+
+        Stores without generation support can't reveal changes by other
+        processes, so that checks against them are never remembered.
+        """
+        if self.verify_cache_ttl <= 0:
+            return None
+        generations = []
+        for store in self.password_stores:
+            generation = _store_generation(store)
+            if generation is None:
+                return None
+            generations.append(generation)
+        # Remembered generations are kept alive along with the digest,
+        # so that the repr of a renewed opaque token can't match.
+        msg = '\0'.join((to_utf8(user), to_utf8(password), repr(generations)))
+        return hmac.new(self._verify_key, msg, hashlib.sha256).digest(), \
+               generations
+
     def _maybe_update_hash(self, user, password):
         from acct_mgr.model import get_user_attribute, set_user_attribute
         if get_user_attribute(self.env, user, 1,
@@ -432,21 +659,81 @@ class AccountManager(Component):
                                  "method %s: %s", listener.__class__.__name__,
                                  mod, exception_to_unicode(e))
 
+    def _notify_password_resets(self, resets):
+        """Notify listeners about many `(user, email, password)` resets.
+
+        Listeners get notified about all users, even if some notifications
+        fail.  Returns a dict mapping users to the first error raised for
+        them.
+        """
+        errors = {}
+        for listener in self.change_listeners:
+            reset_method = getattr(listener, 'users_password_reset', None)
+            if callable(reset_method):
+                try:
+                    listener_errors = reset_method(resets)
+                except Exception, e:
+                    # All users are affected alike.
+                    listener_errors = dict((user, e)
+                                           for user, email, password
+                                           in resets)
+                for user, error in listener_errors.iteritems():
+                    errors.setdefault(user, error)
+                continue
+            for user, email, password in resets:
+                try:
+                    listener.user_password_reset(user, email, password)
+                except AttributeError, e:
+                    self.log.warning("IAccountChangeListener %s does not "
+                                     "support method user_password_reset: "
+                                     "%s", listener.__class__.__name__,
+                                     exception_to_unicode(e))
+                    break
+                except Exception, e:
+                    errors.setdefault(user, e)
+        return errors
+
+    def _notify_all(self, changes):
+        """Notify listeners about a sequence of `(mod, arg, ...)` changes.
+
+        All changes get notified, even if some notifications fail.
+        The first error is raised at the end.
+        """
+        error = None
+        for change in changes:
+            try:
+                self._notify(*change)
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
     # IAccountChangeListener methods
 
     def user_created(self, user, password):
+        self._user_stores.pop(user)
+        self._verified.pop(user)
         self.log.info("Created new user: %s", user)
 
     def user_id_changed(self, old_uid, new_uid):
+        self._user_stores.pop(old_uid)
+        self._user_stores.pop(new_uid)
+        self._verified.pop(old_uid)
+        self._verified.pop(new_uid)
         self.log.info("Changed user id: from '%s' to '%s'", old_uid, new_uid)
 
     def user_password_changed(self, user, password):
+        self._verified.pop(user)
         self.log.info("Updated password for user: %s", user)
 
     def user_deleted(self, user):
+        self._user_stores.pop(user)
+        self._verified.pop(user)
         self.log.info("Deleted user: %s", user)
 
     def user_password_reset(self, user, email, password):
+        self._verified.pop(user)
         self.log.info("Password reset for user: %s, %s", user, email)
 
     def user_email_verification_requested(self, user, token):
@@ -524,3 +811,11 @@ class GenericUserIdChanger(Component):
     # IUserIdChanger method
     def replace(self, old_uid, new_uid):
         raise NotImplementedError
+
+
+def _store_generation(store):
+    """Return the store's generation, or None if it isn't supported."""
+    get_generation = getattr(store, 'get_generation', None)
+    if get_generation is None:
+        return None
+    return get_generation()
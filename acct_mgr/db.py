@@ -9,12 +9,31 @@
 #
 # Author: Matthew Good <trac@matt-good.net>
 
+import atexit
+import os
+import time
+import weakref
+from contextlib import contextmanager
+from threading import Lock
+
+from trac.cache import cached
 from trac.config import ExtensionOption
-from trac.core import Component, implements
+from trac.core import Component, TracError, implements
+from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
+from trac.db.pool import ConnectionPool
+from trac.db_default import schema
+from trac.util.text import exception_to_unicode
 
 from acct_mgr.api import IPasswordStore
 from acct_mgr.pwhash import IPasswordHashMethod
 
+try:
+    from trac.db.api import parse_connection_uri
+except ImportError:
+    # Trac 1.0 provides it privately only.
+    from trac.db.api import _parse_db_str as parse_connection_uri
+
 
 class SessionStore(Component):
     implements(IPasswordStore)
@@ -25,6 +44,8 @@ class SessionStore(Component):
 
     def __init__(self):
         self.key = 'password'
+        # Lower-cased usernames along with the generation they belong to.
+        self._users_lower = None
         # Check for valid hash method configuration.
         self.hash_method_enabled
 
@@ -44,6 +65,45 @@ class SessionStore(Component):
             return True
         return False
 
+    def has_user_ignore_case(self, user):
+        """Returns whether an account exists, whose name equals the
+        lower-cased `user` disregarding case.
+
+        Lower-cased usernames are kept in memory until the next change
+        of accounts.
+        """
+        generation = self._generation
+        cached = self._users_lower
+        if cached is None or cached[0] is not generation:
+            users = set(sid.lower() for sid in self.get_users())
+            cached = self._users_lower = generation, users
+        return user in cached[1]
+
+    def get_generation(self):
+        return self._generation
+
+    @classmethod
+    def renew_generation(cls, env):
+        """Renew the generation in all processes, i.e. after sessions
+        have been deleted or renamed directly.
+
+        Subclasses share the generation. It is unused, and left alone,
+        while none of them is enabled.
+        """
+        for store_cls in [cls] + cls.__subclasses__():
+            store = env[store_cls]
+            if store is not None:
+                del store._generation
+                return
+
+    @cached
+    def _generation(self):
+        """An opaque token, renewed whenever an account is added,
+        deleted or its password changed by any process sharing the
+        environment.
+        """
+        return object()
+
     def set_password(self, user, password, old_password=None, overwrite=True):
         """Sets the password for the user.
 
@@ -56,22 +116,25 @@ class SessionStore(Component):
         hash_ = self.hash_method.generate_hash(user, password)
         with self.env.db_transaction as db:
             sql = "WHERE authenticated=1 AND name=%s AND sid=%s"
-            if overwrite:
-                db("""
-                    UPDATE session_attribute SET value=%s
-                    """ + sql, (hash_, self.key, user))
             exists = False
             for _ in db("""
                     SELECT value FROM session_attribute
                     """ + sql, (self.key, user)):
                 exists = True
                 break
-            if not exists:
+            if exists:
+                if overwrite:
+                    db("""
+                        UPDATE session_attribute SET value=%s
+                        """ + sql, (hash_, self.key, user))
+                    del self._generation
+            else:
                 db("""
                     INSERT INTO session_attribute
                      (sid,authenticated,name,value)
                     VALUES (%s,1,%s,%s)
                     """, (user, self.key, hash_))
+                del self._generation
 
         return not exists
 
@@ -105,9 +168,65 @@ class SessionStore(Component):
                 db("""
                     DELETE FROM session_attribute %s
                     """ % sql, (self.key, user))
+                del self._generation
 
         return exists
 
+    def set_passwords(self, passwords, overwrite=True):
+        """Sets passwords for many users within one transaction.
+
+        Returns a dict mapping users to True for created accounts,
+        and to False for existing ones.
+        """
+        if not self.hash_method_enabled:
+            return {}
+        hashes = dict((user, self.hash_method.generate_hash(user, password))
+                      for user, password in passwords)
+        with self.env.db_transaction as db:
+            existing = set(sid for sid, in db("""
+                SELECT sid FROM session_attribute
+                WHERE authenticated=1 AND name=%s
+                """, (self.key,))) & set(hashes)
+            if overwrite and existing:
+                db.executemany("""
+                    UPDATE session_attribute SET value=%s
+                    WHERE authenticated=1 AND name=%s AND sid=%s
+                    """, [(hashes[user], self.key, user)
+                          for user in existing])
+                del self._generation
+            created = [(user, self.key, hash_)
+                       for user, hash_ in hashes.iteritems()
+                       if user not in existing]
+            if created:
+                db.executemany("""
+                    INSERT INTO session_attribute
+                     (sid,authenticated,name,value)
+                    VALUES (%s,1,%s,%s)
+                    """, created)
+                del self._generation
+
+        return dict((user, user not in existing) for user in hashes)
+
+    def delete_users(self, users):
+        """Deletes many user accounts within one transaction.
+
+        Returns the list of users, that existed and were deleted.
+        """
+        with self.env.db_transaction as db:
+            existing = set(sid for sid, in db("""
+                SELECT sid FROM session_attribute
+                WHERE authenticated=1 AND name=%s
+                """, (self.key,)))
+            deleted = [user for user in users if user in existing]
+            if deleted:
+                db.executemany("""
+                    DELETE FROM session_attribute
+                    WHERE authenticated=1 AND name=%s AND sid=%s
+                    """, [(self.key, user) for user in deleted])
+                del self._generation
+
+        return deleted
+
     @property
     def hash_method_enabled(self):
         """Prevent AttributeError on plugin load.
@@ -122,3 +241,214 @@ class SessionStore(Component):
                            "can't work", self.__class__)
             return
         return True
+
+
+class SharedDatabase(object):
+    """A database shared by several Trac environments or processes.
+
+    The database is given by a Trac database connection string, and the
+    `table` of the subclass is created on first use.
+    """
+
+    table = None
+
+    def __init__(self, env, uri):
+        self.env = env
+        self.log = env.log
+        scheme, args = parse_connection_uri(uri)
+        dbm = DatabaseManager(env)
+        candidates = [(priority, connector)
+                      for connector in dbm.connectors
+                      for scheme_, priority in
+                      connector.get_supported_schemes()
+                      if scheme_ == scheme]
+        if not candidates:
+            raise TracError("Unsupported database type \"%s\"" % scheme)
+        priority, connector = max(candidates)
+        if priority < 0:
+            raise TracError(connector.error)
+        if scheme == 'sqlite' and not os.path.isabs(args['path']):
+            args['path'] = os.path.join(env.path, args['path'].lstrip('/'))
+        self.timeout = dbm.timeout
+        self._pool = ConnectionPool(5, connector, **args)
+        if scheme == 'sqlite' and not os.path.exists(args['path']):
+            connector.init_db(schema=[self.table], **args)
+        else:
+            self._create_table(connector)
+
+    def shutdown(self):
+        """Close all connections."""
+        self._pool.shutdown()
+
+    def _create_table(self, connector):
+        with self._transaction() as db:
+            try:
+                db("SELECT * FROM %s WHERE 1=0" % self.table.name)
+                return
+            except Exception:
+                db.rollback()
+            for stmt in connector.to_sql(self.table):
+                db(stmt)
+
+    @contextmanager
+    def _transaction(self):
+        db = self._pool.get_cnx(self.timeout)
+        try:
+            yield db
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+class SharedDatabaseHolder(object):
+    """Keeps a `SharedDatabase` of class `cls` open for the configured
+    connection string.
+
+    The database is reopened, when the string changes. If it can't be
+    opened, that is logged, and retried after `RETRY_DELAY` seconds.
+    """
+
+    RETRY_DELAY = 60
+
+    def __init__(self, env, cls):
+        self.env = env
+        self.cls = cls
+        self._lock = Lock()
+        self._uri = self._db = None
+        self._failed = 0
+        _holders.add(self)
+
+    def get(self, uri):
+        """Return the database for `uri`, or None if `uri` is empty or
+        the database is unavailable.
+        """
+        if not uri:
+            uri = None
+        with self._lock:
+            if uri != self._uri or self._db is None and uri and \
+                    self._failed + self.RETRY_DELAY <= time.time():
+                self._close()
+                self._uri = uri
+                if uri:
+                    try:
+                        self._db = self.cls(self.env, uri)
+                    except Exception, e:
+                        self._failed = time.time()
+                        self.env.log.error("Can't open %s database: %s",
+                                           self.cls.__name__,
+                                           exception_to_unicode(e))
+            return self._db
+
+    def close(self):
+        """Close the database, until it's requested again."""
+        with self._lock:
+            self._close()
+            self._uri = None
+
+    def _close(self):
+        db, self._db = self._db, None
+        if db is not None:
+            db.shutdown()
+
+
+# Holders of all environments loaded, for closing databases at exit.
+_holders = weakref.WeakSet()
+
+
+def _close_holders():
+    for holder in list(_holders):
+        holder.close()
+
+atexit.register(_close_holders)
+
+
+class SharedAuthCookies(SharedDatabase):
+    """Authentication cookies kept in a database shared by several Trac
+    environments.
+
+    This enables single sign-on without copying auth cookies into the
+    'auth_cookie' table of every environment.
+    """
+
+    table = [table for table in schema if table.name == 'auth_cookie'][0]
+
+    def get_name(self, cookie, ipnr=None):
+        """Return the username authenticated by an auth cookie, or None.
+
+        The client's IP address is checked too, if `ipnr` is given.
+        """
+        sql = "SELECT name FROM auth_cookie WHERE cookie=%s"
+        args = (cookie,)
+        if ipnr is not None:
+            sql += " AND ipnr=%s"
+            args = (cookie, ipnr)
+        with self._transaction() as db:
+            for name, in db(sql, args):
+                return name
+
+    def insert(self, cookie, name, ipnr, time):
+        with self._transaction() as db:
+            db("DELETE FROM auth_cookie WHERE cookie=%s", (cookie,))
+            db("""
+                INSERT INTO auth_cookie (cookie,name,ipnr,time)
+                VALUES (%s,%s,%s,%s)
+                """, (cookie, name, ipnr, time))
+
+    def delete(self, cookie):
+        with self._transaction() as db:
+            db("DELETE FROM auth_cookie WHERE cookie=%s", (cookie,))
+
+    def delete_users(self, names):
+        with self._transaction() as db:
+            db.executemany("DELETE FROM auth_cookie WHERE name=%s",
+                           [(name,) for name in names])
+
+    def rotate(self, old_cookie, cookie, time):
+        with self._transaction() as db:
+            db("UPDATE auth_cookie SET cookie=%s,time=%s WHERE cookie=%s",
+               (cookie, time, old_cookie))
+
+    def refresh(self, refreshes):
+        """Update the time of many auth cookies, given as a dict."""
+        with self._transaction() as db:
+            db.executemany("UPDATE auth_cookie SET time=%s WHERE cookie=%s",
+                           [(t, cookie)
+                            for cookie, t in refreshes.iteritems()])
+
+
+class SharedLoginAttempts(SharedDatabase):
+    """Failed login attempts counted by several Trac processes, see
+    `LoginRateLimiter`.
+    """
+
+    table = Table('login_attempt')[
+        Column('subject'),
+        Column('time', type='int'),
+        Index(['subject', 'time']),
+        Index(['time'])]
+
+    def count(self, subjects, since):
+        """Return a dict of the number of attempts per subject since
+        `since`, omitting subjects without attempts.
+        """
+        with self._transaction() as db:
+            return dict(db("""
+                SELECT subject,COUNT(*) FROM login_attempt
+                WHERE subject IN (%s) AND time>%%s GROUP BY subject
+                """ % ','.join(['%s'] * len(subjects)),
+                tuple(subjects) + (since,)))
+
+    def add(self, subjects, time):
+        """Record an attempt for all `subjects`."""
+        with self._transaction() as db:
+            db.executemany("""
+                INSERT INTO login_attempt (subject,time) VALUES (%s,%s)
+                """, [(subject, time) for subject in subjects])
+
+    def prune(self, expired):
+        """Drop attempts older than `expired`."""
+        with self._transaction() as db:
+            db("DELETE FROM login_attempt WHERE time<=%s", (expired,))
@@ -8,12 +8,17 @@
 #
 # Author: Steffen Hoffmann <hoff.st@web.de>
 
+import json
+import time
+from ast import literal_eval
 from datetime import timedelta
 
-from acct_mgr.model import del_user_attribute, get_user_attribute
-from acct_mgr.model import set_user_attribute, user_known
+from acct_mgr.db import SharedDatabaseHolder, SharedLoginAttempts
+from acct_mgr.model import set_user_attribute, set_user_attributes
+from acct_mgr.util import SlidingWindowCounter
 from trac.config import IntOption, Option
 from trac.core import Component
+from trac.util.text import exception_to_unicode
 from trac.util.datefmt import format_datetime, pretty_timedelta
 from trac.util.datefmt import to_datetime, to_timestamp
 
@@ -49,6 +54,9 @@ class AccountGuard(Component):
             Value '2' means double locktime after 2nd lock activation,
             four times the initial locktime after 3rd, and so on.""")
 
+    # Session attributes holding the lock state of an account.
+    STATE_ATTRIBUTES = ('failed_logins', 'failed_logins_count', 'lock_count')
+
     def __init__(self):
         # Adjust related values to promote a sane configuration, because the
         # combination of some default values is not meaningful.
@@ -74,7 +82,36 @@ class AccountGuard(Component):
             # interrupting a rewrite in progress by another thread and causing
             # a DoS condition by truncating the configuration file.
 
-    def failed_count(self, user, ipnr=None, reset=False):
+    def get_state(self, user):
+        """Returns the `STATE_ATTRIBUTES` of a known user as a dict.
+
+        All attributes are fetched by a single db query. The result is
+        `None` for anonymous and unknown users. It may be passed as
+        `state` to other methods of this class for avoiding further
+        queries, and is updated by them in place.
+        """
+        if not user:
+            return None
+        state = None
+        for name, value in self.env.db_query("""
+                SELECT a.name,a.value
+                  FROM session AS s
+                  LEFT OUTER JOIN session_attribute AS a
+                    ON a.sid=s.sid AND a.authenticated=1
+                   AND a.name IN (%s)
+                 WHERE s.authenticated=1 AND s.sid=%%s
+                """ % ','.join(['%s'] * len(self.STATE_ATTRIBUTES)),
+                self.STATE_ATTRIBUTES + (user,)):
+            if state is None:
+                state = {}
+            if name is not None:
+                state[name] = value
+        return state
+
+    def _state(self, user, state):
+        return state if state is not None else self.get_state(user)
+
+    def failed_count(self, user, ipnr=None, reset=False, state=None):
         """Report number of previously logged failed login attempts.
 
         Enforce login policy with regards to tracking of login attempts
@@ -83,17 +120,17 @@ class AccountGuard(Component):
         `None` value for reset just reads failed login attempts count.
         `True` value for reset triggers final log deletion.
         """
-        if not user or not user_known(self.env, user):
+        state = self._state(user, state)
+        if state is None:
             return 0
         key = 'failed_logins_count'
-        value = get_user_attribute(self.env, user, 1, key)
-        count = value and user in value and int(value[user][1].get(key)) or 0
+        count = int(state.get(key) or 0)
         if reset is None:
             # Report failed attempts count only.
             return count
         if not reset:
             # Trigger the failed attempt logger.
-            attempts = self.get_failed_log(user)
+            attempts = self._parse_failed_log(state.get('failed_logins'))
             log_length = len(attempts)
             if log_length > self.login_attempt_max_count:
                 # Truncate attempts list preserving most recent events.
@@ -102,18 +139,20 @@ class AccountGuard(Component):
                              'time': to_timestamp(to_datetime(None))})
             count += 1
             # Update or create attempts counter and list.
-            set_user_attribute(self.env, user, 'failed_logins', str(attempts))
-            set_user_attribute(self.env, user, key, count)
+            state.update({'failed_logins': self._format_failed_log(attempts),
+                          key: count})
+            set_user_attributes(self.env, [(user, 'failed_logins',
+                                            state['failed_logins']),
+                                           (user, key, count)])
             self.log.debug("AccountGuard.failed_count(%s) = %s", user, count)
-        else:
-            # Delete existing attempts counter and list.
-            del_user_attribute(self.env, user, 1, 'failed_logins')
-            del_user_attribute(self.env, user, 1, key)
-            # Delete the lock count too.
-            self.lock_count(user, 'reset')
+        elif state:
+            # Delete existing attempts counter and list and the lock count.
+            set_user_attributes(self.env, [(user, name, None)
+                                           for name in self.STATE_ATTRIBUTES])
+            state.clear()
         return count
 
-    def get_failed_log(self, user):
+    def get_failed_log(self, user, state=None):
         """Returns an iterable of previously logged failed login attempts.
 
         The iterable contains a list of dicts in the following form:
@@ -121,12 +160,31 @@ class AccountGuard(Component):
         The time stamp format depends on Trac support for POSIX seconds
         (before 0.12) or POSIX microseconds in more recent Trac versions.
         """
-        if not user:
+        state = self._state(user, state)
+        if not state:
+            return []
+        return self._parse_failed_log(state.get('failed_logins'))
+
+    def _format_failed_log(self, attempts):
+        # Compact JSON list of [time, ipnr] pairs.
+        return json.dumps([[attempt['time'], attempt['ipnr']]
+                           for attempt in attempts], separators=(',', ':'))
+
+    def _parse_failed_log(self, value):
+        if not value:
+            return []
+        try:
+            if value.startswith('[{'):
+                # Written by AccountGuard before version 0.5.
+                return literal_eval(value)
+            return [{'ipnr': ipnr, 'time': time}
+                    for time, ipnr in json.loads(value)]
+        except (SyntaxError, TypeError, ValueError):
+            self.log.warning("AccountGuard: Ignoring malformed failed "
+                             "login log %r", value)
             return []
-        attempts = get_user_attribute(self.env, user, 1, 'failed_logins')
-        return attempts and eval(attempts[user][1].get('failed_logins')) or []
 
-    def lock_count(self, user, action='get'):
+    def lock_count(self, user, action='get', state=None):
         """Count, log and report, how often in succession user account
         lock conditions have been met.
 
@@ -134,37 +192,43 @@ class AccountGuard(Component):
         """
         key = 'lock_count'
         if action != 'reset':
-            value = get_user_attribute(self.env, user, 1, key)
-            count = value and user in value and \
-                    int(value[user][1].get(key)) or 0
+            state = self._state(user, state)
+            count = int(state and state.get(key) or 0)
             if action != 'get':
                 # Push and create or update cached count.
                 count += 1
                 set_user_attribute(self.env, user, key, count)
+                if state is not None:
+                    state[key] = count
         else:
             # Reset/delete lock count cache.
-            del_user_attribute(self.env, user, 1, key)
+            set_user_attributes(self.env, [(user, key, None)])
+            if state is not None:
+                state.pop(key, None)
             count = 0
         return count
 
-    def lock_time(self, user, next=False):
+    def lock_time(self, user, next=False, state=None):
         """Calculate current time-lock length for user account."""
-        base = self.lock_time_progression
-        lock_count = self.lock_count(user)
-        if not user or not user_known(self.env, user):
+        state = self._state(user, state)
+        if state is None:
             return 0
+        t_lock = self._lock_time(int(state.get('lock_count') or 0), next)
+        self.log.debug("AccountGuard.lock_time(%s) = %s%s",
+                       user, t_lock, next and ' (preview)' or '')
+        return t_lock
+
+    def _lock_time(self, lock_count, next=False):
+        base = self.lock_time_progression
+        if next:
+            # Preview calculation.
+            exponent = lock_count
         else:
-            if next:
-                # Preview calculation.
-                exponent = lock_count
-            else:
-                exponent = lock_count - 1
+            exponent = lock_count - 1
         t_lock = self.user_lock_time * base ** exponent
         # Limit maximum lock time.
         if t_lock > self.user_lock_max_time:
             t_lock = self.user_lock_max_time
-        self.log.debug("AccountGuard.lock_time(%s) = %s%s",
-                       user, t_lock, next and ' (preview)' or '')
         return t_lock
 
     @property
@@ -182,55 +246,186 @@ class AccountGuard(Component):
                                 ['user_lock_time_progression'])
         return progression
 
-    def pretty_lock_time(self, user, next=False):
+    def pretty_lock_time(self, user, next=False, state=None):
         """Convenience method for formatting lock time to string."""
-        t_lock = self.lock_time(user, next)
+        t_lock = self.lock_time(user, next, state)
         return (t_lock > 0) and \
                (pretty_timedelta(to_datetime(None) -
                                  timedelta(seconds=t_lock))) or None
 
-    def pretty_release_time(self, req, user):
+    def pretty_release_time(self, req, user, state=None):
         """Convenience method for formatting lock time to string."""
-        ts_release = self.release_time(user)
+        ts_release = self.release_time(user, state)
         if ts_release is None:
             return None
-        return format_datetime(to_datetime(
-            self.release_time(user)), tzinfo=req.tz)
+        return format_datetime(to_datetime(ts_release), tzinfo=req.tz)
 
-    def release_time(self, user):
+    def release_time(self, user, state=None):
         if self.login_attempt_max_count > 0:
             if self.user_lock_time == 0:
                 return 0
             # Logged attempts required for further checking.
-            attempts = self.get_failed_log(user)
-            if attempts:
-                return attempts[-1]['time'] + self.lock_time(user)
+            state = self._state(user, state)
+            if state:
+                return self.user_lock_state(state)[2]
 
-    def user_locked(self, user):
+    def user_locked(self, user, state=None):
         """Returns whether the user account is currently locked.
 
         Expect True, if locked, False, if not and None otherwise.
         """
-        if self.login_attempt_max_count < 1 or not user or \
-                not user_known(self.env, user):
+        if self.login_attempt_max_count < 1 or not user:
+            state = None
+        else:
+            state = self._state(user, state)
+        if state is None:
             self.log.debug("AccountGuard.user_locked(%s) = None (%s)",
-                            user, self.login_attempt_max_count < 1 and
-                            'disabled by configuration' or 'anonymous user')
+                           user, self.login_attempt_max_count < 1 and
+                           'disabled by configuration' or 'anonymous user')
             return None
-        count = self.failed_count(user, reset=None)
+        locked = self.user_lock_state(state)[0]
+        self.log.debug("AccountGuard.user_locked(%s) = %s", user, locked)
+        return locked
+
+    def user_lock_state(self, attributes):
+        """Returns lock status, lock time and release time of a known user.
+
+        Other than `user_locked` and friends, this evaluates the account's
+        `STATE_ATTRIBUTES` given as a dict, so that the state of many
+        accounts can be fetched with a single db query beforehand.
+        """
+        if self.login_attempt_max_count < 1:
+            return None, 0, None
+        count = int(attributes.get('failed_logins_count') or 0)
+        t_lock = self._lock_time(int(attributes.get('lock_count') or 0))
+        ts_release = None
+        if self.user_lock_time == 0:
+            ts_release = 0
+        else:
+            attempts = self._parse_failed_log(
+                attributes.get('failed_logins'))
+            if attempts:
+                ts_release = attempts[-1]['time'] + t_lock
         if count < self.login_attempt_max_count:
-            self.log.debug("AccountGuard.user_locked(%s) = False (try left)",
-                           user)
-            return False
-        ts_release = self.release_time(user)
-        if ts_release == 0:
+            locked = False
+        elif ts_release == 0:
             # Account locked permanently.
-            self.log.debug("AccountGuard.user_locked(%s) = True "
-                           "(permanently)", user)
+            locked = True
+        else:
+            ts_now = to_timestamp(to_datetime(None))
+            locked = ts_release is not None and ts_release - ts_now > 0
+        return locked, t_lock, ts_release
+
+
+class LoginRateLimiter(Component):
+    """Throttles failed login attempts per client IP address and per
+    username, regardless of the account's existence.
+
+    Other than AccountGuard this is consulted before any password store,
+    so that guessing credentials, even of unknown accounts, gets cheap
+    to reject.
+    """
+
+    login_rate_window = IntOption(
+        'account-manager', 'login_rate_window', 300,
+        doc="""Period of time (seconds) for counting failed login attempts
+            by `login_rate_ip_max` and `login_rate_user_max`.""")
+    login_rate_ip_max = IntOption(
+        'account-manager', 'login_rate_ip_max', 0,
+        doc="""Reject login attempts from a client IP address after this
+            number of failed attempts within `login_rate_window`.
+            Value zero means no limit.""")
+    login_rate_user_max = IntOption(
+        'account-manager', 'login_rate_user_max', 0,
+        doc="""Reject login attempts for a username after this number of
+            failed attempts within `login_rate_window`, disregarding case.
+            Value zero means no limit.""")
+    login_rate_db = Option(
+        'account-manager', 'login_rate_db', '',
+        doc="""Database connection string for counting failed login
+            attempts across all processes serving the environment, e.g.
+            `sqlite:db/login_attempt.db`. Attempts are counted in memory
+            of each process otherwise.""")
+
+    def __init__(self):
+        # Counters for the current window and budget configuration.
+        self._counters = None
+        self._shared = SharedDatabaseHolder(self.env, SharedLoginAttempts)
+        # Time of the last removal of expired shared attempts.
+        self._pruned = 0
+
+    @property
+    def enabled(self):
+        return self.login_rate_ip_max > 0 or self.login_rate_user_max > 0
+
+    def limited(self, ipnr, user):
+        """Returns whether login attempts from `ipnr` or for `user` are
+        currently rejected.
+        """
+        subjects = self._subjects(ipnr, user)
+        if not subjects:
+            return False
+        now = time.time()
+        counter = self._get_counter()
+        if any(counter.count(subject, now) >= limit
+               for subject, limit in subjects):
             return True
-        # Time-locked or time-lock expired.
-        ts_now = to_timestamp(to_datetime(None))
-        locked = ts_release - ts_now > 0
-        self.log.debug("AccountGuard.user_locked(%s) = %s (%s)",
-                       user, locked, locked and 'time-lock' or 'lock expired')
-        return locked
+        shared = self.shared_attempts
+        if shared is not None:
+            try:
+                counts = shared.count([subject for subject, _ in subjects],
+                                      int(now - self.login_rate_window))
+            except Exception, e:
+                self.log.warning("LoginRateLimiter: Failed to count shared "
+                                 "login attempts: %s",
+                                 exception_to_unicode(e))
+                return False
+            return any(counts.get(subject, 0) >= limit
+                       for subject, limit in subjects)
+        return False
+
+    def add_failure(self, ipnr, user):
+        """Count a failed login attempt from `ipnr` for `user`."""
+        subjects = self._subjects(ipnr, user)
+        if not subjects:
+            return
+        now = time.time()
+        counter = self._get_counter()
+        for subject, limit in subjects:
+            counter.add(subject, now)
+        shared = self.shared_attempts
+        if shared is not None:
+            try:
+                shared.add([subject for subject, _ in subjects], int(now))
+                # Expired attempts are removed once per window only.
+                if now - self._pruned >= self.login_rate_window:
+                    self._pruned = now
+                    shared.prune(int(now - self.login_rate_window))
+            except Exception, e:
+                self.log.warning("LoginRateLimiter: Failed to add shared "
+                                 "login attempt: %s",
+                                 exception_to_unicode(e))
+
+    @property
+    def shared_attempts(self):
+        """The `SharedLoginAttempts` of `login_rate_db`, or None, also
+        while it can't be opened.
+        """
+        return self._shared.get(self.login_rate_db)
+
+    def _subjects(self, ipnr, user):
+        subjects = []
+        if self.login_rate_ip_max > 0 and ipnr:
+            subjects.append(('ip:' + ipnr, self.login_rate_ip_max))
+        if self.login_rate_user_max > 0 and user:
+            subjects.append(('user:' + user.lower(), self.login_rate_user_max))
+        return subjects
+
+    def _get_counter(self):
+        window = self.login_rate_window
+        limit = max(self.login_rate_ip_max, self.login_rate_user_max)
+        counter = self._counters
+        if counter is None or (counter.window, counter.limit) != \
+                (window, limit):
+            counter = self._counters = SlidingWindowCounter(window, limit)
+        return counter
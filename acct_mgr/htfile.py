@@ -11,13 +11,23 @@
 
 import errno
 import os
+import stat
+import tempfile
+from collections import OrderedDict
+from threading import Lock
 
 from acct_mgr.api import IPasswordStore, _
-from acct_mgr.pwhash import htpasswd, mkhtpasswd, htdigest
-from acct_mgr.util import EnvRelativePathOption
+from acct_mgr.pwhash import PasswordHashExecutor, htdigest
+from acct_mgr.util import EnvRelativePathOption, file_signature
 from trac.config import Option
 from trac.core import Component, TracError, implements
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
 
 class AbstractPasswordFileStore(Component):
     """Base class for managing password files.
@@ -30,8 +40,35 @@ class AbstractPasswordFileStore(Component):
 
     # Note: 'filename' is a required, store-specific option.
 
+    def __init__(self):
+        # Parsed password file content, see `_get_index`.
+        self._index = None
+        # Lower-cased users of an index, see `has_user_ignore_case`.
+        self._users_lower = None
+        self._index_lock = Lock()
+        self._update_lock = Lock()
+
     def has_user(self, user):
-        return user in self.get_users()
+        return user.encode('utf-8') in self._get_index()
+
+    def has_user_ignore_case(self, user):
+        """Returns whether an account exists, whose name equals the
+        lower-cased `user` disregarding case.
+        """
+        users = self._get_index()
+        with self._index_lock:
+            # Appending users changes the index in place, so its size
+            # is compared too.
+            cached = self._users_lower
+            if cached is None or cached[0] is not users or \
+                    cached[1] != len(users):
+                cached = self._users_lower = \
+                    users, len(users), set(u.decode('utf-8').lower()
+                                           for u in users)
+        return user in cached[2]
+
+    def get_generation(self):
+        return file_signature(str(self.filename))
 
     def get_users(self):
         filename = str(self.filename)
@@ -39,18 +76,21 @@ class AbstractPasswordFileStore(Component):
             self.log.error('acct_mgr: get_users() -- '
                            'Can\'t locate password file "%s"', filename)
             return []
-        return self._get_users(filename)
+        users = self._get_index()
+        # Appending users changes the index in place, see `_append_line`.
+        with self._index_lock:
+            users = list(users)
+        return [user.decode('utf-8') for user in users]
 
     def set_password(self, user, password, old_password=None, overwrite=True):
         user = user.encode('utf-8')
         password = password.encode('utf-8')
-        return not self._update_file(self.prefix(user),
-                                     self.userline(user, password),
+        return not self._update_file(user, self.userline(user, password),
                                      overwrite)
 
     def delete_user(self, user):
         user = user.encode('utf-8')
-        return self._update_file(self.prefix(user), None)
+        return self._update_file(user, None)
 
     def check_password(self, user, password):
         filename = str(self.filename)
@@ -60,27 +100,55 @@ class AbstractPasswordFileStore(Component):
             return False
         user = user.encode('utf-8')
         password = password.encode('utf-8')
-        prefix = self.prefix(user)
-        try:
-            with open(filename, 'rU') as f:
-                for line in f:
-                    if line.startswith(prefix):
-                        line = line[len(prefix):].rstrip('\n')
-                        return self._check_userline(user, password, line)
-        except (OSError, IOError):
-            self.log.error('acct_mgr: check_password() -- '
-                           'Can\'t read password file "%s"', filename)
+        suffix = self._get_index().get(user)
+        if suffix is None:
+            return None
+        return self._check_userline(user, password, suffix)
+
+    def _get_index(self):
+        """Returns a mapping of (utf-8 encoded) users to their hash data.
+
+        The password file is parsed only after it has been changed,
+        as indicated by its modification time, size or inode number.
+        Mappings preserve the file order of users.
+        """
+        filename = str(self.filename)
+        with self._index_lock:
+            signature = file_signature(filename)
+            if self._index is None or \
+                    self._index[0] != (filename, signature):
+                index = {}
+                if signature is not None:
+                    try:
+                        with open(filename, 'rU') as f:
+                            index = self._parse_file(f)
+                    except (OSError, IOError):
+                        self.log.error('acct_mgr: _get_index() -- '
+                                       'Can\'t read password file "%s"',
+                                       filename)
+                        return {}
+                self._index = (filename, signature), index
+            index = self._index[1]
+        return index.get(self._index_partition(), {})
+
+    def _index_partition(self):
+        """Returns the key to select relevant entries of the parsed file."""
         return None
 
-    def _update_file(self, prefix, userline, overwrite=True):
+    def _update_file(self, user, userline, overwrite=True):
         """Add or remove user and change password.
 
-        If `userline` is empty, the line starting with `prefix` is removed
-        from the user file. Otherwise the line starting with `prefix`
-        is updated to `userline`.  If no line starts with `prefix`,
-        the `userline` is appended to the file.
+        If `userline` is empty, the line of `user` is removed from the
+        user file. Otherwise the line of `user` is updated to `userline`.
+        If there is no line for `user`, the `userline` is appended to the
+        file without rewriting it.
 
-        Returns `True` if a line matching `prefix` was updated,
+        Other changes are written to a temporary file, that finally
+        replaces the password file, so readers never see partial content.
+        Writers are serialized by an advisory lock on the password file,
+        where supported by the platform.
+
+        Returns `True` if a line of `user` was updated,
         `False` otherwise.
         """
         if not self.filename:
@@ -90,84 +158,179 @@ class AbstractPasswordFileStore(Component):
                   "file is not configured",
                   section=option.section, name=option.name))
         filename = str(self.filename)
-        matched = False
-        new_lines = []
-        eol = '\n'
-        try:
-            # Open existing file read-only to read old content.
-            # DEVEL: Use `with` statement available in Python >= 2.5
-            #   as soon as we don't need to support 2.4 anymore.
-            with open(filename) as f:
-                lines = f.readlines()
-
-            # DEVEL: Beware, in shared use there is a race-condition,
-            #   since file changes by other programs that occure from now on
-            #   are currently not detected and will get overwritten.
-            #   This could be fixed by file locking, but a cross-platform
-            #   implementation is certainly non-trivial.
-            if len(lines) > 0:
-                # predict eol style for lines without eol characters
-                if not os.linesep == '\n':
-                    if lines[-1].endswith('\r') and os.linesep == '\r':
-                        # antique MacOS newline style safeguard
-                        # DEVEL: is this really still needed?
-                        eol = '\r'
-                    elif lines[-1].endswith('\r\n') and os.linesep == '\r\n':
-                        # Windows newline style safeguard
-                        eol = '\r\n'
-
-                for line in lines:
-                    if line.startswith(prefix):
-                        if not matched and userline:
-                            if overwrite:
-                                new_lines.append(userline + eol)
-                            else:
-                                new_lines.append(line.rstrip('\r\n') + eol)
-                        matched = True
-                    # preserve existing lines with proper eol
-                    elif line.endswith(eol) and not \
-                            (eol == '\n' and line.endswith('\r\n')):
-                        new_lines.append(line)
-                    # unify eol style using confirmed default and
-                    # make sure the (last) line has a newline anyway
-                    else:
-                        new_lines.append(line.rstrip('\r\n') + eol)
-        except EnvironmentError, e:
-            if e.errno == errno.ENOENT:
-                # Ignore, when file doesn't exist and create it below.
-                pass
-            elif e.errno == errno.EACCES:
-                raise TracError(_(
-                    """The password file could not be read. Trac requires
-                    read and write access to both the password file
-                    and its parent directory."""))
-            else:
-                raise
-
-        # Finally add the new line here, if it wasn't used before
-        # to update or delete a line, creating content for a new file as well.
-        if not matched and userline:
-            new_lines.append(userline + eol)
-
-        # Try to (re-)open file write-only now and save new content.
         try:
-            with open(filename, 'w') as f:
-                f.writelines(new_lines)
+            with self._update_lock:
+                f = self._open_locked(filename)
+                try:
+                    users = self._get_index()
+                    if user not in users:
+                        if userline:
+                            self._append_line(f, filename, user, userline)
+                        return False
+                    if userline and not overwrite:
+                        return True
+                    f.seek(0)
+                    lines = f.readlines()
+                    if fcntl is None:
+                        # Files can't be replaced while open on Windows.
+                        f.close()
+                    self._replace_file(filename,
+                                       self._update_lines(lines, user,
+                                                          userline))
+                finally:
+                    # Closing the file releases the lock too.
+                    f.close()
+                    if not f.closed:
+                        self.log.debug('acct_mgr: _update_file() -- '
+                                       'Closing password file "%s" failed',
+                                       filename)
         except EnvironmentError, e:
-            if e.errno == errno.EACCES or e.errno == errno.EROFS:
+            if e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
                 raise TracError(_(
                     """The password file could not be updated. Trac requires
                     read and write access to both the password file
                     and its parent directory."""))
-            else:
-                raise
-        if f:
-            # Close open file now, even after exception raised.
+            raise
+        # Don't rely on a changed signature within file timestamp resolution.
+        with self._index_lock:
+            self._index = None
+        return True
+
+    def _open_locked(self, filename):
+        """Open the password file for reading and appending, creating it
+        if it doesn't exist yet, and lock it exclusively.
+        """
+        while True:
+            f = open(filename, 'a+')
+            if fcntl is None:
+                return f
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                # Other writers may have replaced the file in the meantime.
+                if os.fstat(f.fileno()).st_ino == os.stat(filename).st_ino:
+                    return f
+            except EnvironmentError, e:
+                f.close()
+                if e.errno != errno.ENOENT:
+                    raise
             f.close()
-            if not f.closed:
-                self.log.debug('acct_mgr: _update_file() -- '
-                               'Closing password file "%s" failed', filename)
-        return matched
+
+    def _append_line(self, f, filename, user, userline):
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        tail = ''
+        if size:
+            f.seek(max(0, size - 2))
+            tail = f.read()
+        eol = self._predict_eol(tail)
+        signature = file_signature(filename)
+        f.seek(0, os.SEEK_END)
+        if tail and not tail.endswith(('\n', '\r')):
+            # Make sure the last line has a newline anyway.
+            f.write(eol)
+        f.write(userline + eol)
+        f.flush()
+        os.fsync(f.fileno())
+        # Update the index in place, as long as it is still current,
+        # instead of parsing the whole file again.
+        with self._index_lock:
+            if self._index is not None and \
+                    self._index[0] == (filename, signature):
+                index = self._index[1]
+                users = index.setdefault(self._index_partition(),
+                                         OrderedDict())
+                users[user] = userline[len(self.prefix(user)):]
+                self._index = (filename, file_signature(filename)), index
+            else:
+                self._index = None
+
+    def _predict_eol(self, tail):
+        """Returns the eol style for new lines, given the end of the file."""
+        if not os.linesep == '\n':
+            if tail.endswith('\r') and os.linesep == '\r':
+                # antique MacOS newline style safeguard
+                # DEVEL: is this really still needed?
+                return '\r'
+            elif tail.endswith('\r\n') and os.linesep == '\r\n':
+                # Windows newline style safeguard
+                return '\r\n'
+        return '\n'
+
+    def _update_lines(self, lines, user, userline):
+        prefix = self.prefix(user)
+        eol = self._predict_eol(lines and lines[-1] or '')
+        matched = False
+        new_lines = []
+        for line in lines:
+            if line.startswith(prefix):
+                if not matched and userline:
+                    new_lines.append(userline + eol)
+                matched = True
+            # preserve existing lines with proper eol
+            elif line.endswith(eol) and not \
+                    (eol == '\n' and line.endswith('\r\n')):
+                new_lines.append(line)
+            # unify eol style using confirmed default and
+            # make sure the (last) line has a newline anyway
+            else:
+                new_lines.append(line.rstrip('\r\n') + eol)
+        return new_lines
+
+    def _replace_file(self, filename, lines):
+        # Replace the target of symlinks, not the links themselves.
+        filename = os.path.realpath(filename)
+        dirname, basename = os.path.split(filename)
+        st = os.stat(filename)
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename,
+                                           dir=dirname)
+        except EnvironmentError:
+            # No permission to create files next to the password file.
+            self._rewrite_file(filename, lines)
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            # Temporary files are created accessible by the owner only.
+            os.chmod(tmpname, stat.S_IMODE(st.st_mode))
+            tmp_st = os.stat(tmpname)
+            if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+                try:
+                    os.chown(tmpname, st.st_uid, st.st_gid)
+                except (AttributeError, OSError):
+                    # Don't change ownership of shared password files.
+                    os.remove(tmpname)
+                    self._rewrite_file(filename, lines)
+                    return
+            if os.name == 'nt':
+                # DEVEL: Not atomic, but rename doesn't replace files here.
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        # Persist the rename itself too.
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def _rewrite_file(self, filename, lines):
+        """Overwrite the file in place, keeping its inode, owner and group,
+        at the expense of atomicity.
+        """
+        with open(filename, 'r+') as f:
+            f.writelines(lines)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
 
 
 class HtPasswdStore(AbstractPasswordFileStore):
@@ -201,17 +364,21 @@ class HtPasswdStore(AbstractPasswordFileStore):
         return user + ':'
 
     def userline(self, user, password):
-        return self.prefix(user) + mkhtpasswd(password, self.hash_type)
+        return self.prefix(user) + \
+               PasswordHashExecutor(self.env).mkhtpasswd(password,
+                                                         self.hash_type)
 
     def _check_userline(self, user, password, suffix):
-        return suffix == htpasswd(password, suffix)
+        return suffix == PasswordHashExecutor(self.env).htpasswd(password,
+                                                                 suffix)
 
-    def _get_users(self, filename):
-        with open(filename, 'rU') as f:
-            for line in f:
-                user = line.split(':', 1)[0]
-                if user:
-                    yield user.decode('utf-8')
+    def _parse_file(self, f):
+        users = OrderedDict()
+        for line in f:
+            args = line.rstrip('\n').split(':', 1)
+            if len(args) == 2 and args[0] and args[0] not in users:
+                users[args[0]] = args[1]
+        return {None: users}
 
 
 class HtDigestStore(AbstractPasswordFileStore):
@@ -248,12 +415,15 @@ class HtDigestStore(AbstractPasswordFileStore):
     def _check_userline(self, user, password, suffix):
         return suffix == htdigest(user, self.realm.encode('utf-8'), password)
 
-    def _get_users(self, filename):
-        _realm = self.realm.encode('utf-8')
-        with open(filename) as f:
-            for line in f:
-                args = line.split(':')[:2]
-                if len(args) == 2:
-                    user, realm = args
-                    if realm == _realm and user:
-                        yield user.decode('utf-8')
+    def _index_partition(self):
+        return self.realm.encode('utf-8')
+
+    def _parse_file(self, f):
+        realms = {}
+        for line in f:
+            args = line.rstrip('\n').split(':', 2)
+            if len(args) == 3 and args[0]:
+                users = realms.setdefault(args[1], OrderedDict())
+                if args[0] not in users:
+                    users[args[0]] = args[2]
+        return realms
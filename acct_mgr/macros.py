@@ -18,6 +18,7 @@ from trac.wiki.formatter import format_to_oneliner
 from acct_mgr.admin import fetch_user_data
 from acct_mgr.api import AccountManager, CommonTemplateProvider, tag_
 from acct_mgr.guard import AccountGuard
+from acct_mgr.model import user_attributes
 
 
 class AccountManagerWikiMacros(CommonTemplateProvider):
@@ -100,9 +101,12 @@ A misc placeholder with this statement is presented to unprivileged users.
             if 'locked' in kw.keys() or 'locked' in args:
                 guard = AccountGuard(env)
                 locked = []
-                for user in users:
-                    if guard.user_locked(user):
-                        locked.append(user)
+                if guard.login_attempt_max_count > 0:
+                    # Fetch lock state of all users at once.
+                    states = user_attributes(env, guard.STATE_ATTRIBUTES,
+                                             users)
+                    locked = [user for user in users if user in states and
+                              guard.user_lock_state(states[user])[0]]
                 if kw.get('locked', 'True').lower() in ('true', 'yes', '1'):
                     users = locked
                 else:
@@ -7,71 +7,67 @@
 #
 # Author: Matthew Good <trac@matt-good.net>
 
-import hashlib
+from hashlib import md5
+
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+# Byte order of the final digest for the to64() encoding.
+_REARRANGED = ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5))
 
 
 def md5crypt(password, salt, magic='$1$'):
+    # Salts taken from hashes read from the database are unicode.
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf-8')
     # /* The password first, since that is what is most unknown */ /*
     # Then our magic string */ /* Then the raw salt */
-    m = hashlib.md5()
-    m.update(password + magic + salt)
+    m = md5(password + magic + salt)
 
     # /* Then just as many characters of the MD5(pw,salt,pw) */
-    mixin = hashlib.md5(password + salt + password).digest()
-    for i in range(0, len(password)):
-        m.update(mixin[i % 16])
+    pw_len = len(password)
+    mixin = md5(password + salt + password).digest()
+    m.update((mixin * (pw_len // 16 + 1))[:pw_len])
 
     # /* Then something really weird... */
     # Also really broken, as far as I can tell.  -m
-    i = len(password)
+    weird = []
+    i = pw_len
     while i:
-        if i & 1:
-            m.update('\x00')
-        else:
-            m.update(password[0])
+        weird.append('\x00' if i & 1 else password[:1])
         i >>= 1
+    m.update(''.join(weird))
 
     final = m.digest()
 
     # /* and now, just to make sure things don't run too fast */
-    for i in range(1000):
-        m2 = hashlib.md5()
-        if i & 1:
-            m2.update(password)
-        else:
-            m2.update(final)
-
-        if i % 3:
-            m2.update(salt)
-
-        if i % 7:
-            m2.update(password)
-
+    # The inputs only depend on i % 42, so that they are prepared once as
+    # (prefix, suffix) pairs around the digest of the previous round.
+    rounds = []
+    for i in xrange(42):
+        middle = (salt if i % 3 else '') + (password if i % 7 else '')
         if i & 1:
-            m2.update(final)
+            rounds.append((password + middle, ''))
         else:
-            m2.update(password)
-
-        final = m2.digest()
+            rounds.append(('', middle + password))
+    rounds = rounds * 24  # 1008 rounds, only the first 1000 are used
+    for prefix, suffix in rounds[:1000]:
+        final = md5(prefix + final + suffix).digest()
 
     # This is the bit that uses to64() in the original code.
-
-    itoa64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-
-    rearranged = ''
-    for a, b, c in (
-            (0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5)):
-        v = ord(final[a]) << 16 | ord(final[b]) << 8 | ord(final[c])
-        for i in range(4):
-            rearranged += itoa64[v & 0x3f]
+    final = bytearray(final)
+    rearranged = bytearray()
+    for a, b, c in _REARRANGED:
+        v = final[a] << 16 | final[b] << 8 | final[c]
+        for i in xrange(4):
+            rearranged.append(_ITOA64[v & 0x3f])
             v >>= 6
 
-    v = ord(final[11])
-    for i in range(2):
-        rearranged += itoa64[v & 0x3f]
+    v = final[11]
+    for i in xrange(2):
+        rearranged.append(_ITOA64[v & 0x3f])
         v >>= 6
 
-    return magic + salt + '$' + rearranged
+    return magic + salt + '$' + str(rearranged)
 
 
 if __name__ == '__main__':
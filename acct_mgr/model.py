@@ -11,14 +11,42 @@ import hashlib
 import re
 
 from acct_mgr.api import GenericUserIdChanger
+from acct_mgr.db import SessionStore
+from trac.db.api import DatabaseManager
 from trac.util import as_int
 from trac.util.text import exception_to_unicode, to_unicode
 
+# Bound for the number of arguments in SQL 'IN' clauses.
+_MAX_SQL_ARGS = 500
+
 _USER_KEYS = {
     'auth_cookie': 'name',
     'permission': 'username',
 }
 
+# Attributes contributing to `env.get_known_users()`.
+_KNOWN_USER_ATTRIBUTES = ('name', 'email')
+
+# Statements inserting or else updating an authenticated session attribute
+# by relying on the primary key of the 'session_attribute' table.
+_UPSERT_SQL = {
+    'sqlite': """
+        INSERT OR REPLACE INTO session_attribute
+         (sid,authenticated,name,value)
+        VALUES (%s,1,%s,%s)
+        """,
+    'postgres': """
+        INSERT INTO session_attribute (sid,authenticated,name,value)
+        VALUES (%s,1,%s,%s)
+        ON CONFLICT (sid,authenticated,name) DO UPDATE SET value=EXCLUDED.value
+        """,
+    'mysql': """
+        INSERT INTO session_attribute (sid,authenticated,name,value)
+        VALUES (%s,1,%s,%s)
+        ON DUPLICATE KEY UPDATE value=VALUES(value)
+        """,
+}
+
 
 def _get_cc_list(cc_value):
     """Parse cc list.
@@ -105,6 +133,13 @@ class AuthCookieUserIdChanger(UniqueUserIdChanger):
     column = 'name'
     table = 'auth_cookie'
 
+    # IUserIdChanger method
+    def replace(self, old_uid, new_uid):
+        result = super(AuthCookieUserIdChanger, self).replace(old_uid,
+                                                              new_uid)
+        revoke_auth_cookies(self.env, [old_uid])
+        return result
+
 
 class ComponentUserIdChanger(PrimitiveUserIdChanger):
     """Change user IDs in components."""
@@ -353,6 +388,8 @@ def change_uid(env, old_uid, new_uid, changers, attr_overwrite):
             WHERE authenticated=1 AND sid=%s
             """, (old_uid,))
         results.update({('session', 'sid', None): 1})
+    # Credentials of the old user ID must not verify in other processes.
+    SessionStore.renew_generation(env)
 
     return results
 
@@ -374,8 +411,6 @@ def copy_user_attributes(env, username, new_uid, overwrite):
                         attrs_new[new_uid].get(1)):
                 # No attributes found.
                 attrs_new = None
-            # Remove value id hashes.
-            attrs[username][1].pop('id')
             for attribute, value in attrs[username][1].iteritems():
                 if not (attrs_new and attribute in attrs_new[new_uid][1]):
                     db("""
@@ -396,8 +431,15 @@ def copy_user_attributes(env, username, new_uid, overwrite):
 
 
 def get_user_attribute(env, username=None, authenticated=1, attribute=None,
-                       value=None):
-    """Return user attributes."""
+                       value=None, ids=False):
+    """Return user attributes.
+
+    The result is a nested dict `{sid: {authenticated: {name: value}}}`.
+    With `ids` set to `True` unique IDs for all accounts and attributes
+    are added, as required for selecting them in forms, see
+    `_add_attribute_ids`.  If all columns are constrained, a list with
+    the count of matching attributes is returned instead.
+    """
     all_cols = ('sid', 'authenticated', 'name', 'value')
     columns = []
     constraints = []
@@ -432,53 +474,172 @@ def get_user_attribute(env, username=None, authenticated=1, attribute=None,
         """ % (sel_stmt, where_stmt)
     sql_args = tuple(constraints)
 
+    if sel_stmt == 'COUNT(*)':
+        for count, in env.db_query(sql, sql_args):
+            return [count]
+    # Constants for this SQL query are merged with selected columns.
+    constants = dict(zip(columns, constraints))
+    positions = [sel_columns.index(col) if col in sel_columns else None
+                 for col in all_cols]
     res = {}
     for row in env.db_query(sql, sql_args):
-        if sel_stmt == 'COUNT(*)':
-            return [row[0]]
-        res_row = {}
-        res_row.update(zip(sel_columns, row))
-        # Merge with constraints, that are constants for this SQL query.
-        res_row.update(zip(columns, constraints))
-        account = res_row.pop('sid')
-        authenticated = res_row.pop('authenticated')
-        # Create single unique attribute ID.
-        m = hashlib.md5()
-        m.update(''.join([account, str(authenticated),
-                          res_row.get('name')]).encode('utf-8'))
-        row_id = m.hexdigest()
-        if account in res:
-            if authenticated in res[account]:
-                res[account][authenticated].update({
-                    res_row['name']: res_row['value']
-                })
-                res[account][authenticated]['id'].update({
-                    res_row['name']: row_id
-                })
-            else:
-                res[account][authenticated] = {
-                    res_row['name']: res_row['value'],
-                    'id': {res_row['name']: row_id}
-                }
-                # Create account ID for additional authentication state.
-                m = hashlib.md5()
-                m.update(''.join([account,
-                                  str(authenticated)]).encode('utf-8'))
-                res[account]['id'][authenticated] = m.hexdigest()
-        else:
+        account, authenticated, name, value = \
+            [constants[col] if pos is None else row[pos]
+             for col, pos in zip(all_cols, positions)]
+        states = res.get(account)
+        if states is None:
+            states = res[account] = {}
+        attrs = states.get(authenticated)
+        if attrs is None:
+            attrs = states[authenticated] = {}
+        attrs[name] = value
+    if ids:
+        _add_attribute_ids(res)
+    return res
+
+
+def _add_attribute_ids(res):
+    """Add unique IDs of accounts and attributes to a result of
+    `get_user_attribute`.
+
+    IDs of authentication states are stored in `res[sid]['id']`,
+    IDs of attributes in `res[sid][authenticated]['id']`.
+    """
+    for account, states in res.iteritems():
+        state_ids = {}
+        for authenticated, attrs in states.iteritems():
+            prefix = ''.join([account, str(authenticated)])
             # Create account ID for authentication state.
-            m = hashlib.md5()
-            m.update(''.join([account, str(authenticated)]).encode('utf-8'))
-            res[account] = {
-                authenticated: {
-                    res_row['name']: res_row['value'],
-                    'id': {res_row['name']: row_id}
-                },
-                'id': {authenticated: m.hexdigest()}
-            }
+            state_ids[authenticated] = \
+                hashlib.md5(prefix.encode('utf-8')).hexdigest()
+            # Create single unique attribute IDs.
+            attrs['id'] = dict((name, hashlib.md5(
+                                   (prefix + name).encode('utf-8')).hexdigest())
+                               for name in attrs)
+        states['id'] = state_ids
+
+
+def user_attribute(env, username, attribute, authenticated=1, default=None):
+    """Returns the value of a single attribute of a user, or `default`."""
+    for value, in env.db_query("""
+            SELECT value FROM session_attribute
+            WHERE sid=%s AND authenticated=%s AND name=%s
+            """, (username, authenticated, attribute)):
+        return value
+    return default
+
+
+def user_attributes(env, attributes, users=None):
+    """Returns selected attributes of authenticated users at once.
+
+    The result is a mapping of usernames to dicts of attribute values,
+    containing users with at least one of the requested attributes only.
+    Results are restricted to the sequence of `users`, if given.
+    """
+    res = {}
+    if not attributes or users is not None and not users:
+        return res
+    sql = """
+        SELECT sid,name,value
+          FROM session_attribute
+         WHERE authenticated=1 AND name IN (%s)
+        """ % ','.join(['%s'] * len(attributes))
+    if users is None:
+        chunks = [()]
+    else:
+        users = list(users)
+        chunks = [users[i:i + _MAX_SQL_ARGS]
+                  for i in xrange(0, len(users), _MAX_SQL_ARGS)]
+    with env.db_query as db:
+        for chunk in chunks:
+            chunk_sql = sql
+            if chunk:
+                chunk_sql += " AND sid IN (%s)" % ','.join(['%s'] * len(chunk))
+            for sid, name, value in db(chunk_sql,
+                                       tuple(attributes) + tuple(chunk)):
+                res.setdefault(sid, {})[name] = value
     return res
 
 
+# Sort keys supported by `user_listing`.
+USER_LISTING_ORDER = {
+    'username': 'p.sid',
+    'name': "COALESCE(n.value,'')",
+    'email': "COALESCE(e.value,'')",
+    'last_visit': 'COALESCE(s.last_visit,0)',
+}
+
+
+def user_listing(env, key='password', filters=None, verify_email=False,
+                 order='username', desc=False, limit=None, offset=0):
+    """Returns one page of authenticated accounts, that have the
+    `key` attribute (password hashes of SessionStore by default).
+
+    Account approval `filters` are applied, sorting by one of the
+    `USER_LISTING_ORDER` keys as well as `limit` and `offset` are done by
+    the database too.  The result is a tuple of the total count of matching
+    accounts and a list of `(sid, name, email, approval,
+    email_verification_sent_to, known, last_visit)` tuples, `known` being
+    true for accounts with a session.
+    """
+    joins = [
+        ('n', """
+          LEFT OUTER JOIN session_attribute n
+            ON (n.sid=p.sid AND n.authenticated=1 AND n.name='name')"""),
+        ('e', """
+          LEFT OUTER JOIN session_attribute e
+            ON (e.sid=p.sid AND e.authenticated=1 AND e.name='email')"""),
+        ('a', """
+          LEFT OUTER JOIN session_attribute a
+            ON (a.sid=p.sid AND a.authenticated=1 AND a.name='approval')"""),
+        ('v', """
+          LEFT OUTER JOIN session_attribute v
+            ON (v.sid=p.sid AND v.authenticated=1
+                AND v.name='email_verification_sent_to')"""),
+        ('s', """
+          LEFT OUTER JOIN session s
+            ON (s.sid=p.sid AND s.authenticated=1)"""),
+    ]
+    where = "WHERE p.authenticated=1 AND p.name=%s"
+    args = [key]
+    # Tables required for counting matches.
+    tables = set()
+    if filters:
+        # Accounts with unselected approval states are dropped.
+        where += " AND (COALESCE(a.value,'')='' OR a.value IN (%s))" \
+                 % ','.join(['%s'] * len(filters))
+        args.extend(filters)
+        tables.add('a')
+        if 'active' not in filters:
+            # Keep accounts pending approval or email verification only.
+            pending = ["COALESCE(a.value,'')!=''"]
+            if verify_email and 'email' in filters:
+                pending.append("""
+                    (COALESCE(e.value,'')!='' AND (s.sid IS NULL
+                     OR (v.value IS NOT NULL AND v.value!=e.value)))
+                    """)
+                tables.update(['e', 'v', 's'])
+            where += " AND (%s)" % ' OR '.join(pending)
+    count_sql = "SELECT COUNT(*) FROM session_attribute p %s %s" \
+                % (''.join(join for table, join in joins if table in tables),
+                   where)
+    sql = """
+        SELECT p.sid,n.value,e.value,a.value,v.value,s.sid,s.last_visit
+          FROM session_attribute p %s %s
+         ORDER BY %s%s,p.sid%s
+        """ % (''.join(join for table, join in joins), where,
+               USER_LISTING_ORDER[order], desc and ' DESC' or '',
+               desc and ' DESC' or '')
+    if limit is not None:
+        sql += " LIMIT %d OFFSET %d" % (limit, offset)
+    with env.db_query as db:
+        for total, in db(count_sql, args):
+            break
+        rows = [row[:5] + (row[5] is not None, row[6])
+                for row in db(sql, args)]
+    return total, rows
+
+
 def prime_auth_session(env, username):
     """Prime session for registered users before initial login.
 
@@ -501,26 +662,69 @@ def prime_auth_session(env, username):
         env.invalidate_known_users_cache()
 
 
+def _upsert_user_attributes(env, db, rows):
+    """Insert or update `(username, attribute, value)` rows as attributes
+    of authenticated sessions.
+
+    A single statement per row is used where the db backend supports it,
+    a DELETE and INSERT pair otherwise.
+    """
+    scheme = DatabaseManager(env).connection_uri.split(':', 1)[0]
+    sql = _UPSERT_SQL.get(scheme)
+    if scheme == 'postgres' and getattr(db, 'server_version', 0) < 90500:
+        # ON CONFLICT has been added in PostgreSQL 9.5.
+        sql = None
+    if sql is None:
+        db.executemany("""
+            DELETE FROM session_attribute
+            WHERE sid=%s AND authenticated=1 AND name=%s
+            """, [(username, attribute) for username, attribute, _ in rows])
+        sql = """
+            INSERT INTO session_attribute (sid,authenticated,name,value)
+            VALUES (%s,1,%s,%s)
+            """
+    db.executemany(sql, rows)
+
+
+def _invalidate_known_users(env, attributes):
+    if hasattr(env, 'invalidate_known_users_cache') and \
+            any(attribute is None or attribute in _KNOWN_USER_ATTRIBUTES
+                for attribute in attributes):
+        env.invalidate_known_users_cache()
+
+
 def set_user_attribute(env, username, attribute, value):
     """Set or update a Trac user attribute within an atomic db transaction."""
+    with env.db_transaction as db:
+        _upsert_user_attributes(env, db, [(username, attribute, value)])
+    _invalidate_known_users(env, [attribute])
 
-    sql = "WHERE sid=%s AND authenticated=1 AND name=%s"
-    if hasattr(env, 'invalidate_known_users_cache'):
-        env.invalidate_known_users_cache()
 
+def set_user_attributes(env, attributes):
+    """Set, update or delete many Trac user attributes within one atomic
+    db transaction.
+
+    `attributes` is an iterable of `(username, attribute, value)` tuples,
+    where a `value` of `None` deletes the attribute.
+    """
+    values = {}
+    for username, attribute, value in attributes:
+        values[(username, attribute)] = value
+    if not values:
+        return
     with env.db_transaction as db:
-        db("""
-            UPDATE session_attribute SET value=%s
-            """ + sql, (value, username, attribute))
-        for _, in db("""
-                SELECT value FROM session_attribute
-                """ + sql, (username, attribute)):
-            break
-        else:
-            db("""
-                INSERT INTO session_attribute (sid,authenticated,name,value)
-                VALUES (%s,1,%s,%s)
-                """, (username, attribute, value))
+        deleted = [key for key, value in values.iteritems() if value is None]
+        if deleted:
+            db.executemany("""
+                DELETE FROM session_attribute
+                WHERE sid=%s AND authenticated=1 AND name=%s
+                """, deleted)
+        rows = [(username, attribute, value)
+                for (username, attribute), value in values.iteritems()
+                if value is not None]
+        if rows:
+            _upsert_user_attributes(env, db, rows)
+    _invalidate_known_users(env, [attribute for _, attribute in values])
 
 
 def del_user_attribute(env, username=None, authenticated=1, attribute=None):
@@ -544,8 +748,7 @@ def del_user_attribute(env, username=None, authenticated=1, attribute=None):
     sql_args = tuple(constraints)
 
     env.db_transaction(sql, sql_args)
-    if hasattr(env, 'invalidate_known_users_cache'):
-        env.invalidate_known_users_cache()
+    _invalidate_known_users(env, [attribute])
 
 
 def delete_user(env, user):
@@ -562,10 +765,45 @@ def delete_user(env, user):
             db(sql, (user,))
 
     env.log.debug("Purged session data and permissions for user '%s'", user)
+    revoke_auth_cookies(env, [user])
+    SessionStore.renew_generation(env)
     if hasattr(env, 'invalidate_known_users_cache'):
         env.invalidate_known_users_cache()
 
 
+def delete_users(env, users):
+    """Delete session data and permissions of many users at once."""
+    args = [(user,) for user in users]
+    if not args:
+        return
+    with env.db_transaction as db:
+        for table in ['auth_cookie', 'session_attribute', 'session',
+                      'permission']:
+            sql = """
+                    DELETE FROM %s WHERE %s=%%s
+                    """ % (table, _USER_KEYS.get(table, 'sid'))
+            db.executemany(sql, args)
+
+    env.log.debug("Purged session data and permissions for %d users",
+                  len(args))
+    revoke_auth_cookies(env, [user for user, in args])
+    SessionStore.renew_generation(env)
+    if hasattr(env, 'invalidate_known_users_cache'):
+        env.invalidate_known_users_cache()
+
+
+def revoke_auth_cookies(env, users=()):
+    """Discard cached auth cookie resolutions after changes to the
+    'auth_cookie' table, and revoke shared auth cookies of `users`.
+    """
+    from acct_mgr.web_ui import LoginModule
+    login = LoginModule(env)
+    login.revoke_cookie_cache()
+    shared = login.shared_cookies
+    if shared and users:
+        shared.delete_users(users)
+
+
 def last_seen(env, user=None):
     sql = """
         SELECT sid,last_visit
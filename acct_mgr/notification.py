@@ -9,13 +9,24 @@
 #
 # Author: Pedro Algarvio <ufs@ufsoft.org>
 
+import atexit
+import json
+import time
+import weakref
+from threading import Event, Lock, Thread, current_thread
+
 from trac.admin import IAdminPanelProvider
-from trac.config import Option, ListOption
+from trac.config import BoolOption, IntOption, Option, ListOption
 from trac.core import Component, TracError, implements
+from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
 from trac.notification import NotifyEmail
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
 
 from acct_mgr.api import IAccountChangeListener, CommonTemplateProvider, \
                          _, dgettext
+from acct_mgr.util import parallel_map
 
 
 class NotificationError(TracError):
@@ -34,33 +45,62 @@ class AccountChangeListener(Component):
 
     def user_created(self, username, password):
         if 'new' in self._notify_actions:
-            notifier = AccountChangeNotification(self.env)
-            notifier.notify(username, 'New user registration')
+            self._send(AccountChangeNotification, username,
+                       'New user registration')
 
     def user_password_changed(self, username, password):
         if 'change' in self._notify_actions:
-            notifier = AccountChangeNotification(self.env)
-            notifier.notify(username, 'Password reset')
+            self._send(AccountChangeNotification, username, 'Password reset')
 
     def user_deleted(self, username):
         if 'delete' in self._notify_actions:
-            notifier = AccountChangeNotification(self.env)
-            notifier.notify(username, 'Deleted User')
+            self._send(AccountChangeNotification, username, 'Deleted User')
 
     def user_password_reset(self, username, email, password):
         notifier = PasswordResetNotification(self.env)
         if email != notifier.email_map.get(username):
             raise Exception(
                 _("The email and username do not match a known account."))
-        notifier.notify(username, password)
+        self._send(PasswordResetNotification, username, password,
+                   notifier=notifier)
+
+    def users_password_reset(self, resets):
+        # Check addresses against the email map of a single notifier.
+        email_map = PasswordResetNotification(self.env).email_map
+        errors = {}
+        messages = []
+        for username, email, password in resets:
+            if email != email_map.get(username):
+                errors[username] = Exception(
+                    _("The email and username do not match a known "
+                      "account."))
+            else:
+                messages.append((PasswordResetNotification,
+                                 (username, password)))
+        queue = NotificationQueue(self.env)
+        if queue.enabled:
+            queue.enqueue_all(messages)
+        else:
+            for (cls, (username, password)), error in \
+                    zip(messages, queue.send_all(messages)):
+                if error is not None:
+                    errors[username] = error
+        return errors
 
     def user_email_verification_requested(self, username, token):
-        notifier = EmailVerificationNotification(self.env)
-        notifier.notify(username, token)
+        self._send(EmailVerificationNotification, username, token)
 
     def user_registration_approval_required(self, username):
-        notifier = EmailVerificationNotification(self.env)
-        notifier.notify(username, 'Registration approval required')
+        self._send(EmailVerificationNotification, username,
+                   'Registration approval required')
+
+    def _send(self, cls, *args, **kwargs):
+        queue = NotificationQueue(self.env)
+        if queue.enabled:
+            queue.enqueue(cls, *args)
+        else:
+            notifier = kwargs.get('notifier') or cls(self.env)
+            notifier.notify(*args)
 
 
 class AccountChangeNotification(NotifyEmail):
@@ -126,17 +166,21 @@ class SingleUserNotification(NotifyEmail):
     def notify(self, username, subject):
         # save the username for use in `get_smtp_address`
         self._username = username
-        old_public_cc = self.config.getbool('notification', 'use_public_cc')
-        # override public cc option so that the user's email is included in
-        # the To: field
-        self.config.set('notification', 'use_public_cc', 'true')
         try:
             NotifyEmail.notify(self, username, subject)
         except Exception, e:
             raise NotificationError(e)
-        # DEVEL: Better use new 'finally' statement here, but
-        #   still need to care for Python 2.4 (RHEL5.x) for now
-        self.config.set('notification', 'use_public_cc', old_public_cc)
+
+    def send(self, torcpts, ccrcpts, mime_headers={}):
+        # Include the user's email in the To: field, which `NotifyEmail`
+        # does with public cc only. Don't override [notification]
+        # use_public_cc for that, as the config is shared by all threads.
+        if not self.config.getbool('notification', 'use_public_cc'):
+            toaddrs = filter(None, [self.get_smtp_address(addr)
+                                    for addr in torcpts])
+            if toaddrs:
+                mime_headers = dict(mime_headers, To=', '.join(toaddrs))
+        NotifyEmail.send(self, torcpts, ccrcpts, mime_headers)
 
 
 class PasswordResetNotification(SingleUserNotification):
@@ -181,6 +225,336 @@ class EmailVerificationNotification(SingleUserNotification):
         SingleUserNotification.notify(self, username, subject)
 
 
+class NotificationQueue(Component):
+    """Persistent queue for delivering account notifications in the
+    background.
+
+    Queued messages are kept in the 'acctmgr_notification' table until
+    they have been sent. Failed deliveries are retried with exponential
+    backoff, and moved aside as dead letters after the last attempt.
+    The background thread starts with the first request, so that messages
+    left over by an earlier process get delivered too.
+    """
+
+    implements(IRequestFilter)
+
+    enabled = BoolOption(
+        'account-manager', 'notification_queue', False,
+        doc="""Send account notifications from a background thread, so
+        that registration and password resets don't wait for the mail
+        server. Note, that queued messages, including temporary passwords,
+        are stored in the database until they have been delivered.""")
+
+    retries = IntOption(
+        'account-manager', 'notification_retries', 5,
+        doc="""Number of attempts to deliver a queued notification,
+        before it is kept as a dead letter.""")
+
+    workers = IntOption(
+        'account-manager', 'notification_workers', 4,
+        doc="""Number of threads sending queued notifications
+        concurrently.""")
+
+    retry_delay = IntOption(
+        'account-manager', 'notification_retry_delay', 60,
+        doc="""Seconds to wait before retrying a failed notification.
+        The delay doubles with every further failed attempt.""")
+
+    # Seconds a message stays claimed by a sender, to keep other Trac
+    # processes from sending it too.
+    LEASE = 300
+
+    # Messages claimed at once for each worker thread.
+    CHUNK = 10
+
+    # Seconds to wait for the background thread to end on shutdown.
+    # Messages still being sent then are claimed until the LEASE ends.
+    SHUTDOWN_TIMEOUT = 10
+
+    notifiers = dict((cls.__name__, cls) for cls in
+                     (AccountChangeNotification, PasswordResetNotification,
+                      EmailVerificationNotification))
+
+    table = Table('acctmgr_notification', key='id')[
+        Column('id', auto_increment=True),
+        Column('notifier'),
+        Column('args'),
+        Column('attempts', type='int'),
+        Column('next_attempt', type='int'),
+        Column('error'),
+        Column('dead', type='int'),
+        Index(['dead', 'next_attempt'])]
+
+    def __init__(self):
+        self._table_created = False
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stop = Event()
+        self._worker = None
+        _queues.add(self)
+
+    def enqueue(self, cls, *args):
+        """Queue a notification of class `cls`, to be sent by calling
+        its `notify` method with `args`.
+        """
+        self.enqueue_all([(cls, args)])
+
+    def enqueue_all(self, messages):
+        """Queue many `(cls, args)` notifications within one transaction."""
+        if not messages:
+            return
+        self._create_table()
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO acctmgr_notification
+                 (notifier,args,attempts,next_attempt,error,dead)
+                VALUES (%s,%s,0,%s,NULL,0)
+                """, [(cls.__name__, json.dumps(args), now)
+                      for cls, args in messages])
+        self._start_worker()
+        self._wakeup.set()
+
+    def send_all(self, messages):
+        """Send many `(cls, args)` notifications right away.
+
+        Messages are split among the worker threads, and each thread
+        reuses one notifier per class, so that templates and email
+        addresses are loaded once per thread instead of once per message.
+        Returns a list of errors in the order of `messages`, with None for
+        each message sent.
+        """
+        workers = max(1, min(self.workers, len(messages)))
+        chunks = [messages[i::workers] for i in xrange(workers)]
+        results = parallel_map(self._send_chunk, chunks, workers)
+        errors = [None] * len(messages)
+        for i, chunk_errors in enumerate(results):
+            errors[i::workers] = chunk_errors
+        return errors
+
+    def _send_chunk(self, messages):
+        notifiers = {}
+        errors = []
+        for cls, args in messages:
+            try:
+                if cls not in notifiers:
+                    notifiers[cls] = cls(self.env)
+                notifiers[cls].notify(*args)
+            except Exception, e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    def process(self, now=None):
+        """Send all notifications due at `now`, and return the number
+        of messages delivered.
+
+        Messages are claimed and delivered in chunks, so that no claim
+        runs out while earlier messages are still being sent.
+        """
+        return self._process(now)
+
+    def _process(self, now=None, stop=None):
+        self._create_table()
+        count = 0
+        while stop is None or not stop.is_set():
+            when = int(time.time()) if now is None else now
+            rows = self.env.db_query("""
+                SELECT id,notifier,args,attempts FROM acctmgr_notification
+                WHERE dead=0 AND next_attempt<=%s ORDER BY id LIMIT %s
+                """, (when, max(1, self.workers) * self.CHUNK))
+            if not rows:
+                return count
+            count += self._deliver([row for row in rows
+                                    if self._claim(row[0], when)], when)
+        return count
+
+    def _deliver(self, due, now):
+        errors = [None] * len(due)
+        messages = []
+        for i, (id, notifier, args, attempts) in enumerate(due):
+            # A corrupt message fails alone, and ends up as a dead letter.
+            try:
+                messages.append((i, (self.notifiers[notifier],
+                                     json.loads(args))))
+            except Exception, e:
+                errors[i] = e
+        for (i, message), error in \
+                zip(messages, self.send_all([m for i, m in messages])):
+            errors[i] = error
+        sent = []
+        for (id, notifier, args, attempts), error in zip(due, errors):
+            if error is None:
+                sent.append((id,))
+            else:
+                self._failed(id, attempts + 1, now, error)
+        if sent:
+            with self.env.db_transaction as db:
+                db.executemany("""
+                    DELETE FROM acctmgr_notification WHERE id=%s
+                    """, sent)
+        return len(sent)
+
+    def get_dead_letters(self):
+        """Return `(id, notifier, args, attempts, error)` of all
+        notifications given up on. `args` is None for corrupt messages.
+        """
+        self._create_table()
+        letters = []
+        for id, notifier, args, attempts, error in self.env.db_query("""
+                SELECT id,notifier,args,attempts,error
+                FROM acctmgr_notification WHERE dead=1 ORDER BY id
+                """):
+            try:
+                args = tuple(json.loads(args))
+            except (TypeError, ValueError):
+                args = None
+            letters.append((id, notifier, args, attempts, error))
+        return letters
+
+    def requeue(self, ids):
+        """Queue dead letters for delivery again."""
+        self._create_table()
+        with self.env.db_transaction as db:
+            db.executemany("""
+                UPDATE acctmgr_notification
+                SET attempts=0,next_attempt=%s,dead=0
+                WHERE id=%s AND dead=1
+                """, [(int(time.time()), id) for id in ids])
+        self._start_worker()
+        self._wakeup.set()
+
+    def _claim(self, id, now):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE acctmgr_notification SET next_attempt=%s
+                WHERE id=%s AND dead=0 AND next_attempt<=%s
+                """, (now + self.LEASE, id, now))
+            return cursor.rowcount == 1
+
+    def _failed(self, id, attempts, now, e):
+        error = exception_to_unicode(e)
+        if attempts >= self.retries:
+            self.log.error("Giving up on notification %s after %s "
+                           "attempts: %s", id, attempts, error)
+            dead, next_attempt = 1, now
+        else:
+            self.log.warning("Notification %s failed, retrying: %s",
+                             id, error)
+            dead = 0
+            next_attempt = now + self.retry_delay * 2 ** (attempts - 1)
+        self.env.db_transaction("""
+            UPDATE acctmgr_notification
+            SET attempts=%s,next_attempt=%s,error=%s,dead=%s WHERE id=%s
+            """, (attempts, next_attempt, error, dead, id))
+
+    def _create_table(self):
+        if self._table_created:
+            return
+        with self._lock:
+            if self._table_created:
+                return
+            connector, args = DatabaseManager(self.env).get_connector()
+            with self.env.db_transaction as db:
+                try:
+                    db("SELECT * FROM acctmgr_notification WHERE 1=0")
+                except Exception:
+                    db.rollback()
+                    for stmt in connector.to_sql(self.table):
+                        db(stmt)
+            self._table_created = True
+
+    def shutdown(self):
+        """Stop the background thread after the current chunk of
+        messages, waiting up to `SHUTDOWN_TIMEOUT` seconds for it.
+        """
+        with self._lock:
+            worker, self._worker = self._worker, None
+            self._stop.set()
+            self._wakeup.set()
+        if worker is not None and worker is not current_thread():
+            worker.join(self.SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                self.log.warning("Notification queue still sending after "
+                                 "%s seconds, not waiting any longer",
+                                 self.SHUTDOWN_TIMEOUT)
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if self._worker is None and self.enabled:
+            self._start_worker()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is None and not self._stop.is_set():
+                stop, wakeup = self._stop, self._wakeup
+
+                def collected(ref):
+                    # The environment is gone, so end the thread too.
+                    stop.set()
+                    wakeup.set()
+                # The thread refers to the queue weakly, so that it doesn't
+                # keep the environment alive.
+                self._worker = Thread(target=_run_queue,
+                                      args=(weakref.ref(self, collected),
+                                            stop, wakeup),
+                                      name='acct_mgr notification queue')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run_once(self):
+        """Deliver due notifications, and return the seconds to wait for
+        the next ones.
+        """
+        try:
+            self._process(stop=self._stop)
+            next_attempt = self._next_attempt()
+        except Exception, e:
+            self.log.error("Notification queue failed: %s",
+                           exception_to_unicode(e, traceback=True))
+            next_attempt = None
+        if next_attempt is None:
+            return self.retry_delay
+        return max(next_attempt - time.time(), 0)
+
+    def _next_attempt(self):
+        for next_attempt, in self.env.db_query("""
+                SELECT MIN(next_attempt) FROM acctmgr_notification
+                WHERE dead=0
+                """):
+            return next_attempt
+
+
+# Queues of all environments loaded, for stopping their threads at exit.
+_queues = weakref.WeakSet()
+
+
+def _stop_queues():
+    for queue in list(_queues):
+        queue.shutdown()
+
+atexit.register(_stop_queues)
+
+
+def _run_queue(ref, stop, wakeup):
+    while True:
+        wakeup.clear()
+        # Checked after clearing, so that no wakeup for stopping is lost.
+        queue = ref()
+        if stop.is_set() or queue is None:
+            break
+        timeout = queue._run_once()
+        del queue
+        wakeup.wait(timeout)
+
+
 class AccountChangeNotificationAdminPanel(CommonTemplateProvider):
     implements(IAdminPanelProvider)
 
@@ -54,6 +54,12 @@ class RadiusAuthStore(Component):
         # DEVEL: Shall we really deny knowing a specified user?
         return False
 
+    def get_generation(self):
+        """Returns None, since passwords may change on the server
+        unnoticed.
+        """
+        return None
+
     def check_password(self, username, password):
         """Checks if the password is valid for the user."""
         # Handle pyrad lib absence and upstream incompatibilities gracefully.
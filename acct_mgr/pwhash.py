@@ -10,14 +10,18 @@
 # Author: Matthew Good <trac@matt-good.net>
 
 import hashlib
+import multiprocessing
+import os
 import re
 from binascii import hexlify
 from os import urandom
+from threading import Lock
 
 from acct_mgr.api import _
 from acct_mgr.md5crypt import md5crypt
-from trac.config import Option
-from trac.core import Component, Interface, implements
+from trac.config import IntOption, Option
+from trac.core import Component, Interface, TracError, implements
+from trac.util.text import exception_to_unicode
 
 try:
     from passlib.apps import custom_app_context as passlib_ctxt
@@ -26,6 +30,11 @@ except ImportError:
     # Hint: Python2.5 is required too
     passlib_ctxt = None
 
+try:
+    from passlib.hash import apr_md5_crypt, md5_crypt
+except ImportError:
+    apr_md5_crypt = md5_crypt = None
+
 
 class IPasswordHashMethod(Interface):
     def generate_hash(user, password):
@@ -43,11 +52,12 @@ class HtPasswdHashMethod(Component):
 
     def generate_hash(self, user, password):
         password = password.encode('utf-8')
-        return mkhtpasswd(password, self.hash_type)
+        return PasswordHashExecutor(self.env).mkhtpasswd(password,
+                                                         self.hash_type)
 
     def check_hash(self, user, password, hash):
         password = password.encode('utf-8')
-        hash2 = htpasswd(password, hash)
+        hash2 = PasswordHashExecutor(self.env).htpasswd(password, hash)
         return hash == hash2
 
 
@@ -65,6 +75,111 @@ class HtDigestHashMethod(Component):
         return hash == self.generate_hash(user, password)
 
 
+class PasswordHashExecutor(Component):
+    """Computes expensive htpasswd hashes in a pool of worker processes.
+
+    Hashing holds the interpreter lock, so that concurrent password
+    checks would otherwise stall all threads of a multi-threaded server.
+    """
+
+    hash_workers = IntOption(
+        'account-manager', 'hash_workers', 0,
+        """Number of worker processes computing expensive htpasswd
+        hashes, i.e. 'md5', 'sha256' and 'sha512' hash types. With 0
+        hashes are computed in the requesting thread.""")
+
+    hash_queue_size = IntOption(
+        'account-manager', 'hash_queue_size', 64,
+        """Maximum number of hashes waiting for worker processes. Further
+        hashes are computed in the requesting thread.""")
+
+    hash_timeout = IntOption(
+        'account-manager', 'hash_timeout', 2,
+        """Seconds to wait for a hash from the worker processes. After
+        that time, the password check fails and setting a password is
+        rejected.""")
+
+    def __init__(self):
+        self._pending = 0
+        self._lock = Lock()
+
+    def htpasswd(self, password, hash):
+        """Same as `htpasswd`, but computed by a worker process, if
+        enabled and the hash type is expensive.
+
+        None is returned, if the worker didn't answer in time.
+        """
+        workers = self.hash_workers
+        if workers < 1 or not hash.startswith(_EXPENSIVE_PREFIXES):
+            return htpasswd(password, hash)
+        with self._lock:
+            queued = self._pending < self.hash_queue_size
+            if queued:
+                self._pending += 1
+        if not queued:
+            self.log.debug("PasswordHashExecutor: queue full")
+            return htpasswd(password, hash)
+        try:
+            # Counted as pending until computed, even after a timeout.
+            result = _get_pool(workers).apply_async(
+                _htpasswd_task, (password, hash), callback=self._done)
+        except OSError, e:
+            self._done(None)
+            self.log.warning("PasswordHashExecutor: worker failed: %s",
+                             exception_to_unicode(e))
+            return htpasswd(password, hash)
+        try:
+            hash2 = result.get(self.hash_timeout)
+        except multiprocessing.TimeoutError:
+            self.log.warning("PasswordHashExecutor: no hash after %s "
+                             "seconds", self.hash_timeout)
+            return None
+        if hash2 is None:
+            # Failed in the worker, so raise the error here.
+            return htpasswd(password, hash)
+        return hash2
+
+    def mkhtpasswd(self, password, hash_type=''):
+        """Same as `mkhtpasswd`, using the worker processes."""
+        hash = self.htpasswd(password, mksalt(hash_type))
+        if hash is None:
+            raise TracError(_("Password hashing timed out, please try "
+                              "again later."))
+        return hash
+
+    def _done(self, hash):
+        with self._lock:
+            self._pending -= 1
+
+
+# Hash types worth the overhead of computation by another process.
+_EXPENSIVE_PREFIXES = ('$apr1$', '$1$', '$5$', '$6$')
+
+_pool = None
+_pool_lock = Lock()
+
+
+def _get_pool(processes):
+    """Return the process pool of this process, created on first use."""
+    global _pool
+    with _pool_lock:
+        pid = os.getpid()
+        if _pool is None or _pool[:2] != (pid, processes):
+            if _pool is not None and _pool[0] == pid:
+                # Let hashes in progress complete.
+                _pool[2].close()
+            _pool = pid, processes, multiprocessing.Pool(processes)
+        return _pool[2]
+
+
+def _htpasswd_task(password, hash):
+    """Return `htpasswd(password, hash)`, or None if it fails."""
+    try:
+        return htpasswd(password, hash)
+    except Exception:
+        return None
+
+
 def _encode(*args):
     return [a.encode('utf-8') for a in args]
 
@@ -78,6 +193,48 @@ except ImportError:
     crypt = None
 
 
+def _passlib_md5crypt(handler):
+    def passlib_md5crypt(password, salt, magic):
+        try:
+            return handler.encrypt(password, salt=salt)
+        except ValueError:
+            # Salt not accepted by passlib, i.e. longer than 8 characters.
+            return md5crypt(password, salt, magic)
+    return passlib_md5crypt
+
+
+def _crypt_md5crypt(password, salt, magic):
+    return crypt(password, magic + salt)
+
+
+def _select_md5crypt(magic, password, hash):
+    """Return the fastest md5crypt implementation for `magic` available,
+    that reproduces the given sample `hash` of `password`.
+    """
+    candidates = []
+    if magic == '$1$' and crypt is not None:
+        candidates.append(_crypt_md5crypt)
+    handler = apr_md5_crypt if magic == '$apr1$' else md5_crypt
+    if handler is not None:
+        candidates.append(_passlib_md5crypt(handler))
+    salt_ = hash[len(magic):].split('$')[0]
+    for candidate in candidates:
+        try:
+            if candidate(password, salt_, magic) == hash:
+                return candidate
+        except Exception:
+            pass
+    return md5crypt
+
+
+_md5crypt = {
+    '$apr1$': _select_md5crypt('$apr1$', 'apache',
+                               '$apr1$J.w5a/..$IW9y6DR0oO/ADuhlMF5/X1'),
+    '$1$': _select_md5crypt('$1$', 'pass',
+                            '$1$YeNsbWdH$wvOF8JdqsoiLix754LTW90'),
+}
+
+
 def salt(salt_char_count=8):
     s = ''
     v = long(hexlify(urandom(int(salt_char_count / 8 * 6))), 16)
@@ -112,7 +269,10 @@ def htpasswd(password, hash):
         return rounds, salt
 
     if hash.startswith('$apr1$'):
-        return md5crypt(password, hash[6:].split('$')[0], '$apr1$')
+        return _md5crypt['$apr1$'](password, hash[6:].split('$')[0],
+                                   '$apr1$')
+    elif hash.startswith('$1$'):
+        return _md5crypt['$1$'](password, hash[3:].split('$')[0], '$1$')
     elif hash.startswith('{SHA}'):
         return '{SHA}' + hashlib.sha1(password).digest().encode('base64')[:-1]
     elif passlib_ctxt is not None and hash.startswith('$5$') and \
@@ -141,7 +301,8 @@ def htpasswd(password, hash):
         return crypt(password, hash)
 
 
-def mkhtpasswd(password, hash_type=''):
+def mksalt(hash_type=''):
+    """Return a new salt for `htpasswd`, including the hash type prefix."""
     hash_prefix_ = hash_prefix(hash_type)
     if hash_type.startswith('sha') and len(hash_type) > 3:
         salt_ = salt(16)
@@ -153,7 +314,11 @@ def mkhtpasswd(password, hash_type=''):
             salt_ = '$apr1$' + salt_
     else:
         salt_ = hash_prefix_ + salt_
-    return htpasswd(password, salt_)
+    return salt_
+
+
+def mkhtpasswd(password, hash_type=''):
+    return htpasswd(password, mksalt(hash_type))
 
 
 def htdigest(user, realm, password):
@@ -16,12 +16,12 @@ import re
 from acct_mgr.api import AccountManager, CommonTemplateProvider
 from acct_mgr.api import IAccountRegistrationInspector
 from acct_mgr.api import _, N_, cleandoc_, dgettext, tag_
-from acct_mgr.model import email_associated, get_user_attribute
-from acct_mgr.model import set_user_attribute
+from acct_mgr.model import email_associated, set_user_attribute
+from acct_mgr.model import user_attribute
 from acct_mgr.notification import NotificationError
 from acct_mgr.util import contains_any
 from trac import perm
-from trac.config import BoolOption, Option
+from trac.config import BoolOption, ConfigurationError, Option
 from trac.core import Component, TracError, implements
 from trac.util.html import html as tag
 from trac.util.text import exception_to_unicode
@@ -139,13 +139,11 @@ class BasicCheck(GenericRegistrationInspector):
         #   and cannot just check for the user being in the permission store.
         #   And better obfuscate whether an existing user or group name
         #   was responsible for rejection of this user name.
-        for store_user in acctmgr.get_users():
-            # Do it carefully by disregarding case.
-            if store_user.lower() == username.lower():
-                raise RegistrationError(tag_(
-                    "Another account or group already exists, who's name "
-                    "differs from %(username)s only by case or is identical.",
-                    username=tag.b(username)))
+        if acctmgr.has_user_ignore_case(username):
+            raise RegistrationError(tag_(
+                "Another account or group already exists, who's name "
+                "differs from %(username)s only by case or is identical.",
+                username=tag.b(username)))
 
         # Password consistency checks follow.
         password = req.args.get('password')
@@ -306,13 +304,57 @@ class RegExpCheck(GenericRegistrationInspector):
         narrow or widen scope i.e. to accept UTF-8 characters.
         """)
 
+    def __init__(self):
+        # Compiled pattern or error message by option name, along with
+        # the option value it has been derived from.
+        self._patterns = {}
+
+    def get_pattern(self, name):
+        """Return the compiled regular expression of option `name`, or
+        None for an empty option.
+
+        Patterns are compiled once per option value, so that changed
+        values are picked up after a configuration reload. Invalid
+        patterns raise a `ConfigurationError`.
+        """
+        value = getattr(self, name).strip()
+        cached = self._patterns.get(name)
+        if cached is None or cached[0] != value:
+            try:
+                pattern = re.compile(value) if value else None
+            except re.error, e:
+                pattern = exception_to_unicode(e)
+                self.log.error("RegExpCheck: Invalid regular expression in "
+                               "option [account-manager] %s: %s", name,
+                               pattern)
+            cached = self._patterns[name] = value, pattern
+        pattern = cached[1]
+        if isinstance(pattern, basestring):
+            raise ConfigurationError(_(
+                "Invalid regular expression in option [account-manager] "
+                "%(option)s: %(error)s", option=name, error=pattern))
+        return pattern
+
+    def pattern_errors(self):
+        """Return `(option, error)` tuples for invalid patterns."""
+        errors = []
+        for name in ('username_regexp', 'email_regexp'):
+            try:
+                self.get_pattern(name)
+            except ConfigurationError:
+                errors.append((name, self._patterns[name][1]))
+        return errors
+
     def validate_registration(self, req):
         acctmgr = AccountManager(self.env)
 
         username = acctmgr.handle_username_casing(
             req.args.get('username', '').strip())
-        if req.path_info != '/prefs' and self.username_regexp != '' and \
-                not re.match(self.username_regexp.strip(), username):
+        if req.path_info != '/prefs':
+            pattern = self.get_pattern('username_regexp')
+        else:
+            pattern = None
+        if pattern is not None and not pattern.match(username):
             raise RegistrationError(N_(
                 "Username %s doesn't match local naming policy."),
                 tag.b(username)
@@ -322,8 +364,8 @@ class RegExpCheck(GenericRegistrationInspector):
         if self.env.is_enabled(EmailCheck) and \
                 self.env.is_enabled(EmailVerificationModule) and \
                 EmailVerificationModule(self.env).verify_email:
-            if self.email_regexp.strip() != '' and \
-                    not re.match(self.email_regexp.strip(), email) and \
+            pattern = self.get_pattern('email_regexp')
+            if pattern is not None and not pattern.match(email) and \
                     not req.args.get('active'):
                 raise RegistrationError(N_(
                     "The email address specified appears to be invalid. "
@@ -338,6 +380,26 @@ class UsernamePermCheck(GenericRegistrationInspector):
     ''This check is bypassed for requests by an authenticated user.''
     """)
 
+    def __init__(self):
+        # Lower-cased permission subjects along with the permission list
+        # they have been derived from.
+        self._subjects = None
+
+    def get_permission_subjects(self):
+        """Return the set of lower-cased users and groups, that have been
+        granted any permission.
+
+        The set is derived again only, if the permission store returns
+        another list of permissions. The default store keeps returning
+        the same list until the permission table is changed.
+        """
+        perms = perm.PermissionSystem(self.env).get_all_permissions()
+        cached = self._subjects
+        if cached is None or cached[0] is not perms:
+            cached = self._subjects = \
+                perms, set(subject.lower() for subject, action in perms)
+        return cached[1]
+
     def validate_registration(self, req):
         if req.authname and req.authname != 'anonymous':
             return
@@ -355,13 +417,11 @@ class UsernamePermCheck(GenericRegistrationInspector):
         #
         #   And again obfuscate whether an existing user or group name
         #   was responsible for rejection of this username.
-        for (perm_user, perm_action) in \
-                perm.PermissionSystem(self.env).get_all_permissions():
-            if perm_user.lower() == username.lower():
-                raise RegistrationError(tag_(
-                    "Another account or group already exists, who's name "
-                    "differs from %(username)s only by case or is identical.",
-                    username=tag.b(username)))
+        if username.lower() in self.get_permission_subjects():
+            raise RegistrationError(tag_(
+                "Another account or group already exists, who's name "
+                "differs from %(username)s only by case or is identical.",
+                username=tag.b(username)))
 
 
 class RegistrationModule(CommonTemplateProvider):
@@ -561,10 +621,8 @@ class EmailVerificationModule(CommonTemplateProvider):
                 # Always warn about issues.
                 chrome.add_warning(req, e)
                 # Look, if the issue existed before.
-                attributes = get_user_attribute(self.env, req.authname,
-                                                attribute='email')
-                email = req.authname in attributes and \
-                        attributes[req.authname][1].get('email') or None
+                email = user_attribute(self.env, req.authname,
+                                       'email') or None
                 new_email = req.args.get('email', '').strip()
                 if (email or new_email) and email != new_email:
                     # Attempt to change email to an empty or invalid
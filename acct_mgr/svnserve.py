@@ -11,7 +11,7 @@
 import os
 
 from acct_mgr.api import IPasswordStore
-from acct_mgr.util import EnvRelativePathOption
+from acct_mgr.util import EnvRelativePathOption, file_signature
 from trac.config import Configuration
 from trac.core import Component, implements
 from trac.versioncontrol.api import RepositoryManager
@@ -62,6 +62,9 @@ class SvnServePasswordStore(Component):
     def has_user(self, user):
         return user in self._config['users']
 
+    def get_generation(self):
+        return file_signature(self._config.filename)
+
     def set_password(self, user, password, old_password=None):
         cfg = self._config
         cfg.set('users', user, password)
@@ -18,8 +18,8 @@ except ImportError:
 
 
 def test_suite():
-    from acct_mgr.tests import admin, api, db, guard, htfile, model, register
-    from acct_mgr.tests import util
+    from acct_mgr.tests import admin, api, db, guard, htfile, model, pwhash
+    from acct_mgr.tests import notification, register, util, web_ui
     from acct_mgr.opt.tests import test_suite as opt_test_suite
 
     suite = unittest.TestSuite()
@@ -29,8 +29,11 @@ def test_suite():
     suite.addTest(guard.test_suite())
     suite.addTest(htfile.test_suite())
     suite.addTest(model.test_suite())
+    suite.addTest(notification.test_suite())
+    suite.addTest(pwhash.test_suite())
     suite.addTest(register.test_suite())
     suite.addTest(util.test_suite())
+    suite.addTest(web_ui.test_suite())
     suite.addTest(opt_test_suite())
 
     # if INCLUDE_FUNCTIONAL_TESTS:
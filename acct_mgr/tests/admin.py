@@ -15,13 +15,16 @@ import unittest
 from trac.core import Component, implements
 from trac.perm import PermissionCache, PermissionSystem
 from trac.test import EnvironmentStub, Mock
+from trac.util.datefmt import to_datetime
 
 from acct_mgr.admin import ExtensionOrder, ConfigurationAdminPanel, \
-                           UserAdminPanel
+                           UserAdminPanel, fetch_user_data, fetch_user_page
 from acct_mgr.api import AccountManager, IAccountRegistrationInspector
 from acct_mgr.db import SessionStore
+from acct_mgr.htfile import HtPasswdStore
 from acct_mgr.register import BasicCheck, GenericRegistrationInspector, \
                               RegistrationError
+from acct_mgr.web_ui import ResetPwStore
 
 
 class BadCheck(Component):
@@ -47,7 +50,7 @@ class _BaseTestCase(unittest.TestCase):
     def setUp(self):
         self.env = EnvironmentStub(enable=[
             'trac.*', 'acct_mgr.api.*', 'acct_mgr.admin.*',
-            'acct_mgr.db.*', 'acct_mgr.register.*',
+            'acct_mgr.db.*', 'acct_mgr.htfile.*', 'acct_mgr.register.*',
             'acct_mgr.pwhash.HtDigestHashMethod',
             'acct_mgr.tests.admin.BadCheck',
             'acct_mgr.tests.admin.DummyCheck'
@@ -183,6 +186,110 @@ class UserAdminPanelTestCase(_BaseTestCase):
         self.assertEqual(response[0], self.user_panel_template)
         self._assert_no_msg(self.req)
 
+    def test_fetch_user_data(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+        self.env.config.set('account-manager', 'login_attempt_max_count', 1)
+        self.env.config.set('account-manager', 'user_lock_time', 0)
+        for user in ('admin', 'banned', 'locked'):
+            self.acctmgr.set_password(user, 'passwd')
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO session (sid,authenticated,last_visit)
+                VALUES (%s,1,%s)
+                """, [('admin', 1), ('banned', 0), ('locked', 0)])
+        self.acctmgr.set_user_attributes_bulk([
+            ('admin', 'name', 'Admin'),
+            ('admin', 'email', 'admin@example.org'),
+            ('banned', 'approval', 'revoked'),
+            ('locked', 'failed_logins', "[{'ipnr': None, 'time': 0}]"),
+            ('locked', 'failed_logins_count', '1')])
+
+        accounts = fetch_user_data(self.env, self.req)
+        self.assertEqual([acct['username'] for acct in accounts],
+                         ['admin', 'banned', 'locked'])
+        admin, banned, locked = accounts
+        self.assertEqual(admin['name'], 'Admin')
+        self.assertEqual(admin['email'], 'admin@example.org')
+        self.assertEqual(admin['last_visit'], to_datetime(1))
+        self.assertFalse('approval' in admin or 'locked' in admin)
+        self.assertEqual(banned['approval'], ['revoked'])
+        self.assertTrue(locked['locked'])
+        self.assertFalse('release_hint' in locked)
+        # Filters drop active accounts.
+        accounts = fetch_user_data(self.env, self.req, ['revoked'])
+        self.assertEqual([acct['username'] for acct in accounts], ['banned'])
+
+    def test_fetch_user_page(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+        for i in range(5):
+            self.acctmgr.set_password('user%d' % i, 'passwd')
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO session (sid,authenticated,last_visit)
+                VALUES (%s,1,%s)
+                """, [('user%d' % i, 5 - i) for i in range(5)])
+        self.acctmgr.set_user_attributes_bulk([
+            ('user1', 'approval', 'pending'),
+            ('user2', 'approval', 'revoked'),
+            ('user3', 'name', 'Last'),
+            ('user4', 'name', 'First')])
+
+        def page(*args, **kwargs):
+            accounts, total = fetch_user_page(self.env, self.req, *args,
+                                              **kwargs)
+            return [acct['username'] for acct in accounts], total
+        filters = ['active', 'pending']
+        self.assertEqual(page(filters, max_per_page=2),
+                         (['user0', 'user1'], 4))
+        self.assertEqual(page(filters, page=2, max_per_page=2),
+                         (['user3', 'user4'], 4))
+        self.assertEqual(page(filters, 'name', max_per_page=2),
+                         (['user0', 'user1'], 4))
+        self.assertEqual(page(filters, 'name', True, max_per_page=2),
+                         (['user3', 'user4'], 4))
+        self.assertEqual(page(filters, 'last_visit', max_per_page=2),
+                         (['user4', 'user3'], 4))
+        self.assertEqual(page(['revoked', 'pending']),
+                         (['user1', 'user2'], 2))
+        accounts, total = fetch_user_page(self.env, self.req, ['revoked'])
+        self.assertEqual(accounts[0]['approval'], ['revoked'])
+        self.assertEqual(accounts[0]['last_visit'], to_datetime(3))
+        self.assertTrue(accounts[0]['url'])
+        # Other password stores are listed in memory, with same results.
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore, HtPasswdStore')
+        self.env.config.set('account-manager', 'htpasswd_file', 'htpasswd')
+        self.assertEqual(list(HtPasswdStore(self.env).get_users()), [])
+        self.assertEqual(page(filters, page=2, max_per_page=2),
+                         (['user3', 'user4'], 4))
+        self.assertEqual(page(filters, 'last_visit', max_per_page=2),
+                         (['user4', 'user3'], 4))
+        self.assertEqual(page(['revoked', 'pending']),
+                         (['user1', 'user2'], 2))
+
+    def test_reset_passwords(self):
+        self.env.enable_component('acct_mgr.web_ui.AccountModule')
+        self.env.enable_component('acct_mgr.web_ui.ResetPwStore')
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+        for user in ('user1', 'user2'):
+            self.acctmgr.set_password(user, 'passwd')
+        self.acctmgr.set_user_attributes_bulk([
+            ('user1', 'email', 'user1@example.org')])
+        self.req.method = 'POST'
+        self.req.args = {'reset': True, 'sel': ['user1', 'user2']}
+        self.admin.render_admin_panel(self.req, 'accounts', 'users', '')
+        # Only accounts reset get listed, and others get reported.
+        notices = [unicode(notice) for notice in self.req.chrome['notices']]
+        self.assertEqual([u'Password reset for <b>user1</b>.'], notices)
+        warnings = [unicode(warning)
+                    for warning in self.req.chrome['warnings']]
+        self.assertEqual([u'No name or email address known for <b>user2</b>, '
+                          u'password not reset.'], warnings)
+        self.assertEqual(['user1'], list(ResetPwStore(self.env).get_users()))
+
     def _assert_no_msg(self, req):
         self.assertEqual(req.chrome['notices'], [])
         self.assertEqual(req.chrome['warnings'], [])
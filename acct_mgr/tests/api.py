@@ -20,6 +20,7 @@ from trac.web.session import Session
 
 from acct_mgr.api import AccountManager
 from acct_mgr.db import SessionStore
+from acct_mgr.htfile import HtDigestStore
 
 
 class _BaseTestCase(unittest.TestCase):
@@ -110,6 +111,164 @@ class AccountManagerTestCase(_BaseTestCase):
         self.mgr.pre_process_request(req, None)
         self.assertFalse(action in req.perm)
 
+    def test_find_user_store(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'HtDigestStore, SessionStore')
+        self.env.config.set('account-manager', 'htdigest_file', '.htdigest')
+        htdigest = HtDigestStore(self.env)
+        htdigest.set_password('admin', 'passwd')
+
+        self.assertEqual(self.mgr.find_user_store('admin'), htdigest)
+        self.assertEqual(self.mgr.find_user_store('user'), self.store)
+        self.assertEqual(self.mgr.find_user_store('foo'), None)
+
+        # Cached results don't query stores again.
+        calls = []
+        has_user = self.store.has_user
+        self.store.has_user = lambda user: calls.append(user) or \
+                                           has_user(user)
+        self.assertEqual(self.mgr.find_user_store('user'), self.store)
+        self.assertTrue(self.mgr.has_user('user'))
+        self.assertEqual(calls, [])
+        del self.store.has_user
+
+        # But changes of any consulted store invalidate them.
+        self.store.set_password('foo', 'passwd')
+        self.assertEqual(self.mgr.find_user_store('foo'), self.store)
+        htdigest.set_password('user', 'passwd')
+        self.assertEqual(self.mgr.find_user_store('user'), htdigest)
+        self.store.delete_user('foo')
+        self.assertEqual(self.mgr.find_user_store('foo'), None)
+
+    def test_has_user_ignore_case(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'HtDigestStore, SessionStore')
+        self.env.config.set('account-manager', 'htdigest_file', '.htdigest')
+        htdigest = HtDigestStore(self.env)
+        htdigest.set_password('Admin', 'passwd')
+        self.store.set_password('Other', 'passwd')
+        for user in ('admin', 'ADMIN', 'user', 'USER', 'other'):
+            self.assertTrue(self.mgr.has_user_ignore_case(user))
+        self.assertFalse(self.mgr.has_user_ignore_case('foo'))
+        # Changes of both stores are picked up.
+        htdigest.set_password('Foo', 'passwd')
+        self.assertTrue(self.mgr.has_user_ignore_case('foo'))
+        self.store.set_password('Bar', 'passwd')
+        self.assertTrue(self.mgr.has_user_ignore_case('BAR'))
+        self.store.delete_user('Bar')
+        htdigest.delete_user('Foo')
+        self.assertFalse(self.mgr.has_user_ignore_case('foo'))
+        self.assertFalse(self.mgr.has_user_ignore_case('bar'))
+
+    def test_verify_cache(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+        self.env.config.set('account-manager', 'verify_cache_ttl', 60)
+        calls = []
+        check_password = self.store.check_password
+        self.store.check_password = lambda user, password: \
+            calls.append(user) or check_password(user, password)
+        self.assertTrue(self.mgr.check_password('user', 'passwd'))
+        self.assertTrue(self.mgr.check_password('user', 'passwd'))
+        self.assertEqual(calls, ['user'])
+        # Wrong passwords are neither served from nor added to the cache.
+        self.assertFalse(self.mgr.check_password('user', 'other'))
+        self.assertFalse(self.mgr.check_password('user', 'other'))
+        self.assertEqual(calls, ['user'] * 3)
+        self.assertTrue(all(password not in repr(self.mgr._verified._data)
+                            for password in ('passwd', 'other')))
+
+        # Password changes invalidate, even without notification.
+        self.store.set_password('user', 'new')
+        self.assertFalse(self.mgr.check_password('user', 'passwd'))
+        self.assertTrue(self.mgr.check_password('user', 'new'))
+        self.assertTrue(self.mgr.check_password('user', 'new'))
+        self.assertEqual(calls, ['user'] * 5)
+        self.mgr.user_password_reset('user', 'u@localhost', 'new')
+        self.assertTrue(self.mgr.check_password('user', 'new'))
+        self.assertEqual(calls, ['user'] * 6)
+        self.mgr.reset_verify_cache()
+        self.mgr.delete_user('user')
+        self.assertFalse(self.mgr.check_password('user', 'new'))
+
+        # Disabled by default.
+        self.env.config.set('account-manager', 'verify_cache_ttl', 0)
+        del calls[:]
+        self.store.set_password('user', 'passwd')
+        self.assertTrue(self.mgr.check_password('user', 'passwd'))
+        self.assertTrue(self.mgr.check_password('user', 'passwd'))
+        self.assertEqual(calls, ['user'] * 2)
+        del self.store.check_password
+
+    def test_verify_cache_other_process(self):
+        from acct_mgr.model import change_uid, delete_user
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+        self.env.config.set('account-manager', 'verify_cache_ttl', 60)
+        self.store.set_password('other', 'passwd')
+        self.assertTrue(self.mgr.check_password('user', 'passwd'))
+        self.assertTrue(self.mgr.check_password('other', 'passwd'))
+        # Deleting or renaming sessions directly, like other processes do,
+        # without notifying the local cache.
+        delete_user(self.env, 'user')
+        self.assertFalse(self.mgr.check_password('user', 'passwd'))
+        change_uid(self.env, 'other', 'renamed', [], True)
+        self.assertFalse(self.mgr.check_password('other', 'passwd'))
+
+    def test_set_passwords(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'HtDigestStore, SessionStore')
+        self.env.config.set('account-manager', 'htdigest_file', '.htdigest')
+        htdigest = HtDigestStore(self.env)
+        htdigest.set_password('admin', 'passwd')
+
+        results = self.mgr.set_passwords([('admin', 'new'), ('user', 'new'),
+                                          ('foo', 'new')])
+        self.assertEqual(results, {'admin': False, 'user': False,
+                                   'foo': True})
+        # New accounts are created in the primary store.
+        self.assertEqual(self.mgr.find_user_store('foo'), htdigest)
+        for user in ('admin', 'user', 'foo'):
+            self.assertTrue(self.mgr.check_password(user, 'new'))
+        # Existing accounts are skipped on request.
+        results = self.mgr.set_passwords([('user', 'other'), ('bar', 'new')],
+                                         overwrite=False)
+        self.assertEqual(results, {'user': False, 'bar': True})
+        self.assertTrue(self.mgr.check_password('user', 'new'))
+
+    def test_delete_users(self):
+        self.env.config.set('account-manager', 'password_store',
+                            'HtDigestStore, SessionStore')
+        self.env.config.set('account-manager', 'htdigest_file', '.htdigest')
+        htdigest = HtDigestStore(self.env)
+        htdigest.set_password('admin', 'passwd')
+        self.store.set_password('other', 'passwd')
+        self.mgr.set_user_attributes_bulk([('user', 'email', 'u@localhost'),
+                                           ('other', 'name', 'Other')])
+        self.perm.grant_permission('user', 'TRAC_ADMIN')
+
+        self.mgr.delete_users(['admin', 'user', 'unknown'])
+        self.assertEqual(list(self.mgr.get_users()), ['other'])
+        self.assertEqual(list(self.env.db_query("""
+            SELECT * FROM permission WHERE username='user'
+            """)), [])
+        self.assertEqual(list(self.env.db_query("""
+            SELECT sid,name FROM session_attribute
+            WHERE authenticated=1 ORDER BY sid,name
+            """)), [('other', 'name'), ('other', 'password')])
+
+    def test_set_user_attributes_bulk(self):
+        self.mgr.set_user_attributes_bulk([('user', 'approval', 'revoked'),
+                                           ('foo', 'approval', 'pending'),
+                                           ('foo', 'email', 'f@localhost')])
+        self.mgr.set_user_attributes_bulk([('user', 'approval', None),
+                                           ('foo', 'approval', 'revoked')])
+        self.assertEqual(sorted(self.env.db_query("""
+            SELECT sid,name,value FROM session_attribute
+            WHERE authenticated=1 AND name!='password'
+            """)), [('foo', 'approval', 'revoked'),
+                    ('foo', 'email', 'f@localhost')])
+
     def test_maybe_update_hash(self):
         # Configure another, primary password store.
         self.env.config.set('account-manager', 'password_store',
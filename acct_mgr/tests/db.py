@@ -9,11 +9,14 @@
 #
 # Author: Matthew Good <trac@matt-good.net>
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from trac.test import EnvironmentStub
 
-from acct_mgr.db import SessionStore
+from acct_mgr.db import SessionStore, SharedAuthCookies, SharedDatabaseHolder
 
 
 class _BaseTestCase(unittest.TestCase):
@@ -72,6 +75,32 @@ class _BaseTestCase(unittest.TestCase):
         self.assertFalse(self.store.has_user('foo'))
         self.assertFalse(self.store.delete_user('foo'))
 
+    def test_set_passwords(self):
+        self.store.set_password('foo', 'pass1')
+        self.assertEqual(self.store.set_passwords([('foo', 'pass2'),
+                                                   ('bar', 'pass2')],
+                                                  overwrite=False),
+                         {'foo': False, 'bar': True})
+        self.assertTrue(self.store.check_password('foo', 'pass1'))
+        self.assertEqual(self.store.set_passwords([('foo', 'pass3'),
+                                                   ('bar', 'pass3')]),
+                         {'foo': False, 'bar': False})
+        self.assertTrue(self.store.check_password('foo', 'pass3'))
+        self.assertTrue(self.store.check_password('bar', 'pass3'))
+
+    def test_delete_users(self):
+        self.store.set_password('foo', 'password')
+        self.store.set_password('bar', 'password')
+        self.assertEqual(self.store.delete_users(['foo', 'baz']), ['foo'])
+        self.assertFalse(self.store.has_user('foo'))
+        self.assertTrue(self.store.has_user('bar'))
+
+    def test_renew_generation(self):
+        generation = self.store.get_generation()
+        self.assertTrue(generation is self.store.get_generation())
+        SessionStore.renew_generation(self.env)
+        self.assertFalse(generation is self.store.get_generation())
+
     def test_unicode_username_and_password(self):
         username = u'\u4e60'
         password = u'\u4e61'
@@ -95,10 +124,82 @@ class HtPasswdTestCase(_BaseTestCase):
                             'HtPasswdHashMethod')
 
 
+class SharedAuthCookiesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.store = SharedAuthCookies(self.env, 'sqlite:db/shared.db')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def test_create(self):
+        self.assertTrue(os.path.isfile(os.path.join(self.env.path, 'db',
+                                                    'shared.db')))
+        # Reuse an existing database.
+        self.store.insert('123456', 'user', '127.0.0.1', 0)
+        store = SharedAuthCookies(self.env, 'sqlite:db/shared.db')
+        self.assertEqual(store.get_name('123456'), 'user')
+
+    def test_get_name(self):
+        self.assertEqual(self.store.get_name('123456'), None)
+        self.store.insert('123456', 'user', '127.0.0.1', 0)
+        self.assertEqual(self.store.get_name('123456'), 'user')
+        self.assertEqual(self.store.get_name('123456', '127.0.0.1'), 'user')
+        self.assertEqual(self.store.get_name('123456', '127.0.0.2'), None)
+        # Cookie values are unique.
+        self.store.insert('123456', 'other', '127.0.0.1', 0)
+        self.assertEqual(self.store.get_name('123456'), 'other')
+
+    def test_rotate(self):
+        self.store.insert('123456', 'user', '127.0.0.1', 0)
+        self.store.rotate('123456', '654321', 1)
+        self.assertEqual(self.store.get_name('123456'), None)
+        self.assertEqual(self.store.get_name('654321'), 'user')
+        self.store.refresh({'654321': 2})
+        self.assertEqual(self.store.get_name('654321'), 'user')
+
+    def test_delete(self):
+        self.store.insert('123456', 'user', '127.0.0.1', 0)
+        self.store.insert('234567', 'user', '127.0.0.1', 0)
+        self.store.insert('345678', 'other', '127.0.0.1', 0)
+        self.store.delete('123456')
+        self.assertEqual(self.store.get_name('123456'), None)
+        self.assertEqual(self.store.get_name('234567'), 'user')
+        self.store.delete_users(['user'])
+        self.assertEqual(self.store.get_name('234567'), None)
+        self.assertEqual(self.store.get_name('345678'), 'other')
+
+    def test_holder(self):
+        holder = SharedDatabaseHolder(self.env, SharedAuthCookies)
+        self.assertEqual(holder.get(''), None)
+        store = holder.get('sqlite:db/shared.db')
+        self.assertEqual(store.__class__, SharedAuthCookies)
+        self.assertTrue(holder.get('sqlite:db/shared.db') is store)
+        # The old database is closed, when the string changes.
+        closed = []
+        store._pool.shutdown = lambda: closed.append(True)
+        other = holder.get('sqlite:db/other.db')
+        self.assertFalse(other is store)
+        self.assertEqual([True], closed)
+
+    def test_holder_unavailable(self):
+        holder = SharedDatabaseHolder(self.env, SharedAuthCookies)
+        uri = 'nosuchdb:db/shared.db'
+        self.assertEqual(holder.get(uri), None)
+        # Retried only after a while.
+        holder.cls = lambda env, uri: self.store
+        self.assertEqual(holder.get(uri), None)
+        holder._failed -= holder.RETRY_DELAY
+        self.assertTrue(holder.get(uri) is self.store)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(HtDigestTestCase))
     suite.addTest(unittest.makeSuite(HtPasswdTestCase))
+    suite.addTest(unittest.makeSuite(SharedAuthCookiesTestCase))
     return suite
 
 
@@ -9,6 +9,7 @@
 # Author: Pedro Algarvio <ufs@ufsoft.org>
 
 import base64
+import time
 
 from trac.tests.notification import parse_smtp_message
 
@@ -295,6 +296,31 @@ class NoEmailVerificationForAnonymousUsers(FunctionalTestCaseSetup):
                    'address</a></span>')
 
 
+class QueuedNotificationIsDelivered(FunctionalTestCaseSetup):
+    def runTest(self):
+        """Send out queued notifications in the background"""
+        address_to_notify = 'admin@testenv%s.tld' % self._testenv.port
+        env = self._testenv.get_trac_environment()
+        env.config.set('account-manager', 'notification_queue', 'true')
+        env.config.save()
+        self._smtpd.full_reset()
+        try:
+            self._tester.register('queued')
+            for i in range(50):
+                message = self._smtpd.get_message(address_to_notify)
+                if message:
+                    break
+                time.sleep(0.1)
+            headers, body = parse_smtp_message(message)
+            self.assertEqual(headers['Subject'],
+                             '[%s] New user registration: %s' % (
+                                            'testenv%s' % self._testenv.port,
+                                            'queued'))
+        finally:
+            env.config.set('account-manager', 'notification_queue', 'false')
+            env.config.save()
+
+
 def test_suite():
     suite = FunctionalTestSuite()
     suite.addTest(TestFormLoginAdmin())
@@ -315,6 +341,7 @@ def test_suite():
     suite.addTest(UserNoLongerLogins())
     suite.addTest(UserIsAbleToRegisterWithSameUserName())
     suite.addTest(NoEmailVerificationForAnonymousUsers())
+    suite.addTest(QueuedNotificationIsDelivered())
     return suite
 
 
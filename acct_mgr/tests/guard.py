@@ -8,6 +8,7 @@
 #
 # Author: Steffen Hoffmann <hoff.st@web.de>
 
+import os
 import shutil
 import tempfile
 import unittest
@@ -18,7 +19,7 @@ from trac.test import EnvironmentStub, Mock
 from trac.util.datefmt import to_datetime, to_timestamp
 from trac.web.session import Session
 
-from acct_mgr.guard import AccountGuard
+from acct_mgr.guard import AccountGuard, LoginRateLimiter
 
 
 class AccountGuardTestCase(unittest.TestCase):
@@ -55,7 +56,8 @@ class AccountGuardTestCase(unittest.TestCase):
     def _mock_failed_attempt(self, requests=1):
         ipnr = '127.0.0.1'
         ts = to_timestamp(to_datetime(None))
-        attempts = eval(self.session.get('failed_logins', '[]'))
+        attempts = self.guard._parse_failed_log(
+                       self.session.get('failed_logins'))
         count = int(self.session.get('failed_logins_count', 0))
         lock_count = int(self.session.get('lock_count', 0))
         max_ = self.env.config.getint('account-manager',
@@ -66,7 +68,8 @@ class AccountGuardTestCase(unittest.TestCase):
             # Assume, that every lock is enforced.
             if not count < max_:
                 lock_count += 1
-        self.session['failed_logins'] = str(attempts)
+        self.session['failed_logins'] = \
+            self.guard._format_failed_log(attempts)
         self.session['failed_logins_count'] = count
         self.session['lock_count'] = lock_count
         self.session.save()
@@ -204,10 +207,139 @@ class AccountGuardTestCase(unittest.TestCase):
         self.env.config.set('account-manager', 'login_attempt_max_count', 0)
         self.assertEqual(self.guard.user_locked(user), None)
 
+    def test_user_lock_state(self):
+        self.env.config.set('account-manager', 'user_lock_time', 30)
+        user = self.user
+
+        def state():
+            attributes = dict((name, self.session.get(name))
+                              for name in self.guard.STATE_ATTRIBUTES
+                              if name in self.session)
+            return self.guard.user_lock_state(attributes)
+        self.assertEqual(state(), (False, 30, None))
+        # Time-locked account.
+        ts = self._mock_failed_attempt()
+        self.assertEqual(state(), (True, 30, ts + 30))
+        self.assertEqual(state()[0], self.guard.user_locked(user))
+        # Permanently locked account.
+        self.env.config.set('account-manager', 'user_lock_time', 0)
+        self.assertEqual(state(), (True, 0, 0))
+        self.assertEqual(state()[0], self.guard.user_locked(user))
+        # Result with locking disabled.
+        self.env.config.set('account-manager', 'login_attempt_max_count', 0)
+        self.assertEqual(state(), (None, 0, None))
+
+    def test_get_state(self):
+        self.assertEqual(self.guard.get_state(None), None)
+        self.assertEqual(self.guard.get_state('unknown'), None)
+        self.assertEqual(self.guard.get_state(self.user), {})
+        self.session['email'] = 'user@localhost'
+        self.session.save()
+        self.assertEqual(self.guard.get_state(self.user), {})
+
+        # State is kept current by methods changing it.
+        state = self.guard.get_state(self.user)
+        self.guard.failed_count(self.user, '127.0.0.1', state=state)
+        self.assertEqual(state['failed_logins_count'], 1)
+        self.assertEqual(self.guard.user_locked(self.user, state), True)
+        self.guard.lock_count(self.user, 'up', state)
+        self.assertEqual(
+            dict((name, unicode(value)) for name, value in state.items()),
+            self.guard.get_state(self.user))
+        self.assertEqual(self.guard.failed_count(self.user, reset=True,
+                                                 state=state), 1)
+        self.assertEqual(state, {})
+        self.assertEqual(self.guard.get_state(self.user), {})
+
+    def test_failed_log(self):
+        user = self.user
+        self.assertEqual(self.guard.get_failed_log(user), [])
+        self.guard.failed_count(user, '127.0.0.1')
+        self.guard.failed_count(user)
+        attempts = self.guard.get_failed_log(user)
+        self.assertEqual([attempt['ipnr'] for attempt in attempts],
+                         ['127.0.0.1', None])
+        self.assertEqual(self.guard._parse_failed_log(
+                             self.guard._format_failed_log(attempts)),
+                         attempts)
+
+        # Log format of previous versions.
+        self.assertEqual(self.guard._parse_failed_log(
+                             "[{'ipnr': None, 'time': 1}, "
+                             "{'ipnr': '127.0.0.1', 'time': 2}]"),
+                         [{'ipnr': None, 'time': 1},
+                          {'ipnr': '127.0.0.1', 'time': 2}])
+        # Never evaluate code.
+        self.assertEqual(self.guard._parse_failed_log(
+                             "[{'time': __import__('os').getpid()}]"), [])
+        self.assertEqual(self.guard._parse_failed_log('garbage'), [])
+
+
+class LoginRateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'acct_mgr.guard.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('account-manager', 'login_rate_ip_max', 3)
+        self.env.config.set('account-manager', 'login_rate_user_max', 2)
+        self.limiter = LoginRateLimiter(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def test_limited(self):
+        self.assertFalse(self.limiter.limited('127.0.0.1', 'user'))
+        self.limiter.add_failure('127.0.0.1', 'user')
+        self.limiter.add_failure('127.0.0.1', 'USER')
+        # Usernames are counted disregarding case.
+        self.assertTrue(self.limiter.limited('127.0.0.2', 'User'))
+        self.assertFalse(self.limiter.limited('127.0.0.1', 'other'))
+        self.limiter.add_failure('127.0.0.1', 'other')
+        self.assertTrue(self.limiter.limited('127.0.0.1', 'another'))
+        self.assertFalse(self.limiter.limited('127.0.0.2', None))
+
+        # Counting restarts, when a budget is changed.
+        self.env.config.set('account-manager', 'login_rate_ip_max', 5)
+        self.assertFalse(self.limiter.limited('127.0.0.1', 'another'))
+        self.env.config.set('account-manager', 'login_rate_ip_max', 0)
+        self.env.config.set('account-manager', 'login_rate_user_max', 0)
+        self.assertFalse(self.limiter.enabled)
+
+    def test_shared_attempts(self):
+        uri = 'sqlite:' + os.path.join(self.env.path, 'login_attempt.db')
+        self.env.config.set('account-manager', 'login_rate_db', uri)
+        env2 = EnvironmentStub(enable=['trac.*', 'acct_mgr.guard.*'])
+        try:
+            for option in ('login_rate_db', 'login_rate_ip_max',
+                           'login_rate_user_max'):
+                env2.config.set('account-manager', option,
+                                self.env.config.get('account-manager',
+                                                    option))
+            limiter2 = LoginRateLimiter(env2)
+            self.limiter.add_failure('127.0.0.1', 'user')
+            limiter2.add_failure('127.0.0.2', 'user')
+            self.assertTrue(self.limiter.limited('127.0.0.3', 'user'))
+            self.assertTrue(limiter2.limited('127.0.0.3', 'user'))
+            self.assertFalse(limiter2.limited('127.0.0.1', 'other'))
+            # Expired attempts are removed once per window.
+            shared = self.limiter.shared_attempts
+            deleted = []
+            prune = shared.prune
+            shared.prune = lambda expired: deleted.append(expired) or \
+                                           prune(expired)
+            self.limiter.add_failure('127.0.0.1', 'user')
+            self.assertEqual([], deleted)
+            self.limiter._pruned -= self.limiter.login_rate_window
+            self.limiter.add_failure('127.0.0.1', 'user')
+            self.assertEqual(1, len(deleted))
+        finally:
+            env2.shutdown()
+
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(AccountGuardTestCase))
+    suite.addTest(unittest.makeSuite(LoginRateLimiterTestCase))
     return suite
 
 
@@ -16,6 +16,7 @@ import unittest
 
 from trac.test import EnvironmentStub
 
+from acct_mgr import htfile
 from acct_mgr.htfile import HtDigestStore, HtPasswdStore
 
 
@@ -63,6 +64,73 @@ class _BaseTestCase(unittest.TestCase):
         self.assertTrue(self.store.set_password('user2', 'password',
                                                 overwrite=False))
 
+    def test_append(self):
+        self._init_password_file(self.flavor, 'test_append')
+        filename = self.store.filename
+        with open(filename, 'w') as f:
+            # Last line without newline.
+            f.write(self.store.userline('user1', 'password1'))
+        inode = os.stat(filename).st_ino
+        self.assertTrue(self.store.set_password('user2', 'password2'))
+        self.assertTrue(self.store.has_user('user2'))
+        # New users are appended in place.
+        self.assertEqual(os.stat(filename).st_ino, inode)
+        self.assertEqual(open(filename).read().count('\n'), 2)
+        self.assertEqual(self.store.get_users(), ['user1', 'user2'])
+        self.assertTrue(self.store.check_password('user1', 'password1'))
+        self.assertTrue(self.store.check_password('user2', 'password2'))
+
+    def test_replace(self):
+        self._init_password_file(self.flavor, 'test_replace')
+        filename = self.store.filename
+        self.store.set_password('user1', 'password1')
+        self.store.set_password('user2', 'password2')
+        os.chmod(filename, 0640)
+        inode = os.stat(filename).st_ino
+        self.assertFalse(self.store.set_password('user1', 'password3'))
+        # Changes are written to a new file, replacing the old one.
+        self.assertNotEqual(os.stat(filename).st_ino, inode)
+        self.assertTrue(self.store.delete_user('user2'))
+        self.assertFalse(self.store.delete_user('user2'))
+        self.assertEqual(os.stat(filename).st_mode & 0777, 0640)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(filename))),
+                         ['test_replace', 'trac-tempenv'])
+        self.assertEqual(self.store.get_users(), ['user1'])
+        self.assertTrue(self.store.check_password('user1', 'password3'))
+
+    def test_replace_symlink(self):
+        self._init_password_file(self.flavor, 'test_replace_symlink')
+        target = self.store.filename
+        link = os.path.join(self.basedir, 'link')
+        os.symlink(target, link)
+        self.env.config.set('account-manager', self.flavor + '_file', link)
+        self.store.set_password('user1', 'password1')
+        self.assertFalse(self.store.set_password('user1', 'password2'))
+        # The symlink is kept, and the target gets replaced.
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.stat(link).st_ino, os.stat(target).st_ino)
+        self.assertTrue(self.store.check_password('user1', 'password2'))
+
+    def test_replace_in_place(self):
+        self._init_password_file(self.flavor, 'test_replace_in_place')
+        filename = self.store.filename
+        self.store.set_password('user1', 'password1')
+        self.store.set_password('user2', 'password2')
+        inode = os.stat(filename).st_ino
+
+        def mkstemp(*args, **kwargs):
+            raise OSError(13, 'Permission denied')
+        htfile.tempfile.mkstemp, orig_mkstemp = mkstemp, tempfile.mkstemp
+        try:
+            self.assertFalse(self.store.set_password('user1', 'password3'))
+            self.assertTrue(self.store.delete_user('user2'))
+        finally:
+            htfile.tempfile.mkstemp = orig_mkstemp
+        # Without a temporary file, the file is rewritten in place.
+        self.assertEqual(os.stat(filename).st_ino, inode)
+        self.assertEqual(self.store.get_users(), ['user1'])
+        self.assertTrue(self.store.check_password('user1', 'password3'))
+
     def test_unicode(self):
         self.env.config.set('account-manager', 'htdigest_realm',
                             u'UnicodeRealm\u4e60')
@@ -104,6 +172,20 @@ class HtDigestTestCase(_BaseTestCase):
         self.store.set_password('foo', 'pass3', 'pass2')
         self.assertTrue(self.store.check_password('foo', 'pass3'))
 
+    def test_realm(self):
+        self._init_password_file(
+            self.flavor, 'test_realm',
+            'user:TestRealm:752b304cc7cf011d69ee9b79e2cd0866\n'
+            'other:OtherRealm:0e15a0c3c7a6da10a66eb4fd1c7e2ce6\n')
+        self.assertEqual(self.store.get_users(), ['user'])
+        self.assertTrue(self.store.has_user('user'))
+        self.assertFalse(self.store.has_user('other'))
+        self.assertEqual(self.store.check_password('other', 'password'),
+                         None)
+        self.env.config.set('account-manager', 'htdigest_realm',
+                            'OtherRealm')
+        self.assertEqual(self.store.get_users(), ['other'])
+
 
 class HtPasswdTestCase(_BaseTestCase):
     flavor = 'htpasswd'
@@ -166,6 +248,34 @@ class HtPasswdTestCase(_BaseTestCase):
         self.store.set_password('foo', 'pass3', 'pass2')
         self.assertTrue(self.store.check_password('foo', 'pass3'))
 
+    def test_external_change(self):
+        self._init_password_file(self.flavor, 'test_external_change',
+                                 'user:{SHA}W6ph5Mm5Pz8GgiULbPgzG37mj9g=\n')
+        self.assertTrue(self.store.check_password('user', 'password'))
+        self.assertEqual(self.store.check_password('other', 'password'),
+                         None)
+        # Replacement by other programs is detected, i.e. by rename.
+        filename = self._create_file(
+            'test_external_change.new',
+            content='other:{SHA}W6ph5Mm5Pz8GgiULbPgzG37mj9g=\n')
+        os.rename(filename, self.store.filename)
+        self.assertEqual(self.store.check_password('user', 'password'),
+                         None)
+        self.assertTrue(self.store.check_password('other', 'password'))
+        self.assertEqual(self.store.get_users(), ['other'])
+
+    def test_hash_workers(self):
+        self.env.config.set('account-manager', 'hash_workers', 2)
+        self._do_password_test(self.flavor, 'test_hash_workers',
+                               'user:$apr1$xW/09...$fb150dT95SoL1HwXtHS/I0\n')
+        self.env.config.set('account-manager', 'htpasswd_hash_type', 'md5')
+        self.store.set_password('user', 'password')
+        self.assertTrue(self.store.check_password('user', 'password'))
+        self.assertFalse(self.store.check_password('user', 'other'))
+        # Hashes are computed inline, if no worker is available in time.
+        self.env.config.set('account-manager', 'hash_queue_size', 0)
+        self.assertTrue(self.store.check_password('user', 'password'))
+
     def test_create_hash(self):
         self._init_password_file(self.flavor, 'test_hash')
         self.env.config.set('account-manager', 'htpasswd_hash_type', 'bad')
@@ -17,8 +17,10 @@ from Cookie import SimpleCookie as Cookie
 from trac.test import EnvironmentStub, Mock
 from trac.web.session import Session
 
+from acct_mgr import model
 from acct_mgr.model import get_user_attribute, set_user_attribute, \
-                           last_seen, user_known
+                           set_user_attributes, last_seen, \
+                           user_attribute, user_known
 
 
 class ModelTestCase(unittest.TestCase):
@@ -103,6 +105,43 @@ class ModelTestCase(unittest.TestCase):
         self.assertEqual(no_constraints['another'].get(0), None)
         self.assertTrue(no_constraints['another'][1]['attribute2'], 'value3')
 
+    def test_get_user_attribute_ids(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO session_attribute (sid,authenticated,name,value)
+                VALUES (%s,%s,%s,%s)
+                """, [('user', 0, 'attribute1', 'value1'),
+                      ('user', 1, 'attribute1', 'value1'),
+                      ('user', 1, 'attribute2', 'value2')])
+
+        self.assertEqual(get_user_attribute(self.env, 'user', None),
+                         {'user': {0: {'attribute1': 'value1'},
+                                   1: {'attribute1': 'value1',
+                                       'attribute2': 'value2'}}})
+        self.assertEqual(get_user_attribute(self.env, 'user', 0, 'attribute1',
+                                            'value1'), [1])
+        attrs = get_user_attribute(self.env, 'user', None, ids=True)['user']
+        # IDs are unique per authentication state and attribute.
+        ids = attrs['id'].values() + attrs[0]['id'].values() + \
+              attrs[1]['id'].values()
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(sorted(attrs[1]['id']), ['attribute1', 'attribute2'])
+        # IDs don't depend on the query.
+        self.assertEqual(get_user_attribute(self.env, authenticated=1,
+                                            attribute='attribute2',
+                                            ids=True)['user'][1]['id'],
+                         {'attribute2': attrs[1]['id']['attribute2']})
+
+    def test_user_attribute(self):
+        self.assertEqual(user_attribute(self.env, 'user', 'attribute1'), None)
+        self.assertEqual(user_attribute(self.env, 'user', 'attribute1', 1,
+                                        'default'), 'default')
+        set_user_attribute(self.env, 'user', 'attribute1', 'value1')
+        self.assertEqual(user_attribute(self.env, 'user', 'attribute1'),
+                         'value1')
+        self.assertEqual(user_attribute(self.env, 'user', 'attribute1', 0),
+                         None)
+
     def test_set_user_attribute(self):
         set_user_attribute(self.env, 'user', 'attribute1', 'value1')
 
@@ -129,6 +168,48 @@ class ModelTestCase(unittest.TestCase):
                     """):
                 self.assertEqual(('attribute1', '0'), (name, value))
 
+    def test_set_user_attributes(self):
+        def attributes():
+            return sorted(self.env.db_query("""
+                SELECT sid,name,value FROM session_attribute
+                WHERE authenticated=1
+                """))
+
+        set_user_attribute(self.env, 'user', 'attribute1', 'value1')
+        set_user_attributes(self.env, [('user', 'attribute1', 'value2'),
+                                       ('user', 'attribute2', 'value2'),
+                                       ('other', 'attribute1', 'value1')])
+        self.assertEqual([('other', 'attribute1', 'value1'),
+                          ('user', 'attribute1', 'value2'),
+                          ('user', 'attribute2', 'value2')], attributes())
+        set_user_attributes(self.env, [('user', 'attribute1', None),
+                                       ('user', 'attribute2', 'value3')])
+        self.assertEqual([('other', 'attribute1', 'value1'),
+                          ('user', 'attribute2', 'value3')], attributes())
+
+    def test_set_user_attributes_generic(self):
+        # Fallback for db backends without an upsert statement.
+        upsert_sql = model._UPSERT_SQL
+        model._UPSERT_SQL = {}
+        try:
+            self.test_set_user_attribute()
+            self.test_set_user_attributes()
+        finally:
+            model._UPSERT_SQL = upsert_sql
+
+    def test_set_user_attribute_known_users(self):
+        invalidated = []
+        self.env.invalidate_known_users_cache = lambda: invalidated.append(1)
+        # Only attributes listed by env.get_known_users() matter.
+        set_user_attribute(self.env, 'user', 'failed_logins_count', 1)
+        set_user_attributes(self.env, [('user', 'failed_logins', '[]'),
+                                       ('user', 'lock_count', 1)])
+        self.assertEqual([], invalidated)
+        set_user_attribute(self.env, 'user', 'email', 'user@example.org')
+        set_user_attributes(self.env, [('user', 'name', 'User'),
+                                       ('user', 'email', None)])
+        self.assertEqual([1, 1], invalidated)
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Pedro Algarvio <ufs@ufsoft.org>
+# Copyright (C) 2013-2015 Steffen Hoffmann <hoff.st@web.de>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Pedro Algarvio <ufs@ufsoft.org>
+
+import gc
+import shutil
+import tempfile
+import unittest
+
+from trac.core import Component, implements
+from trac.notification import IEmailSender
+from trac.test import EnvironmentStub
+
+from acct_mgr.api import AccountManager
+from acct_mgr.notification import NotificationQueue, \
+                                  PasswordResetNotification
+
+
+class RecordingEmailSender(Component):
+    """Email sender keeping messages instead of sending them."""
+
+    implements(IEmailSender)
+
+    def __init__(self):
+        self.messages = []
+        self.fail = False
+        self.fail_recipients = set()
+        self.public_cc = []
+
+    def send(self, from_addr, recipients, message):
+        if self.fail or self.fail_recipients.intersection(recipients):
+            raise IOError("Connection refused")
+        self.public_cc.append(self.config.getbool('notification',
+                                                  'use_public_cc'))
+        self.messages.append((recipients, message))
+
+
+class _BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'acct_mgr.api.*',
+                                           'acct_mgr.notification.*',
+                                           RecordingEmailSender])
+        self.env.path = tempfile.mkdtemp()
+        config = self.env.config
+        config.set('account-manager', 'notification_queue', True)
+        config.set('account-manager', 'notification_retries', 2)
+        config.set('account-manager', 'notify_actions', 'new')
+        config.set('account-manager', 'account_changes_notify_addresses',
+                   'admin@example.org')
+        config.set('notification', 'smtp_enabled', True)
+        config.set('notification', 'email_sender', 'RecordingEmailSender')
+        self.sender = RecordingEmailSender(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+
+class SingleUserNotificationTestCase(_BaseTestCase):
+    def test_recipient(self):
+        self.env.known_users = [('user', None, 'user@example.org')]
+        PasswordResetNotification(self.env).notify('user', 'secret')
+        recipients, message = self.sender.messages[0]
+        self.assertEqual(['user@example.org'], recipients)
+        self.assertTrue('\nTo: user@example.org\n' in message)
+        # The shared configuration is left alone, even while sending.
+        self.assertEqual([False], self.sender.public_cc)
+        self.assertFalse(self.env.config.getbool('notification',
+                                                 'use_public_cc'))
+
+    def test_public_cc(self):
+        self.env.known_users = [('user', None, 'user@example.org')]
+        self.env.config.set('notification', 'use_public_cc', True)
+        PasswordResetNotification(self.env).notify('user', 'secret')
+        recipients, message = self.sender.messages[0]
+        self.assertEqual(1, message.count('\nTo: '))
+
+
+class NotificationQueueTestCase(_BaseTestCase):
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.queue = NotificationQueue(self.env)
+        # Deliver from the test thread only.
+        self.queue._start_worker = lambda: None
+
+    def test_enqueue(self):
+        AccountManager(self.env)._notify('created', 'user', 'secret')
+        # Nothing is sent within the request.
+        self.assertEqual([], self.sender.messages)
+        self.assertEqual(1, self.queue.process())
+        self.assertEqual(1, len(self.sender.messages))
+        recipients, message = self.sender.messages[0]
+        self.assertEqual(['admin@example.org'], recipients)
+        self.assertTrue('New user registration: user' in message)
+        self.assertEqual(0, self.queue.process())
+
+    def test_workers(self):
+        acctmgr = AccountManager(self.env)
+        self.env.known_users = [('user%d' % i, None, 'user%d@example.org' % i)
+                                for i in range(10)]
+        for i in range(10):
+            acctmgr._notify('created', 'user%d' % i, 'secret')
+            acctmgr._notify('password_reset', 'user%d' % i,
+                            'user%d@example.org' % i, 'secret')
+        self.assertEqual(20, self.queue.process())
+        self.assertEqual(sorted(['admin@example.org'] * 10 +
+                                ['user%d@example.org' % i
+                                 for i in range(10)]),
+                         sorted(recipients[0] for recipients, message
+                                in self.sender.messages))
+
+    def test_chunks(self):
+        self.env.config.set('account-manager', 'notification_workers', 1)
+        self.queue.CHUNK = 2
+        acctmgr = AccountManager(self.env)
+        for i in range(5):
+            acctmgr._notify('created', 'user%d' % i, 'secret')
+        now = self.queue._next_attempt()
+        claimed = []
+        send = self.sender.send
+
+        def counting_send(*args):
+            claimed.append(self.env.db_query("""
+                SELECT COUNT(*) FROM acctmgr_notification
+                WHERE next_attempt>%s
+                """, (now,))[0][0])
+            send(*args)
+        self.sender.send = counting_send
+        self.assertEqual(5, self.queue.process(now))
+        # Only the current chunk is claimed while sending.
+        self.assertEqual([2, 2, 2, 2, 1], claimed)
+
+    def test_password_resets(self):
+        self.env.known_users = [('user1', None, 'user1@example.org'),
+                                ('user2', None, 'user2@example.org')]
+        errors = AccountManager(self.env)._notify_password_resets(
+            [('user1', 'user1@example.org', 'secret'),
+             ('user2', 'other@example.org', 'secret')])
+        self.assertEqual(['user2'], errors.keys())
+        self.assertEqual([], self.sender.messages)
+        self.assertEqual(1, self.queue.process())
+        self.assertEqual(['user1@example.org'], self.sender.messages[0][0])
+
+    def test_shutdown(self):
+        del self.queue._start_worker
+        AccountManager(self.env)._notify('created', 'user', 'secret')
+        worker = self.queue._worker
+        self.assertTrue(worker.is_alive())
+        self.queue.shutdown()
+        self.assertFalse(worker.is_alive())
+        # Sent by the thread, or still queued.
+        self.assertEqual(1, len(self.sender.messages) + self.queue.process())
+
+    def test_worker_ends_with_env(self):
+        env = EnvironmentStub(enable=['trac.*', 'acct_mgr.notification.*'])
+        queue = NotificationQueue(env)
+        queue._start_worker()
+        worker = queue._worker
+        self.assertTrue(worker.is_alive())
+        del queue
+        env.shutdown()
+        del env
+        # The thread may still be delivering, and so holding the queue.
+        for i in range(50):
+            gc.collect()
+            worker.join(0.1)
+            if not worker.is_alive():
+                break
+        self.assertFalse(worker.is_alive())
+
+    def test_start_on_request(self):
+        started = []
+        self.queue._start_worker = lambda: started.append(True)
+        handler = object()
+        self.assertEqual(handler, self.queue.pre_process_request(None,
+                                                                 handler))
+        self.assertEqual([True], started)
+        # Not without the queue enabled.
+        del started[:]
+        self.env.config.set('account-manager', 'notification_queue', False)
+        self.queue.pre_process_request(None, handler)
+        self.assertEqual([], started)
+
+    def test_stop_between_chunks(self):
+        self.env.config.set('account-manager', 'notification_workers', 1)
+        self.queue.CHUNK = 1
+        acctmgr = AccountManager(self.env)
+        for i in range(3):
+            acctmgr._notify('created', 'user%d' % i, 'secret')
+        send = self.sender.send
+
+        def stopping_send(*args):
+            send(*args)
+            self.queue._stop.set()
+        self.sender.send = stopping_send
+        self.assertEqual(1, self.queue._process(stop=self.queue._stop))
+        # The rest is left for later.
+        self.sender.send = send
+        self.assertEqual(2, self.queue.process())
+
+    def test_corrupt_message(self):
+        acctmgr = AccountManager(self.env)
+        acctmgr._notify('created', 'user1', 'secret')
+        acctmgr._notify('created', 'user2', 'secret')
+        self.env.db_transaction("""
+            UPDATE acctmgr_notification SET args='[' WHERE id=1
+            """)
+        now = self.queue._next_attempt()
+        self.assertEqual(1, self.queue.process(now))
+        self.assertEqual(1, len(self.sender.messages))
+        self.assertEqual(0, self.queue.process(now + 60))
+        dead = self.queue.get_dead_letters()
+        self.assertEqual([(1, None, 2)], [(id, args, attempts) for
+                                          id, notifier, args, attempts, error
+                                          in dead])
+
+    def test_retry(self):
+        AccountManager(self.env)._notify('created', 'user', 'secret')
+        self.sender.fail = True
+        now = self.queue._next_attempt()
+        self.assertEqual(0, self.queue.process(now))
+        # Retried after a delay.
+        self.assertEqual(0, self.queue.process(now + 1))
+        self.assertEqual(now + 60, self.queue._next_attempt())
+        self.sender.fail = False
+        self.assertEqual(1, self.queue.process(now + 60))
+        self.assertEqual(1, len(self.sender.messages))
+
+    def test_dead_letter(self):
+        AccountManager(self.env)._notify('created', 'user', 'secret')
+        self.sender.fail = True
+        now = self.queue._next_attempt()
+        self.queue.process(now)
+        self.queue.process(now + 60)
+        self.assertEqual(None, self.queue._next_attempt())
+        dead = self.queue.get_dead_letters()
+        self.assertEqual(1, len(dead))
+        id, notifier, args, attempts, error = dead[0]
+        self.assertEqual('AccountChangeNotification', notifier)
+        self.assertEqual(('user', 'New user registration'), args)
+        self.assertEqual(2, attempts)
+        self.assertTrue('Connection refused' in error)
+
+        self.sender.fail = False
+        self.queue.requeue([id])
+        self.assertEqual([], self.queue.get_dead_letters())
+        self.assertEqual(1, self.queue.process())
+        self.assertEqual(1, len(self.sender.messages))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SingleUserNotificationTestCase))
+    suite.addTest(unittest.makeSuite(NotificationQueueTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Matthew Good <trac@matt-good.net>
+# Copyright (C) 2011 Steffen Hoffmann <hoff.st@web.de>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Matthew Good <trac@matt-good.net>
+
+import time
+import unittest
+
+from trac.core import TracError
+from trac.test import EnvironmentStub
+
+from acct_mgr import pwhash
+from acct_mgr.md5crypt import md5crypt
+
+MD5CRYPT_HASHES = (
+    (' ', '$1$yiiZbNIH$YiCsHZjcTkYd31wkgW8JF.'),
+    ('pass', '$1$YeNsbWdH$wvOF8JdqsoiLix754LTW90'),
+    ('____fifteen____', '$1$s9lUWACI$Kk1jtIVVdmT01p0z3b/hw1'),
+    ('____sixteen_____', '$1$dL3xbVZI$kkgqhCanLdxODGq14g/tW1'),
+    ('____seventeen____', '$1$NaH5na7J$j7y8Iss0hcRbu3kzoJs5V.'),
+    ('__________thirty-three___________',
+     '$1$HO7Q6vzJ$yGwp2wbL5D7eOVzOmxpsy.'),
+    ('apache', '$apr1$J.w5a/..$IW9y6DR0oO/ADuhlMF5/X1'),
+    ('password', '$apr1$xW/09...$fb150dT95SoL1HwXtHS/I0'),
+)
+
+
+class Md5CryptTestCase(unittest.TestCase):
+    def test_md5crypt(self):
+        for password, hash in MD5CRYPT_HASHES:
+            magic, salt = hash[1:].split('$')[:2]
+            self.assertEqual(md5crypt(password, salt, '$%s$' % magic), hash)
+        self.assertEqual(md5crypt('', 'salt'),
+                         '$1$salt$UsdFqFVB.FsuinRDK5eE..')
+        self.assertEqual(md5crypt('pass', u'YeNsbWdH'),
+                         '$1$YeNsbWdH$wvOF8JdqsoiLix754LTW90')
+
+    def test_htpasswd(self):
+        # Whatever backend has been selected.
+        for password, hash in MD5CRYPT_HASHES:
+            self.assertEqual(pwhash.htpasswd(password, hash), hash)
+        self.assertNotEqual(pwhash.htpasswd('other', hash), hash)
+
+    def test_select_md5crypt(self):
+        self.assertEqual(pwhash._select_md5crypt('$1$', 'pass', 'invalid'),
+                         md5crypt)
+        if pwhash.crypt is not None:
+            self.assertEqual(pwhash._select_md5crypt(
+                                 '$1$', 'pass',
+                                 '$1$YeNsbWdH$wvOF8JdqsoiLix754LTW90'),
+                             pwhash._crypt_md5crypt)
+
+
+class PasswordHashExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['acct_mgr.pwhash.*'])
+        self.env.config.set('account-manager', 'hash_workers', 1)
+        self.executor = pwhash.PasswordHashExecutor(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+
+    def test_htpasswd(self):
+        password, hash = MD5CRYPT_HASHES[1]
+        self.assertEqual(hash, self.executor.htpasswd(password, hash))
+        self.assertEqual(0, self.executor._pending)
+
+    def test_timeout(self):
+        self.env.config.set('account-manager', 'hash_timeout', 0)
+        # Slow enough to miss even a timeout of zero.
+        hash = pwhash.mksalt('sha512').replace('$6$', '$6$rounds=500000$')
+        self.assertEqual(None, self.executor.htpasswd('pass', hash))
+        self.assertRaises(TracError, self.executor.mkhtpasswd, 'pass',
+                          'sha512')
+        # Still pending in the worker, instead of computed twice.
+        self.assertTrue(self.executor._pending > 0)
+        for i in range(500):
+            if not self.executor._pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, self.executor._pending)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(Md5CryptTestCase))
+    suite.addTest(unittest.makeSuite(PasswordHashExecutorTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -14,6 +14,7 @@ import tempfile
 import unittest
 from Cookie import SimpleCookie as Cookie
 
+from trac.config import ConfigurationError
 from trac.perm import PermissionCache, PermissionSystem
 from trac.util.html import Markup
 from trac.test import EnvironmentStub, Mock, MockPerm
@@ -282,6 +283,23 @@ class RegExpCheckTestCase(_BaseTestCase):
                             r'(?i)^[A-Z.\-\'_]{4,}$')
         self.assertEqual(check.validate_registration(req), None)
 
+    def test_invalid_pattern(self):
+        self.env.config.set('account-manager', 'verify_email', False)
+        check = RegExpCheck(self.env)
+        self.req.args['username'] = 'username'
+        self.assertEqual(check.pattern_errors(), [])
+        pattern = check.get_pattern('username_regexp')
+        # Compiled once per option value.
+        self.assertTrue(check.get_pattern('username_regexp') is pattern)
+        self.env.config.set('account-manager', 'username_regexp', '(?i)^[A-')
+        self.assertRaises(ConfigurationError, check.validate_registration,
+                          self.req)
+        self.assertEqual([option for option, error in check.pattern_errors()],
+                         ['username_regexp'])
+        self.env.config.set('account-manager', 'username_regexp', '')
+        self.assertEqual(check.get_pattern('username_regexp'), None)
+        self.assertEqual(check.validate_registration(self.req), None)
+
 
 class UsernamePermCheckTestCase(_BaseTestCase):
     def test_check(self):
@@ -304,6 +322,22 @@ class UsernamePermCheckTestCase(_BaseTestCase):
         req = Mock(authname='admin', args=self.req.args)
         self.assertEqual(check.validate_registration(req), None)
 
+    def test_permission_subjects(self):
+        check = UsernamePermCheck(self.env)
+        perm = self.perm
+        subjects = check.get_permission_subjects()
+        self.assertTrue('admin' in subjects)
+        self.assertTrue(check.get_permission_subjects() is subjects)
+        # Permission changes are picked up.
+        perm.grant_permission('Group1', 'ACCTMGR_USER_ADMIN')
+        self.assertTrue('group1' in check.get_permission_subjects())
+        self.req.args['username'] = 'GROUP1'
+        self.assertRaises(RegistrationError, check.validate_registration,
+                          self.req)
+        perm.revoke_permission('Group1', 'ACCTMGR_USER_ADMIN')
+        self.assertFalse('group1' in check.get_permission_subjects())
+        self.assertEqual(check.validate_registration(self.req), None)
+
 
 class RegistrationModuleTestCase(_BaseTestCase):
     def setUp(self):
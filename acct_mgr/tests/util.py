@@ -9,8 +9,10 @@
 # Author: Steffen Hoffmann <hoff.st@web.de>
 
 import unittest
+from collections import deque
 from datetime import datetime
 
+from acct_mgr.util import LRUCache, SlidingWindowCounter, parallel_map
 from acct_mgr.util import pretty_precise_timedelta
 
 
@@ -44,6 +46,74 @@ class UtilTestCase(unittest.TestCase):
         self.assertEqual(pretty_precise_timedelta(None, diff=86401),
                          '1 day 1 second')
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # Least recently used entry gets evicted first.
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        # Expired entries are never returned.
+        cache = LRUCache(2, ttl=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a', 0), 0)
+
+
+    def test_sliding_window_counter(self):
+        counter = SlidingWindowCounter(10, 3)
+        self.assertEqual(counter.count('a', 100), 0)
+        for t in (100, 101, 102, 103):
+            counter.add('a', t)
+        # Only the most recent events up to the limit are kept.
+        self.assertEqual(counter.count('a', 104), 3)
+        self.assertEqual(counter.count('b', 104), 0)
+        self.assertEqual(counter.count('a', 111.5), 2)
+        self.assertEqual(counter.count('a', 113), 0)
+
+        # Keys without recent events are dropped first.
+        counter = SlidingWindowCounter(10, 3, maxkeys=4)
+        for i in xrange(4):
+            counter.add(i, 100 + i)
+        counter.add('new', 112)
+        self.assertEqual(sorted(counter._events), [3, 'new'])
+        self.assertEqual(counter.count(3, 112), 1)
+
+        # Keys added while sweeping aren't lost.
+        class Events(dict):
+            def items(self):
+                items = dict.items(self)
+                self['concurrent'] = deque([112])
+                return items
+        counter._events = Events(counter._events)
+        counter.add('a', 112)
+        counter.add('b', 112)
+        counter.add('c', 113)
+        self.assertTrue('concurrent' in counter._events)
+        self.assertEqual(counter.count('concurrent', 113), 1)
+
+    def test_parallel_map(self):
+        self.assertEqual(parallel_map(lambda x: x * 2, range(10), 4),
+                         range(0, 20, 2))
+        self.assertEqual(parallel_map(lambda x: x * 2, [1], 4), [2])
+        self.assertEqual(parallel_map(lambda x: x * 2, [], 4), [])
+        done = []
+
+        def fail(x):
+            done.append(x)
+            if x == 3:
+                raise ValueError(x)
+        self.assertRaises(ValueError, parallel_map, fail, range(10), 4)
+        # Other items are processed anyway.
+        self.assertEqual(sorted(done), range(10))
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 Matthew Good <trac@matt-good.net>
+# Copyright (C) 2010-2014 Steffen Hoffmann <hoff.st@web.de>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Matthew Good <trac@matt-good.net>
+
+import gc
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import weakref
+from Cookie import SimpleCookie as Cookie
+
+from trac.env import Environment
+from trac.test import EnvironmentStub, Mock
+
+from acct_mgr.model import del_user_attribute, delete_user, \
+                           set_user_attribute, user_attribute
+from acct_mgr.notification import NotificationError, NotificationQueue
+from acct_mgr.tests.notification import RecordingEmailSender
+from acct_mgr import web_ui
+from acct_mgr.web_ui import AccountModule, LoginModule
+
+
+class _BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'acct_mgr.api.*',
+                                           'acct_mgr.db.SessionStore',
+                                           'acct_mgr.pwhash.*',
+                                           'acct_mgr.web_ui.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('account-manager', 'password_store',
+                            'SessionStore')
+
+    def tearDown(self):
+        # Really close db connections.
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+
+class ApiKeyTestCase(_BaseTestCase):
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.acctmod = AccountModule(self.env)
+        self.req = Mock(authname='anonymous', args={}, environ={})
+
+    def test_refresh_apikey(self):
+        self.assertEqual(self.acctmod._get_apikey_user('unknown'), None)
+        self.acctmod._refresh_apikey(self.req, 'user')
+        apikey = self.acctmod._get_user_apikey('user')
+        self.assertEqual(len(apikey), self.acctmod.apikey_length)
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), 'user')
+
+        # The old key is void after a refresh.
+        self.acctmod._refresh_apikey(self.req, 'user')
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), None)
+        apikey = self.acctmod._get_user_apikey('user')
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), 'user')
+
+    def test_stale_apikey(self):
+        self.acctmod._refresh_apikey(self.req, 'user')
+        apikey = self.acctmod._get_user_apikey('user')
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), 'user')
+        # Attribute changes bypassing the cache invalidation must not
+        # authenticate anyone with the previous key.
+        del_user_attribute(self.env, 'user', attribute='apikey')
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), None)
+        set_user_attribute(self.env, 'user', 'apikey', 'other')
+        self.assertEqual(self.acctmod._get_apikey_user(apikey), None)
+
+    def test_remote_user_by_apikey(self):
+        login = LoginModule(self.env)
+        self.acctmod._refresh_apikey(self.req, 'user')
+        apikey = self.acctmod._get_user_apikey('user')
+        self.req.environ['HTTP_X_TRAC_API_KEY'] = apikey
+        self.assertEqual(login._remote_user(self.req), 'user')
+        self.req.environ['HTTP_X_TRAC_API_KEY'] = apikey[:-1]
+        self.assertEqual(login._remote_user(self.req), None)
+
+
+class ResetPasswordsTestCase(_BaseTestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'acct_mgr.api.*',
+                                           'acct_mgr.db.SessionStore',
+                                           'acct_mgr.notification.*',
+                                           'acct_mgr.pwhash.*',
+                                           'acct_mgr.web_ui.*',
+                                           RecordingEmailSender])
+        self.env.path = tempfile.mkdtemp()
+        config = self.env.config
+        config.set('account-manager', 'password_store', 'SessionStore')
+        config.set('account-manager', 'force_passwd_change', True)
+        config.set('notification', 'smtp_enabled', True)
+        config.set('notification', 'email_sender', 'RecordingEmailSender')
+        self.env.known_users = [('user%d' % i, None, 'user%d@example.org' % i)
+                                for i in range(1, 4)]
+        self.sender = RecordingEmailSender(self.env)
+        self.acctmod = AccountModule(self.env)
+        self.req = Mock(path_info='/admin/accounts/users',
+                        chrome={'notices': [], 'warnings': []})
+
+    def test_reset_passwords(self):
+        self.sender.fail_recipients.add('user2@example.org')
+        errors = self.acctmod._reset_passwords(
+            self.req, [('user1', 'user1@example.org'),
+                       ('user2', 'user2@example.org'),
+                       ('user3', 'other@example.org')])
+        self.assertEqual(['user2', 'user3'], sorted(errors))
+        self.assertTrue(isinstance(errors['user2'], NotificationError))
+        self.assertFalse(isinstance(errors['user3'], NotificationError))
+        self.assertEqual(2, len(self.req.chrome['warnings']))
+        self.assertEqual([['user1@example.org']],
+                         [recipients for recipients, message
+                          in self.sender.messages])
+        # Passwords are reset regardless of notification errors.
+        for user in ('user1', 'user2', 'user3'):
+            self.assertTrue(self.acctmod.store.has_user(user))
+        self.assertEqual('1', user_attribute(self.env, 'user1',
+                                             'force_change_passwd'))
+        self.assertEqual('1', user_attribute(self.env, 'user2',
+                                             'force_change_passwd'))
+        self.assertEqual(None, user_attribute(self.env, 'user3',
+                                              'force_change_passwd'))
+
+
+    def test_listener_error(self):
+        self.env.config.set('account-manager', 'notification_queue', True)
+        queue = NotificationQueue(self.env)
+
+        def enqueue_all(messages):
+            raise IOError("Database is locked")
+        queue.enqueue_all = enqueue_all
+        errors = self.acctmod._reset_passwords(
+            self.req, [('user1', 'user1@example.org'),
+                       ('user2', 'user2@example.org')])
+        # Reported for every user, instead of escaping.
+        self.assertEqual(['user1', 'user2'], sorted(errors))
+        self.assertTrue(isinstance(errors['user1'], IOError))
+        self.assertEqual(2, len(self.req.chrome['warnings']))
+
+class AuthCookieTestCase(_BaseTestCase):
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.login = LoginModule(self.env)
+        self.env.db_transaction("""
+            INSERT INTO auth_cookie (cookie,name,ipnr,time)
+            VALUES ('123456','user','127.0.0.1',0)
+            """)
+
+    def _make_req(self, value='123456'):
+        incookie = Cookie()
+        incookie['trac_auth'] = value
+        return Mock(authname='user', base_path='/', method='POST',
+                    incookie=incookie, outcookie=Cookie(),
+                    remote_addr='127.0.0.1')
+
+    def _name_for_cookie(self, value='123456'):
+        req = self._make_req(value)
+        return self.login._get_name_for_cookie(req, req.incookie['trac_auth'])
+
+    def test_cached_name(self):
+        self.assertEqual(self._name_for_cookie(), 'user')
+        self.assertEqual(self._name_for_cookie('654321'), None)
+        self.env.db_transaction("UPDATE auth_cookie SET name='other'")
+        # Served from cache.
+        self.assertEqual(self._name_for_cookie(), 'user')
+        self.login.revoke_cookie_cache()
+        self.assertEqual(self._name_for_cookie(), 'other')
+
+    def test_delete_user(self):
+        self.assertEqual(self._name_for_cookie(), 'user')
+        delete_user(self.env, 'user')
+        self.assertEqual(self._name_for_cookie(), None)
+
+    def test_logout(self):
+        self.assertEqual(self._name_for_cookie(), 'user')
+        self.login._do_logout(self._make_req())
+        self.assertEqual(self._name_for_cookie(), None)
+
+    def test_shared_unavailable(self):
+        self.env.config.set('account-manager', 'auth_cookie_db',
+                            'nosuchdb:db/auth_cookie.db')
+        # Falls back to the local table.
+        self.assertEqual(self.login.shared_cookies, None)
+        self.assertEqual(self._name_for_cookie(), 'user')
+
+    def test_refresh(self):
+        self.env.config.set('account-manager', 'persistent_sessions', True)
+        self.env.config.set('account-manager', 'cookie_refresh_pct', 0)
+        req = self._make_req()
+        req.incookie['trac_auth_session'] = 1
+        cookie = req.incookie['trac_auth']
+
+        def cookie_time():
+            for t, in self.env.db_query("""
+                    SELECT time FROM auth_cookie WHERE cookie='123456'
+                    """):
+                return t
+        self.assertEqual(self.login._get_name_for_cookie(req, cookie),
+                         'user')
+        self.assertEqual(req.outcookie['trac_auth'].value, '123456')
+        # Written later on in batches.
+        self.assertEqual(cookie_time(), 0)
+        self.login.flush_cookie_refreshes()
+        self.assertTrue(cookie_time() > 0)
+
+    def test_flush_at_exit(self):
+        self.env.config.set('account-manager', 'persistent_sessions', True)
+        self.env.config.set('account-manager', 'cookie_refresh_pct', 0)
+        req = self._make_req()
+        req.incookie['trac_auth_session'] = 1
+        self.login._get_name_for_cookie(req, req.incookie['trac_auth'])
+        web_ui._flush_login_modules()
+        for t, in self.env.db_query("SELECT time FROM auth_cookie"):
+            self.assertTrue(t > 0)
+
+    def test_not_kept_alive(self):
+        env = EnvironmentStub(enable=['trac.*', 'acct_mgr.*'])
+        login = weakref.ref(LoginModule(env))
+        self.assertTrue(login() in web_ui._login_modules)
+        env.shutdown()
+        del env
+        gc.collect()
+        self.assertEqual(None, login())
+
+    def test_rotate(self):
+        self.env.config.set('account-manager', 'persistent_sessions', True)
+        self.env.config.set('account-manager', 'cookie_refresh_pct', 100)
+        self.assertEqual(self._name_for_cookie(), 'user')
+        req = self._make_req()
+        req.incookie['trac_auth_session'] = 1
+        self.assertEqual(self.login._get_name_for_cookie(
+                             req, req.incookie['trac_auth']), 'user')
+        value = req.outcookie['trac_auth'].value
+        self.assertNotEqual(value, '123456')
+        # Rotation takes effect immediately.
+        self.assertEqual(self._name_for_cookie(), None)
+        self.assertEqual(self._name_for_cookie(value), 'user')
+
+
+class LoginRateLimitTestCase(_BaseTestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'acct_mgr.*'],
+                                   disable=['trac.web.auth.LoginModule'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('account-manager', 'login_rate_ip_max', 2)
+        self.login = LoginModule(self.env)
+        self.calls = []
+        self.login._remote_user = lambda req: self.calls.append(req) and None
+
+    def _authenticate(self, username='user'):
+        req = Mock(method='POST', path_info='/login', remote_addr='127.0.0.1',
+                   remote_user=None, args={'username': username,
+                                           'password': 'wrong'},
+                   environ={}, incookie=Cookie(), outcookie=Cookie())
+        self.login.authenticate(req)
+        return req
+
+    def test_throttled(self):
+        for username in ('user', 'unknown'):
+            req = self._authenticate(username)
+            self.assertFalse(req.args.get('login_throttled'))
+        self.assertEqual(len(self.calls), 2)
+        # Further attempts are rejected without checking passwords.
+        req = self._authenticate('other')
+        self.assertTrue(req.args['login_throttled'])
+        self.assertEqual(req.environ['REMOTE_USER'], None)
+        self.assertEqual(len(self.calls), 2)
+
+
+class SSOTestCase(_BaseTestCase):
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.env.config.set('trac', 'auth_cookie_path', '/')
+        self.login = LoginModule(self.env)
+        self.parent_dir = os.path.join(self.env.path, 'envs')
+        os.mkdir(self.parent_dir)
+        self.envs = {}
+        for env_name in ('local', 'shared1', 'shared2', 'other'):
+            options = [('trac', 'database', 'sqlite:db/trac.db')]
+            if env_name != 'other':
+                options.append(('trac', 'auth_cookie_path', '/'))
+            self.envs[env_name] = Environment(
+                os.path.join(self.parent_dir, env_name), create=True,
+                options=options)
+        self.req = Mock(base_path='/local', remote_addr='127.0.0.1',
+                        environ={'trac.env_parent_dir': self.parent_dir})
+
+    def tearDown(self):
+        for env in self.envs.itervalues():
+            env.shutdown()
+        _BaseTestCase.tearDown(self)
+
+    def _names(self, env_name):
+        return [name for name, in self.envs[env_name].db_query("""
+            SELECT name FROM auth_cookie WHERE cookie='123456'
+            """)]
+
+    def test_sso_environments(self):
+        self.assertEqual(['local', 'shared1', 'shared2'],
+                         sorted(env_name for env_name, env_path in
+                                self.login._sso_environments(
+                                    self.req.environ)))
+        # Configuration changes are picked up.
+        config = self.envs['other'].config
+        config.set('trac', 'auth_cookie_path', '/')
+        time.sleep(0.01)
+        config.save()
+        self.assertEqual(4, len(self.login._sso_environments(
+                                    self.req.environ)))
+
+    def test_sso_environments_inherit(self):
+        self.assertEqual(3, len(self.login._sso_environments(
+                                    self.req.environ)))
+        shared = os.path.join(self.parent_dir, 'shared.ini')
+        with open(shared, 'w') as f:
+            f.write('[trac]\n')
+        config = self.envs['other'].config
+        config.set('inherit', 'file', shared)
+        time.sleep(0.01)
+        config.save()
+        self.assertEqual(3, len(self.login._sso_environments(
+                                    self.req.environ)))
+        # Changes of inherited files are picked up too.
+        time.sleep(0.01)
+        with open(shared, 'w') as f:
+            f.write('[trac]\nauth_cookie_path = /\n')
+        self.assertEqual(4, len(self.login._sso_environments(
+                                    self.req.environ)))
+
+    def test_distribute_auth(self):
+        self.login._distribute_auth(self.req, '123456', 'user')
+        self.assertEqual([], self._names('local'))
+        self.assertEqual(['user'], self._names('shared1'))
+        self.assertEqual(['user'], self._names('shared2'))
+        self.assertEqual([], self._names('other'))
+        # Revoke auth data.
+        self.login._distribute_auth(self.req, '123456')
+        self.assertEqual([], self._names('shared1'))
+        self.assertEqual([], self._names('shared2'))
+
+    def test_unknown_cookie(self):
+        self.login._distribute_auth(self.req, '123456', 'user')
+        incookie = Cookie()
+        incookie['trac_auth'] = '123456'
+        req = Mock(base_path='/local', remote_addr='127.0.0.1',
+                   incookie=incookie, outcookie=Cookie(),
+                   environ=self.req.environ)
+        self.assertEqual(None, self.login._get_name_for_cookie(
+                                   req, incookie['trac_auth']))
+        # Unknown here, but not revoked from other environments.
+        self.assertEqual(['user'], self._names('shared1'))
+        self.login._expire_cookie(req)
+        self.assertEqual([], self._names('shared1'))
+
+
+class SharedAuthCookiesTestCase(_BaseTestCase):
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        uri = 'sqlite:' + os.path.join(self.env.path, 'shared.db')
+        self.env.config.set('account-manager', 'auth_cookie_db', uri)
+        self.env2 = EnvironmentStub(enable=['trac.*', 'acct_mgr.*'])
+        self.env2.path = tempfile.mkdtemp()
+        self.env2.config.set('account-manager', 'auth_cookie_db', uri)
+        self.login = LoginModule(self.env)
+        self.login2 = LoginModule(self.env2)
+        self.login.shared_cookies.insert('123456', 'user', '127.0.0.1', 0)
+
+    def tearDown(self):
+        self.env2.shutdown()
+        shutil.rmtree(self.env2.path)
+        _BaseTestCase.tearDown(self)
+
+    def _make_req(self, value='123456'):
+        incookie = Cookie()
+        incookie['trac_auth'] = value
+        return Mock(authname='user', base_path='/', method='POST',
+                    incookie=incookie, outcookie=Cookie(),
+                    remote_addr='127.0.0.1')
+
+    def _name_for_cookie(self, login, value='123456'):
+        req = self._make_req(value)
+        return login._get_name_for_cookie(req, req.incookie['trac_auth'])
+
+    def test_name_for_cookie(self):
+        self.assertEqual(self._name_for_cookie(self.login), 'user')
+        self.assertEqual(self._name_for_cookie(self.login2), 'user')
+        self.assertEqual(self._name_for_cookie(self.login2, '654321'), None)
+
+    def test_logout(self):
+        self.assertEqual(self._name_for_cookie(self.login2), 'user')
+        self.login._do_logout(self._make_req())
+        self.assertEqual(self._name_for_cookie(self.login2), None)
+
+    def test_delete_user(self):
+        delete_user(self.env2, 'user')
+        self.assertEqual(self._name_for_cookie(self.login), None)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ApiKeyTestCase))
+    suite.addTest(unittest.makeSuite(ResetPasswordsTestCase))
+    suite.addTest(unittest.makeSuite(AuthCookieTestCase))
+    suite.addTest(unittest.makeSuite(LoginRateLimitTestCase))
+    suite.addTest(unittest.makeSuite(SSOTestCase))
+    suite.addTest(unittest.makeSuite(SharedAuthCookiesTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -12,7 +12,10 @@
 
 import os
 import sys
+import time
 import urllib2
+from collections import OrderedDict, deque
+from threading import Lock, Thread
 
 from acct_mgr.api import _, ngettext
 from trac.config import Option
@@ -64,6 +67,157 @@ else:
     HTTPBasicAuthHandler = urllib2.HTTPBasicAuthHandler
 
 
+class LRUCache(object):
+    """A small, thread-safe mapping with least-recently-used eviction.
+
+    Entries optionally expire after `ttl` seconds, so that values derived
+    from data changed by other processes are not served forever.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Re-insert to mark the entry as most recently used.
+            self._data[key] = value, expires
+            return value
+
+    def set(self, key, value):
+        expires = self.ttl and time.time() + self.ttl or None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SlidingWindowCounter(object):
+    """Counts events per key within the last `window` seconds.
+
+    Only the most recent `limit` events of a key are kept, because more
+    don't change the verdict of callers. There is no lock, but appending
+    to and popping from a deque are atomic, and keys are pruned in place,
+    so that concurrent updates may just be a bit off.
+    """
+
+    def __init__(self, window, limit, maxkeys=10000):
+        self.window = window
+        self.limit = limit
+        self.maxkeys = maxkeys
+        self._events = {}
+
+    def count(self, key, now=None):
+        events = self._events.get(key)
+        if not events:
+            return 0
+        expired = (now or time.time()) - self.window
+        try:
+            while events[0] <= expired:
+                events.popleft()
+        except IndexError:
+            pass
+        return len(events)
+
+    def add(self, key, now=None):
+        now = now or time.time()
+        events = self._events.get(key)
+        if events is None:
+            if len(self._events) >= self.maxkeys:
+                self._sweep(now)
+            events = self._events.setdefault(key, deque(maxlen=self.limit))
+        events.append(now)
+
+    def _sweep(self, now):
+        """Drop keys without recent events, and the keys with the oldest
+        events too, while there are still too many.
+        """
+        expired = now - self.window
+        last = [(key, e[-1] if e else 0)
+                for key, e in self._events.items()]
+        recent = [(t, key) for key, t in last if t > expired]
+        if len(recent) >= self.maxkeys:
+            recent = sorted(recent)[-(self.maxkeys // 2):]
+        keep = set(key for t, key in recent)
+        for key, t in last:
+            events = self._events.get(key)
+            # Spare keys added or updated concurrently.
+            if key not in keep and events is not None and \
+                    (events[-1] if events else 0) == t:
+                self._events.pop(key, None)
+
+
+def file_signature(filename):
+    """Return a tuple, that changes whenever the file is modified.
+
+    It consists of modification time, size and inode number, the latter
+    catching atomic replacement by rename too.  None is returned for
+    a missing or unreadable file.
+    """
+    try:
+        st = os.stat(filename)
+    except (OSError, IOError):
+        return None
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+def parallel_map(func, items, max_threads):
+    """Return the results of calling `func` for every item, using up to
+    `max_threads` short-lived threads.
+
+    All threads have ended on return.  The first exception raised by
+    `func` is raised again, after all items have been processed.
+    """
+    items = list(items)
+    threads = min(max_threads, len(items))
+    if threads < 2:
+        return map(func, items)
+    results = [None] * len(items)
+    errors = []
+    indices = iter(xrange(len(items)))
+    lock = Lock()
+
+    def work():
+        while True:
+            with lock:
+                i = next(indices, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                errors.append(sys.exc_info())
+    workers = [Thread(target=work) for i in xrange(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
 # taken from a comment of Horst Hansen
 # at http://code.activestate.com/recipes/65441
 def contains_any(str, set):
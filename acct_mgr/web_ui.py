@@ -9,19 +9,26 @@
 #
 # Author: Matthew Good <trac@matt-good.net>
 
+import atexit
+import os
 import random
 import string
 import time
+import weakref
+from threading import Lock, Timer, current_thread
 
 from acct_mgr.api import AccountManager, CommonTemplateProvider
 from acct_mgr.api import _, dgettext, ngettext, tag_
-from acct_mgr.db import SessionStore
-from acct_mgr.guard import AccountGuard
-from acct_mgr.model import get_user_attribute, set_user_attribute
+from acct_mgr.db import SessionStore, SharedAuthCookies, SharedDatabaseHolder
+from acct_mgr.guard import AccountGuard, LoginRateLimiter
+from acct_mgr.model import set_user_attribute, set_user_attributes
+from acct_mgr.model import user_attribute
 from acct_mgr.notification import NotificationError
 from acct_mgr.register import RegistrationModule
-from acct_mgr.util import if_enabled
-from trac.config import BoolOption, ConfigurationError
+from acct_mgr.util import LRUCache, file_signature, if_enabled
+from acct_mgr.util import parallel_map
+from trac.cache import cached
+from trac.config import BoolOption, Configuration, ConfigurationError
 from trac.config import IntOption, Option
 from trac.core import implements
 from trac.env import open_environment
@@ -36,6 +43,18 @@ from trac.web.chrome import add_warning
 from trac.web.main import IRequestHandler, IRequestFilter, get_environments
 
 
+# Login modules of all environments loaded, for flushing pending work
+# at exit without keeping environments alive until then.
+_login_modules = weakref.WeakSet()
+
+
+def _flush_login_modules():
+    for module in list(_login_modules):
+        module.flush_cookie_refreshes()
+
+atexit.register(_flush_login_modules)
+
+
 class ResetPwStore(SessionStore):
     """User password store for the 'lost password' procedure."""
 
@@ -295,14 +314,44 @@ class AccountModule(CommonTemplateProvider):
                         for _ in xrange(self.apikey_length)])
 
     def _get_user_apikey(self, username):
-        try:
-            attrs = get_user_attribute(self.env, username, None, 'apikey')
-            current_apikey = attrs[username][1].get('apikey')
-        except:
+        current_apikey = user_attribute(self.env, username, 'apikey')
+        if current_apikey is None:
             self.log.info('\'{}\' is API Key not used.'.format(username))
             current_apikey = _('Please push "Refresh API Key" button.')
         return current_apikey
 
+    def _get_apikey_user(self, apikey):
+        """Return the username owning an API key, or None.
+
+        The lookup is served from an in-memory map, that is shared by all
+        threads and invalidated across processes by Trac's cache table.
+        A (primary key) query confirms the candidate, so that entries made
+        stale by attribute changes outside of `_refresh_apikey` never
+        authenticate anyone.
+        """
+        if not apikey:
+            return None
+        username = self._apikeys.get(apikey)
+        if username is None:
+            return None
+        for value, in self.env.db_query("""
+                SELECT value FROM session_attribute
+                WHERE sid=%s AND authenticated=1 AND name='apikey'
+                """, (username,)):
+            if value == apikey:
+                return username
+        # Stale entry, rebuild the map on next access.
+        del self._apikeys
+        return None
+
+    @cached
+    def _apikeys(self):
+        """Map API keys to usernames of authenticated sessions."""
+        return dict(self.env.db_query("""
+            SELECT value,sid FROM session_attribute
+            WHERE authenticated=1 AND name='apikey'
+            """))
+
     def _reset_password(self, req, username, email):
         """Store a new, temporary password on admin or user request.
 
@@ -336,12 +385,58 @@ class AccountModule(CommonTemplateProvider):
         if acctmgr.force_passwd_change:
             set_user_attribute(self.env, username, 'force_change_passwd', 1)
 
+    def _reset_passwords(self, req, users):
+        """Store new, temporary passwords for many `(username, email)` users
+        at once on admin request.
+
+        Returns a dict mapping usernames to the error raised for them.
+        Users with failed notifications only get a new password anyway.
+        """
+        resets = [(username, email, self._random_password)
+                  for username, email in users]
+        try:
+            self.store.set_passwords([(username, password)
+                                      for username, email, password
+                                      in resets])
+        except Exception, e:
+            add_warning(req, _("Cannot reset password: %(error)s",
+                               error=exception_to_unicode(e)))
+            self.log.error("Unable to reset passwords: %s",
+                           exception_to_unicode(e, traceback=True))
+            return dict((username, e) for username, email in users)
+        errors = self.acctmgr._notify_password_resets(resets)
+        failed = []
+        for username in sorted(errors):
+            e = errors[username]
+            if isinstance(e, NotificationError):
+                self.log.error("Unable to send password reset notification "
+                               "for user %s: %s", username,
+                               exception_to_unicode(e))
+            else:
+                failed.append(username)
+                add_warning(req, _("Cannot reset password for %(user)s: "
+                                   "%(error)s", user=username,
+                                   error=exception_to_unicode(e)))
+                self.log.error("Unable to reset password for user %s: %s",
+                               username, exception_to_unicode(e))
+        if len(failed) < len(errors):
+            add_warning(req, _("Error raised while sending a change "
+                               "notification.") +
+                        _("You'll get details with TracLogging enabled."))
+        if self.acctmgr.force_passwd_change:
+            set_user_attributes(self.env,
+                                [(username, 'force_change_passwd', 1)
+                                 for username, email in users
+                                 if username not in failed])
+        return errors
+
     def _refresh_apikey(self, req, username):
         """
         Refresh api-key on user request.
         """
         apikey = self._generate_apikey
         set_user_attribute(self.env, username, 'apikey', apikey)
+        del self._apikeys
 
 class LoginModule(auth.LoginModule, CommonTemplateProvider):
     """Custom login form and processing.
@@ -397,6 +492,15 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
         'account-manager', 'environ_reverse_proxy_auth', 'HTTP_X_FORWARDED_USER',
         """Environment variable referenced during reverse proxy authentication.""")
 
+    auth_cookie_db = Option(
+        'account-manager', 'auth_cookie_db', '',
+        """Database connection string of an authentication cookie store
+        shared by several Trac environments, e.g.
+        `sqlite:/var/lib/trac/auth_cookie.db`. If set, all environments
+        using it look up auth cookies there and logins are written there
+        only, instead of being copied to every environment with the same
+        'auth_cookie_path'. Use an absolute path for SQLite.""")
+
     # Update cookies for persistant sessions only 1/day.
     #   hex_entropy returns 32 chars per call equal to 128 bit of entropy,
     #   so it should be technically impossible to explore the hash even within
@@ -405,7 +509,31 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
     #   equal to a full-scale DDoS attack - an entirely different issue.
     UPDATE_INTERVAL = 86400
 
+    # Bounds for the cache of auth cookie to username resolution results.
+    # Revocation through this plugin takes effect immediately in all
+    # processes, the TTL limits the lifetime of entries made stale by
+    # other means, i.e. direct db changes.
+    COOKIE_CACHE_SIZE = 1000
+    COOKIE_CACHE_TTL = 60
+
+    # Delay in seconds for writing batched auth cookie time refreshes.
+    COOKIE_REFRESH_DELAY = 30
+
+    # Maximum number of environments receiving SSO auth data concurrently.
+    # Distribution completes within the request, so that other
+    # environments know the auth cookie before the browser does.
+    SSO_THREADS = 8
+
     def __init__(self):
+        self._cookie_names = LRUCache(self.COOKIE_CACHE_SIZE,
+                                      self.COOKIE_CACHE_TTL)
+        self._cookie_refreshes = {}
+        self._cookie_refresh_lock = Lock()
+        self._cookie_refresh_timer = None
+        _login_modules.add(self)
+        self._sso_config = {}
+        self._shared_cookies = SharedDatabaseHolder(self.env,
+                                                    SharedAuthCookies)
         cfg = self.config
         if self.env.is_enabled(self.__class__) and \
                 self.env.is_enabled(auth.LoginModule):
@@ -429,30 +557,49 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
     def authenticate(self, req):
         if req.method == 'POST' and req.path_info.startswith('/login') and \
                         req.args.get('user_locked') is None:
-            username = self._remote_user(req)
+            limiter = LoginRateLimiter(self.env)
+            throttled = limiter.enabled and \
+                        limiter.limited(req.remote_addr,
+                                        req.args.get('username'))
+            if throttled:
+                # Reject without consulting any password store.
+                username = None
+                req.args['login_throttled'] = True
+            else:
+                username = self._remote_user(req)
+                if username is None and limiter.enabled:
+                    limiter.add_failure(req.remote_addr,
+                                        req.args.get('username'))
             acctmgr = AccountManager(self.env)
             guard = AccountGuard(self.env)
-            if guard.login_attempt_max_count > 0:
+            if throttled:
+                req.args['user_locked'] = False
+            elif guard.login_attempt_max_count > 0:
                 if username is None:
                     # Get user for failed authentication attempt.
                     f_user = req.args.get('username')
                     req.args['user_locked'] = False
+                    # Load lock state once, methods below keep it current.
+                    state = guard.get_state(f_user)
                     # Log current failed login attempt.
-                    guard.failed_count(f_user, req.remote_addr)
-                    if guard.user_locked(f_user):
+                    guard.failed_count(f_user, req.remote_addr, state=state)
+                    if guard.user_locked(f_user, state):
                         # Step up lock time prolongation only while locked.
-                        guard.lock_count(f_user, 'up')
+                        guard.lock_count(f_user, 'up', state)
                         req.args['user_locked'] = True
-                elif guard.user_locked(username):
-                    req.args['user_locked'] = True
-                    # Void successful login as long as user is locked.
-                    username = None
                 else:
-                    req.args['user_locked'] = False
-                    if req.args.get('failed_logins') is None:
-                        # Reset failed login attempts counter.
-                        req.args['failed_logins'] = \
-                            guard.failed_count(username, reset=True)
+                    state = guard.get_state(username)
+                    if guard.user_locked(username, state):
+                        req.args['user_locked'] = True
+                        # Void successful login as long as user is locked.
+                        username = None
+                    else:
+                        req.args['user_locked'] = False
+                        if req.args.get('failed_logins') is None:
+                            # Reset failed login attempts counter.
+                            req.args['failed_logins'] = \
+                                guard.failed_count(username, reset=True,
+                                                   state=state)
             else:
                 req.args['user_locked'] = False
             if 'REMOTE_USER' not in req.environ or self.environ_auth_overwrite:
@@ -499,7 +646,10 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
             if req.method == 'POST':
                 self.log.debug("LoginModule.process_request: 'user_locked' "
                                "= %s", req.args.get('user_locked'))
-                if not req.args.get('user_locked'):
+                if req.args.get('login_throttled'):
+                    data['login_error'] = _("Too many failed login attempts, "
+                                            "please try again later")
+                elif not req.args.get('user_locked'):
                     # TRANSLATOR: Intentionally obfuscated login error
                     data['login_error'] = _("Invalid username or password")
                 else:
@@ -544,11 +694,24 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
             if acctmgr.persistent_sessions or not self.check_ip:
                 sql = "SELECT name FROM auth_cookie WHERE cookie=%s"
                 args = (cookie.value,)
-            name = None
-            for name, in self.env.db_query(sql, args):
-                break
+            shared = self.shared_cookies
+            if shared:
+                # Not cached, so that revocation by other environments
+                # takes effect immediately.
+                name = shared.get_name(*args)
+            else:
+                generation = self._cookie_generation
+                name, generation_ = self._cookie_names.get(args,
+                                                           (None, None))
+                if generation_ is not generation:
+                    name = None
+                    for name, in self.env.db_query(sql, args):
+                        self._cookie_names.set(args, (name, generation))
+                        break
         if name is None:
-            self._expire_cookie(req)
+            # Other environments may still be unaware of the cookie, so
+            # only an explicit logout revokes it from them.
+            self._expire_cookie(req, revoke=False)
 
         if acctmgr.persistent_sessions and name and \
                         'trac_auth_session' in req.incookie and \
@@ -564,10 +727,6 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
             # Update the timestamp of the session so that it doesn't expire.
             self.log.debug("Updating session %s for user %s", cookie.value,
                            name)
-            # Refresh in database
-            self.env.db_transaction("""
-                UPDATE auth_cookie SET time=%s WHERE cookie=%s
-                """, (int(time.time()), cookie.value))
 
             # Change session ID (cookie.value) now and then as it otherwise
             #   never would change at all (i.e. stay the same indefinitely and
@@ -579,12 +738,25 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
                 self.log.debug("Changing session id for user %s to %s", name,
                                cookie.value)
 
-                self.env.db_transaction("""
-                    UPDATE auth_cookie SET cookie=%s WHERE cookie=%s
-                    """, (cookie.value, old_cookie))
-
-                if self.auth_cookie_path:
-                    self._distribute_auth(req, cookie.value, name)
+                # The new value must be known to all processes before
+                # the next request, so this can't be deferred.
+                with self._cookie_refresh_lock:
+                    self._cookie_refreshes.pop(old_cookie, None)
+                if shared:
+                    shared.rotate(old_cookie, cookie.value, int(time.time()))
+                else:
+                    with self.env.db_transaction as db:
+                        db("""
+                            UPDATE auth_cookie SET cookie=%s,time=%s
+                            WHERE cookie=%s
+                            """, (cookie.value, int(time.time()), old_cookie))
+                        self.revoke_cookie_cache()
+
+                    if self.auth_cookie_path:
+                        self._distribute_auth(req, cookie.value, name)
+            else:
+                # Refresh in database later on.
+                self._queue_cookie_refresh(cookie.value, int(time.time()))
 
             cookie_lifetime = self.cookie_lifetime
             cookie_path = self._get_cookie_path(req)
@@ -599,6 +771,64 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
                 req.outcookie['trac_auth_session']['secure'] = True
         return name
 
+    def flush_cookie_refreshes(self):
+        """Write pending auth cookie time refreshes to the database."""
+        with self._cookie_refresh_lock:
+            refreshes, self._cookie_refreshes = self._cookie_refreshes, {}
+            timer, self._cookie_refresh_timer = \
+                self._cookie_refresh_timer, None
+        if timer and timer is not current_thread():
+            # Let the thread end, before the interpreter shuts down.
+            timer.cancel()
+            timer.join()
+        if not refreshes:
+            return
+        try:
+            shared = self.shared_cookies
+            if shared:
+                shared.refresh(refreshes)
+            else:
+                with self.env.db_transaction as db:
+                    db.executemany("""
+                        UPDATE auth_cookie SET time=%s WHERE cookie=%s
+                        """, [(t, cookie)
+                              for cookie, t in refreshes.iteritems()])
+        except Exception, e:
+            # Refreshes are merely lost, so that sessions might expire
+            # a bit earlier than intended.
+            self.log.warning("Failed to refresh %d auth cookies: %s",
+                             len(refreshes), exception_to_unicode(e))
+
+    def _queue_cookie_refresh(self, cookie, t):
+        with self._cookie_refresh_lock:
+            self._cookie_refreshes[cookie] = t
+            if self._cookie_refresh_timer is None:
+                timer = self._cookie_refresh_timer = \
+                    Timer(self.COOKIE_REFRESH_DELAY,
+                          self.flush_cookie_refreshes)
+                timer.daemon = True
+                timer.start()
+
+    @property
+    def shared_cookies(self):
+        """The `SharedAuthCookies` store configured by 'auth_cookie_db',
+        or None, also while it can't be opened.
+        """
+        return self._shared_cookies.get(self.auth_cookie_db)
+
+    def revoke_cookie_cache(self):
+        """Discard cached auth cookie to username resolutions of all
+        processes, i.e. after auth cookies have been changed or deleted.
+        """
+        del self._cookie_generation
+
+    @cached
+    def _cookie_generation(self):
+        """An opaque token, renewed whenever auth cookies are revoked
+        by any process sharing the environment.
+        """
+        return object()
+
     # overrides
     def _do_login(self, req):
         if not req.remote_user:
@@ -620,7 +850,11 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
         req.outcookie['trac_auth']['path'] = cookie_path
         # Inspect current cookie and try auth data distribution for SSO.
         cookie = req.outcookie.get('trac_auth')
-        if cookie and self.auth_cookie_path:
+        shared = self.shared_cookies
+        if cookie and shared:
+            shared.insert(cookie.value, req.remote_user, req.remote_addr,
+                          int(time.time()))
+        elif cookie and self.auth_cookie_path:
             self._distribute_auth(req, cookie.value, req.remote_user)
 
         if req.args.get('rememberme', '0') == '1':
@@ -651,59 +885,107 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
                 self._expire_session_cookie(req)
         return res
 
+    # overrides
+    def _do_logout(self, req):
+        self.flush_cookie_refreshes()
+        try:
+            auth.LoginModule._do_logout(self, req)
+        finally:
+            # Auth cookies have been deleted, unless logout was rejected.
+            # Note, that a custom logout redirect ends the request early.
+            if req.method == 'POST' and req.authname != 'anonymous':
+                self.revoke_cookie_cache()
+
     def _distribute_auth(self, req, trac_auth, name=None):
         # Single Sign On authentication distribution between multiple
         #   Trac environments managed by AccountManager.
         local_env_name = req.base_path.lstrip('/')
+        ipnr = req.remote_addr
 
-        for env_name, env_path in get_environments(req.environ).iteritems():
-            if env_name != local_env_name:
-                try:
-                    # Cache environment for subsequent invocations.
-                    env = open_environment(env_path, use_cache=True)
-                    auth_cookie_path = env.config.get('trac',
-                                                      'auth_cookie_path')
-                    # Consider only Trac environments with equal, non-default
-                    # 'auth_cookie_path', which enables cookies to be shared.
-                    if auth_cookie_path == self.auth_cookie_path:
-                        with env.db_transaction as db:
-                            # Authentication cookie values must be unique.
-                            # Ensure, there is no other session (or worse:
-                            # session ID) associated to it.
-                            db("""
-                                DELETE FROM auth_cookie WHERE cookie=%s
-                                """, (trac_auth,))
-                            if not name:
-                                env.log.debug("Auth data revoked from: %s",
-                                              local_env_name)
-                                continue
-
-                            db("""
-                                INSERT INTO auth_cookie (cookie,name,ipnr,time)
-                                VALUES (%s,%s,%s,%s)
-                                """, (trac_auth, name, req.remote_addr,
-                                      int(time.time())))
-
-                        env.log.debug("Auth data received from: %s",
+        def distribute(target):
+            env_name, env_path = target
+            try:
+                # Cache environment for subsequent invocations.
+                env = open_environment(env_path, use_cache=True)
+                with env.db_transaction as db:
+                    # Authentication cookie values must be unique.
+                    # Ensure, there is no other session (or worse:
+                    # session ID) associated to it.
+                    db("""
+                        DELETE FROM auth_cookie WHERE cookie=%s
+                        """, (trac_auth,))
+                    LoginModule(env).revoke_cookie_cache()
+                    if not name:
+                        env.log.debug("Auth data revoked from: %s",
                                       local_env_name)
-                        self.log.debug("Auth distribution success: %s",
-                                       env_name)
+                        return
+
+                    db("""
+                        INSERT INTO auth_cookie (cookie,name,ipnr,time)
+                        VALUES (%s,%s,%s,%s)
+                        """, (trac_auth, name, ipnr, int(time.time())))
+
+                env.log.debug("Auth data received from: %s", local_env_name)
+                self.log.debug("Auth distribution success: %s", env_name)
+            except Exception, e:
+                self.log.debug("Auth distribution skipped for env %s: %s",
+                               env_name,
+                               exception_to_unicode(e, traceback=True))
+
+        envs = [(env_name, env_path) for env_name, env_path
+                in self._sso_environments(req.environ)
+                if env_name != local_env_name]
+        parallel_map(distribute, envs, self.SSO_THREADS)
+
+    def _sso_environments(self, environ):
+        """Return `(env_name, env_path)` of all environments sharing the
+        'auth_cookie_path' with this one.
+
+        The setting is read from each environment's trac.ini, and reread
+        only after the file has been modified.
+        """
+        envs = []
+        for env_name, env_path in get_environments(environ).iteritems():
+            filename = os.path.join(env_path, 'conf', 'trac.ini')
+            try:
+                filenames, signature_, auth_cookie_path = \
+                    self._sso_config[env_path]
+            except KeyError:
+                filenames, signature_ = [filename], None
+            # Inherited files are watched for changes too.
+            signature = tuple(file_signature(f) for f in filenames)
+            if signature[0] is None:
+                continue
+            if signature != signature_:
+                try:
+                    config = Configuration(filename)
+                    auth_cookie_path = config.get('trac', 'auth_cookie_path')
                 except Exception, e:
-                    self.log.debug("Auth distribution skipped for env %s: %s",
-                                   env_name,
-                                   exception_to_unicode(e, traceback=True))
+                    self.log.debug("Auth distribution skipped for env %s: "
+                                   "%s", env_name, exception_to_unicode(e))
+                    continue
+                filenames = [filename] + _inherited_files(config)
+                signature = tuple(file_signature(f) for f in filenames)
+                self._sso_config[env_path] = filenames, signature, \
+                                             auth_cookie_path
+            # Consider only Trac environments with equal, non-default
+            # 'auth_cookie_path', which enables cookies to be shared.
+            if auth_cookie_path == self.auth_cookie_path:
+                envs.append((env_name, env_path))
+        return envs
 
     def _get_cookie_path(self, req):
         """Determine "path" cookie property from setting or request object."""
         return self.auth_cookie_path or req.base_path or '/'
 
     # overrides
-    def _expire_cookie(self, req):
+    def _expire_cookie(self, req, revoke=True):
         """Instruct the user agent to drop the auth_session cookie by setting
         the "expires" property to a date in the past.
 
         Basically, whenever "trac_auth" cookie gets expired, expire
-        "trac_auth_session" too.
+        "trac_auth_session" too.  Unless `revoke` is False, the cookie is
+        revoked from other environments sharing it as well.
         """
         # First of all expire trac_auth_session cookie, if it exists.
         if 'trac_auth_session' in req.incookie:
@@ -714,10 +996,18 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
             trac_auth = cookie.value
         else:
             trac_auth = None
+        if trac_auth:
+            self._cookie_names.pop((trac_auth,))
+            self._cookie_names.pop((trac_auth, req.remote_addr))
         # Then let auth.LoginModule expire all other cookies.
         auth.LoginModule._expire_cookie(self, req)
         # And finally revoke distributed authentication data too.
-        if self.auth_cookie_path and trac_auth:
+        if not revoke or not trac_auth:
+            return
+        shared = self.shared_cookies
+        if shared:
+            shared.delete(trac_auth)
+        elif self.auth_cookie_path:
             self._distribute_auth(req, trac_auth)
 
     # Keep this code in a separate methode to be able to expire the session
@@ -786,12 +1076,7 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
 
     def _remote_user_by_apikey(self, req, apikey):
         """The real authentication using API Key."""
-        username = None
-        for acct, status in get_user_attribute(self.env,
-                                               authenticated=None,
-                                               attribute='apikey').iteritems():
-            if status[1].get('apikey') == apikey:
-                username = acct
+        username = AccountModule(self.env)._get_apikey_user(apikey)
         self.env.log.debug("LoginModule._remote_user: Authentication "
                            "attempted for '%s'", username)
         return username
@@ -807,6 +1092,15 @@ class LoginModule(auth.LoginModule, CommonTemplateProvider):
                not self.env.is_enabled(auth.LoginModule)
 
 
+def _inherited_files(config):
+    """Return the filenames of all files inherited by a `Configuration`."""
+    filenames = []
+    for parent in config.parents:
+        filenames.append(parent.filename)
+        filenames.extend(_inherited_files(parent))
+    return filenames
+
+
 def _set_password(env, req, username, password, old_password=None):
     try:
         AccountManager(env).set_password(username, password,
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Micro-benchmarks for performance sensitive AccountManager code paths.
+
+Usage: python contrib/benchmark.py [name ...]
+
+Without arguments all benchmarks are run.  Each benchmark prints the mean
+time per call for a growing number of accounts, so that scaling behavior
+becomes obvious at a glance.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from trac.core import Component, implements
+from trac.notification import IEmailSender
+from trac.test import EnvironmentStub, Mock
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append((fn.__name__[len('bench_'):], fn))
+    return fn
+
+
+def measure(fn, repeat=1000):
+    """Return mean wall clock time per call of `fn` in microseconds."""
+    fn()  # warm-up, i.e. for populating caches
+    start = time.time()
+    for _ in xrange(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000000
+
+
+def report(label, size, usec, unit='accounts'):
+    print '  %-32s %8d %s: %10.1f us/call' % (label, size, unit, usec)
+
+
+def make_env(*enable):
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'acct_mgr.*'] + list(enable))
+    env.path = tempfile.mkdtemp()
+    env.config.set('account-manager', 'password_store', 'SessionStore')
+    return env
+
+
+def destroy_env(env):
+    env.shutdown()
+    shutil.rmtree(env.path)
+
+
+def populate_attribute(env, name, size, value='%s-value'):
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO session_attribute (sid,authenticated,name,value)
+            VALUES (%s,1,%s,%s)
+            """, [('user%d' % i, name, value % i) for i in xrange(size)])
+
+
+@benchmark
+def bench_apikey(sizes=(100, 1000, 10000, 100000)):
+    """API key authentication by LoginModule."""
+    from acct_mgr.web_ui import LoginModule
+    for size in sizes:
+        env = make_env()
+        try:
+            populate_attribute(env, 'apikey', size, 'key%040d')
+            login = LoginModule(env)
+            req = Mock(args={}, environ={
+                'HTTP_X_TRAC_API_KEY': 'key%040d' % (size // 2)})
+            assert login._remote_user(req) == 'user%d' % (size // 2)
+            report('_remote_user_by_apikey', size,
+                   measure(lambda: login._remote_user(req)))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_htfile(sizes=(10000, 100000)):
+    """Password checks against large htpasswd and htdigest files."""
+    from acct_mgr.htfile import HtDigestStore, HtPasswdStore
+    from acct_mgr.pwhash import htdigest, mkhtpasswd
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'htdigest_realm', 'realm')
+            env.config.set('account-manager', 'htpasswd_file', 'htpasswd')
+            env.config.set('account-manager', 'htdigest_file', 'htdigest')
+            # Cheap hashes to not hide lookup cost behind hashing cost.
+            hash_ = mkhtpasswd('password', 'sha')
+            with open(os.path.join(env.path, 'htpasswd'), 'w') as f:
+                f.writelines('user%d:%s\n' % (i, hash_)
+                             for i in xrange(size))
+            with open(os.path.join(env.path, 'htdigest'), 'w') as f:
+                f.writelines('user%d:realm:%s\n'
+                             % (i, htdigest('user%d' % i, 'realm',
+                                            'password'))
+                             for i in xrange(size))
+            user = u'user%d' % (size - 1)
+            for store in (HtPasswdStore(env), HtDigestStore(env)):
+                assert store.check_password(user, u'password') is True
+                report('%s.check_password' % store.__class__.__name__, size,
+                       measure(lambda: store.check_password(user,
+                                                            u'password'),
+                               repeat=100))
+                report('%s.has_user' % store.__class__.__name__, size,
+                       measure(lambda: store.has_user(user), repeat=100))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_htfile_register(sizes=(10000, 100000)):
+    """Adding users to a large htpasswd file, followed by a lookup."""
+    from acct_mgr.htfile import HtPasswdStore
+    from acct_mgr.pwhash import mkhtpasswd
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'htpasswd_file', 'htpasswd')
+            env.config.set('account-manager', 'htpasswd_hash_type', 'sha')
+            with open(os.path.join(env.path, 'htpasswd'), 'w') as f:
+                f.writelines('user%d:%s\n' % (i, mkhtpasswd('password', 'sha'))
+                             for i in xrange(size))
+            store = HtPasswdStore(env)
+            count = iter(xrange(size, size * 2))
+
+            def register():
+                user = u'user%d' % next(count)
+                store.set_password(user, u'password')
+                assert store.has_user(user)
+            report('HtPasswdStore.set_password', size,
+                   measure(register, repeat=100))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_bulk_delete(sizes=(100, 2000)):
+    """Banning and deleting spam accounts one by one vs. in bulk."""
+    from acct_mgr.api import AccountManager
+    from acct_mgr.db import SessionStore  # register the component
+    from acct_mgr.model import set_user_attribute
+    for size in sizes:
+        env = make_env()
+        try:
+            acctmgr = AccountManager(env)
+            populate_attribute(env, 'password', size)
+            users = ['user%d' % i for i in xrange(size)]
+
+            def ban_each():
+                for user in users:
+                    set_user_attribute(env, user, 'approval', 'revoked')
+            report('set_user_attribute (each)', size,
+                   measure(ban_each, repeat=1))
+            report('set_user_attributes_bulk', size,
+                   measure(lambda: acctmgr.set_user_attributes_bulk(
+                       [(user, 'approval', 'revoked') for user in users]),
+                       repeat=1))
+
+            def delete_each():
+                for user in users[:size // 2]:
+                    acctmgr.delete_user(user)
+            start = time.time()
+            delete_each()
+            report('delete_user (each)', size // 2,
+                   (time.time() - start) * 1000000)
+            start = time.time()
+            acctmgr.delete_users(users[size // 2:])
+            report('delete_users', size // 2,
+                   (time.time() - start) * 1000000)
+            assert not list(acctmgr.get_users())
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_user_listing(sizes=(100, 1000, 10000)):
+    """Building the account list of the user admin panel."""
+    from acct_mgr.admin import fetch_user_data, fetch_user_page
+    from acct_mgr.db import SessionStore  # register the component
+    from trac.perm import PermissionCache
+    from trac.util.datefmt import utc
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'login_attempt_max_count', 3)
+            populate_attribute(env, 'password', size)
+            populate_attribute(env, 'email', size, 'user%d@example.org')
+            populate_attribute(env, 'failed_logins_count', size, '%d')
+            with env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO session (sid,authenticated,last_visit)
+                    VALUES (%s,1,0)
+                    """, [('user%d' % i,) for i in xrange(size)])
+            req = Mock(authname='admin', href=env.href, tz=utc,
+                       perm=PermissionCache(env, 'admin'), session={})
+            assert len(fetch_user_data(env, req)) == size
+            report('fetch_user_data', size,
+                   measure(lambda: fetch_user_data(env, req), repeat=3))
+            filters = ['active', 'pending']
+            assert fetch_user_page(env, req, filters)[1] == size
+            for order in ('username', 'email'):
+                report('fetch_user_page (%s)' % order, size,
+                       measure(lambda: fetch_user_page(env, req, filters,
+                                                       order, page=2),
+                               repeat=10))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_user_attribute(sizes=(1000, 10000, 100000)):
+    """Fetching all attributes of authenticated users, with and without IDs."""
+    from acct_mgr.model import get_user_attribute
+    for size in sizes:
+        env = make_env()
+        try:
+            populate_attribute(env, 'email', size, 'user%d@example.org')
+            assert len(get_user_attribute(env, authenticated=1)) == size
+            for ids in (False, True):
+                report('get_user_attribute (ids=%s)' % ids, size,
+                       measure(lambda: get_user_attribute(env,
+                                                          authenticated=1,
+                                                          ids=ids),
+                               repeat=3))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_failed_login(sizes=(1000, 10000)):
+    """Logging failed login attempts and setting passwords."""
+    from acct_mgr.db import SessionStore
+    from acct_mgr.guard import AccountGuard
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'login_attempt_max_count', 5)
+            env.config.set('account-manager', 'hash_method',
+                           'HtPasswdHashMethod')
+            env.config.set('account-manager', 'db_htpasswd_hash_type', 'sha')
+            populate_attribute(env, 'password', size)
+            with env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO session (sid,authenticated,last_visit)
+                    VALUES (%s,1,0)
+                    """, [('user%d' % i,) for i in xrange(size)])
+            guard = AccountGuard(env)
+            store = SessionStore(env)
+            user = 'user%d' % (size // 2)
+            report('AccountGuard.failed_count', size,
+                   measure(lambda: guard.failed_count(user)))
+            report('AccountGuard.user_locked', size,
+                   measure(lambda: guard.user_locked(user)))
+            report('SessionStore.set_password', size,
+                   measure(lambda: store.set_password(user, 'password'),
+                           repeat=100))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_auth_cookie(sizes=(1000, 100000)):
+    """Resolving the auth cookie of authenticated requests."""
+    from Cookie import SimpleCookie as Cookie
+    from acct_mgr.web_ui import LoginModule
+    from trac.cache import CacheManager
+    for size in sizes:
+        env = make_env()
+        try:
+            with env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO auth_cookie (cookie,name,ipnr,time)
+                    VALUES (%s,%s,'127.0.0.1',0)
+                    """, [('%032x' % i, 'user%d' % i) for i in xrange(size)])
+            login = LoginModule(env)
+            incookie = Cookie()
+            incookie['trac_auth'] = '%032x' % (size // 2)
+            req = Mock(base_path='/', incookie=incookie, outcookie=Cookie(),
+                       remote_addr='127.0.0.1')
+            cookie = incookie['trac_auth']
+
+            def resolve(reset=False):
+                if reset:
+                    # Cache metadata is reset at the start of every request
+                    # and fetched once on first use of any cached property.
+                    CacheManager(env).reset_metadata()
+                return login._get_name_for_cookie(req, cookie)
+            assert resolve() == 'user%d' % (size // 2)
+            report('_get_name_for_cookie', size, measure(resolve))
+            report('_get_name_for_cookie (reset)', size,
+                   measure(lambda: resolve(True)))
+            # Daily refresh of persistent sessions.
+            env.config.set('account-manager', 'persistent_sessions', True)
+            env.config.set('account-manager', 'cookie_refresh_pct', 0)
+            incookie['trac_auth_session'] = 1
+            report('_get_name_for_cookie (refresh)', size, measure(resolve))
+            login.flush_cookie_refreshes()
+            del incookie['trac_auth_session']
+            env.config.set('account-manager', 'persistent_sessions', False)
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_sso(sizes=(5, 20)):
+    """Distributing SSO auth data to sibling environments."""
+    from acct_mgr.web_ui import LoginModule
+    from trac.env import Environment
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('trac', 'auth_cookie_path', '/')
+            parent_dir = os.path.join(env.path, 'envs')
+            os.mkdir(parent_dir)
+            for i in xrange(size):
+                Environment(os.path.join(parent_dir, 'env%d' % i),
+                            create=True,
+                            options=[('trac', 'database', 'sqlite:db/trac.db'),
+                                     ('trac', 'auth_cookie_path', '/')])
+            login = LoginModule(env)
+            req = Mock(base_path='/env0', remote_addr='127.0.0.1',
+                       environ={'trac.env_parent_dir': parent_dir})
+
+            def login_logout():
+                login._distribute_auth(req, '123456', 'user')
+                login._distribute_auth(req, '123456')
+            report('_distribute_auth', size,
+                   measure(login_logout, repeat=10) / 2, 'environments')
+            env.config.set('account-manager', 'auth_cookie_db',
+                           'sqlite:db/auth_cookie.db')
+            shared = login.shared_cookies
+
+            def shared_login_logout():
+                shared.insert('123456', 'user', '127.0.0.1', 0)
+                shared.delete('123456')
+            report('SharedAuthCookies', size,
+                   measure(shared_login_logout, repeat=10) / 2,
+                   'environments')
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_hash_workers(sizes=(0, 2, 4)):
+    """Concurrent password checks by 8 threads with worker processes."""
+    from threading import Thread
+    from acct_mgr.pwhash import HtPasswdHashMethod
+    for hash_type in ('md5', 'sha512'):
+        for size in sizes:
+            env = make_env()
+            try:
+                # Only these are expensive enough to be handed to workers.
+                env.config.set('account-manager', 'db_htpasswd_hash_type',
+                               hash_type)
+                env.config.set('account-manager', 'hash_workers', size)
+                method = HtPasswdHashMethod(env)
+                hash_ = method.generate_hash('user', u'password')
+
+                def check(repeat=10):
+                    for _ in xrange(repeat):
+                        assert method.check_hash('user', u'password', hash_)
+
+                def concurrent_checks():
+                    threads = [Thread(target=check) for _ in xrange(8)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                report('check_hash (%s)' % hash_type, size,
+                       measure(concurrent_checks, repeat=5) / 80, 'workers')
+            finally:
+                destroy_env(env)
+
+
+@benchmark
+def bench_md5crypt(sizes=(8, 64)):
+    """md5crypt ($1$, $apr1$) hashing by the available backends."""
+    from acct_mgr import pwhash
+    from acct_mgr.md5crypt import md5crypt
+    backends = [('md5crypt', md5crypt)]
+    if pwhash.crypt is not None:
+        backends.append(('crypt', pwhash._crypt_md5crypt))
+    if pwhash.md5_crypt is not None:
+        backends.append(('passlib', pwhash._passlib_md5crypt(
+                                        pwhash.md5_crypt)))
+        backends.append(('passlib apr1', pwhash._passlib_md5crypt(
+                                             pwhash.apr_md5_crypt)))
+    for size in sizes:
+        password = 'x' * size
+        for name, fn in backends:
+            magic = '$apr1$' if name.endswith('apr1') else '$1$'
+            report(name, size, measure(lambda: fn(password, 'saltsalt',
+                                                  magic), repeat=200),
+                   'characters')
+        for magic in ('$1$', '$apr1$'):
+            report('htpasswd %s' % magic, size,
+                   measure(lambda: pwhash.htpasswd(password,
+                                                   magic + 'saltsalt$'),
+                           repeat=200), 'characters')
+
+
+@benchmark
+def bench_verify_cache(sizes=(0, 60)):
+    """Repeated password checks with md5 hashes and verify_cache_ttl."""
+    from acct_mgr.api import AccountManager
+    from acct_mgr.db import SessionStore
+    from acct_mgr.pwhash import HtPasswdHashMethod
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'hash_method',
+                           'HtPasswdHashMethod')
+            env.config.set('account-manager', 'db_htpasswd_hash_type', 'md5')
+            env.config.set('account-manager', 'verify_cache_ttl', size)
+            mgr = AccountManager(env)
+            mgr.set_password('user', 'password')
+            report('check_password', size,
+                   measure(lambda: mgr.check_password('user', 'password'),
+                           repeat=200), 'seconds TTL')
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_basic_check(sizes=(1000, 10000, 100000)):
+    """Username uniqueness check of BasicCheck for a registration."""
+    from acct_mgr.db import SessionStore
+    from acct_mgr.register import BasicCheck, RegistrationError
+    for size in sizes:
+        env = make_env()
+        try:
+            populate_attribute(env, 'password', size)
+            check = BasicCheck(env)
+            req = Mock(path_info='/register',
+                       args={'username': 'USER%d' % (size - 1) + 'x',
+                             'password': 'p', 'password_confirm': 'p'})
+
+            def validate():
+                check.validate_registration(req)
+            report('validate_registration', size, measure(validate, 100))
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_perm_check(sizes=(1000, 50000)):
+    """Permission subject check of UsernamePermCheck for a registration."""
+    from acct_mgr.register import UsernamePermCheck
+    for size in sizes:
+        env = make_env()
+        try:
+            with env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO permission (username,action) VALUES (%s,%s)
+                    """, [('user%d' % i, 'WIKI_VIEW') for i in xrange(size)])
+            check = UsernamePermCheck(env)
+            req = Mock(authname='anonymous', args={'username': 'newuser'})
+            report('validate_registration', size,
+                   measure(lambda: check.validate_registration(req), 100),
+                   'permissions')
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_login_rate(sizes=(100, 10000)):
+    """Login rate limiter checks with many tracked clients."""
+    from acct_mgr.guard import LoginRateLimiter
+    for size in sizes:
+        env = make_env()
+        try:
+            env.config.set('account-manager', 'login_rate_ip_max', 10)
+            env.config.set('account-manager', 'login_rate_user_max', 10)
+            limiter = LoginRateLimiter(env)
+            for i in xrange(size):
+                limiter.add_failure('10.0.%d.%d' % divmod(i, 256),
+                                    'user%d' % i)
+            report('limited', size,
+                   measure(lambda: limiter.limited('10.0.0.1', 'user1'),
+                           10000), 'clients')
+            report('add_failure', size,
+                   measure(lambda: limiter.add_failure('10.0.0.1', 'user1'),
+                           10000), 'clients')
+            env.config.set('account-manager', 'login_rate_db',
+                           'sqlite:db/login_attempt.db')
+            # Not limited in memory, so that the db is queried.
+            report('limited (login_rate_db)', size,
+                   measure(lambda: limiter.limited('10.1.0.1', 'other'),
+                           1000), 'clients')
+            report('add_failure (login_rate_db)', size,
+                   measure(lambda: limiter.add_failure('10.0.0.1', 'user2'),
+                           100), 'clients')
+        finally:
+            destroy_env(env)
+
+
+class SlowEmailSender(Component):
+    """Email sender taking `delay` seconds per message."""
+
+    implements(IEmailSender)
+
+    delay = 0
+
+    def send(self, from_addr, recipients, message):
+        time.sleep(self.delay)
+
+
+def _make_notification_env(queued):
+    env = make_env(SlowEmailSender)
+    config = env.config
+    config.set('account-manager', 'notify_actions', 'new')
+    config.set('account-manager', 'account_changes_notify_addresses',
+               'admin@example.org')
+    config.set('account-manager', 'notification_queue', queued)
+    config.set('notification', 'smtp_enabled', True)
+    config.set('notification', 'email_sender', 'SlowEmailSender')
+    return env
+
+
+@benchmark
+def bench_notification_queue(sizes=(0, 50)):
+    """Registration notification with a mail server taking size ms."""
+    from acct_mgr.api import AccountManager
+    from acct_mgr.notification import NotificationQueue
+    for size in sizes:
+        SlowEmailSender.delay = size / 1000.0
+        for queued in (False, True):
+            env = _make_notification_env(queued)
+            try:
+                acctmgr = AccountManager(env)
+                # Measure the request only, not the background delivery.
+                NotificationQueue(env)._start_worker = lambda: None
+                report('user_created (notification_queue=%s)' % queued,
+                       size, measure(lambda: acctmgr._notify('created',
+                                                             'user', 'x'),
+                                     20), 'ms smtp')
+            finally:
+                destroy_env(env)
+
+
+@benchmark
+def bench_notification_workers(sizes=(1, 4)):
+    """Delivery of 20 queued notifications, mail server taking 20 ms."""
+    from acct_mgr.api import AccountManager
+    from acct_mgr.notification import NotificationQueue
+    SlowEmailSender.delay = 0.02
+    for size in sizes:
+        env = _make_notification_env(True)
+        try:
+            env.config.set('account-manager', 'notification_workers', size)
+            acctmgr = AccountManager(env)
+            queue = NotificationQueue(env)
+            queue._start_worker = lambda: None
+
+            def process():
+                for i in xrange(20):
+                    acctmgr._notify('created', 'user%d' % i, 'x')
+                queue.process()
+            report('process', size, measure(process, 5) / 20, 'workers')
+        finally:
+            destroy_env(env)
+
+
+@benchmark
+def bench_bulk_reset(sizes=(100, 1000)):
+    """Admin password reset for many users, mail server taking 5 ms."""
+    from acct_mgr.web_ui import AccountModule
+    SlowEmailSender.delay = 0.005
+    for size in sizes:
+        env = _make_notification_env(False)
+        try:
+            env.known_users = [('user%d' % i, None, 'user%d@example.org' % i)
+                               for i in xrange(size)]
+            users = [(username, email)
+                     for username, name, email in env.known_users]
+            acctmod = AccountModule(env)
+            req = Mock(path_info='/admin/accounts/users',
+                       chrome={'notices': [], 'warnings': []})
+
+            def reset_each():
+                for username, email in users:
+                    acctmod._reset_password(req, username, email)
+            report('_reset_password loop', size,
+                   measure(reset_each, 1) / size)
+            report('_reset_passwords', size,
+                   measure(lambda: acctmod._reset_passwords(req, users), 1)
+                   / size)
+        finally:
+            destroy_env(env)
+
+
+def main(names):
+    for name, fn in BENCHMARKS:
+        if not names or name in names:
+            print '%s: %s' % (name, fn.__doc__)
+            fn()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])